@@ -0,0 +1,284 @@
+# Threaded vs asyncio pipeline throughput.
+#
+# Runs many stories end to end through each engine's entry point against the
+# fake provider: run_story_pipeline on a thread per story (like concurrent
+# queue invocations), and run_story_pipeline_async with every story a task on
+# one event loop sharing one set of clients (what PipelineEngine=async does).
+# Both go through the stage DAG, the story lease, the checkpoint writes and
+# the story slots. Each story starts from a checkpointed transcription, so
+# ffmpeg isn't needed, and runs the separate-mode text stages, chunked
+# narration, key-point images and timeline. Blob storage is in memory (block
+# data is discarded), the database is a no-op connection and the result cache
+# is off. Reports throughput, story wall time, the peak number of threads and
+# the Python heap peak per level of concurrency.
+#
+# Usage: python benchmarks/bench_async_pipeline.py [stories]
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SqlConnectionString", "benchmark")
+os.environ.setdefault("AzureBlobStorageConnectionString", "benchmark")
+os.environ.setdefault("AudioStorageContainerName", "audio")
+os.environ["ResultCacheEnabled"] = "false"
+os.environ["ImageTransferMode"] = "b64"
+os.environ["PipelineLlmMode"] = "separate"
+os.environ["PipelineSentimentMode"] = "llm"
+for limit in ("WhisperRequestsPerMinute", "ChatRequestsPerMinute", "ChatTokensPerMinute", "TtsRequestsPerMinute", "ImageRequestsPerMinute"):
+    os.environ.setdefault(limit, "0")
+
+import pyodbc
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+import pipeline_async
+import pipeline_stages
+import provider_limits
+from providers import AsyncFakeProvider, FakeProvider
+
+CONCURRENCY_LEVELS = (4, 16, 64)
+LATENCY_SECONDS = 0.3
+SECONDS_PER_1K_TOKENS = 1.0
+STORY_URL = "https://example.invalid/audio/{story_id}/recording.mp3"
+
+class NullCursor:
+    def __init__(self, story_id=None):
+        self.story_id = story_id
+
+    def execute(self, query, *args):
+        if query.startswith("SELECT story_url"):
+            self.story_id = args[0]
+        return self
+
+    def executemany(self, query, rows):
+        pass
+
+    def fetchone(self):
+        return (STORY_URL.format(story_id=self.story_id), f"Story {self.story_id}")
+
+class NullConnection:
+    def cursor(self):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+class MemoryLease:
+    def __init__(self, blob):
+        self.blob = blob
+
+    def renew(self):
+        pass
+
+    def release(self):
+        self.blob.store.leases.discard(self.blob.key)
+
+class MemoryBlob:
+    """Keeps what's uploaded whole (the state blobs); staged blocks are only counted."""
+
+    def __init__(self, store, container, name):
+        self.store = store
+        self.key = (container, name)
+        self.blob_name = name
+        self.url = f"https://example.invalid/{container}/{name}"
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        if not overwrite and self.key in self.store.blobs:
+            raise ResourceExistsError("blob already exists")
+        self.store.blobs[self.key] = data
+
+    def download_blob(self, **kwargs):
+        if self.key not in self.store.blobs:
+            raise ResourceNotFoundError("blob not found")
+        return MemoryDownload(self.store.blobs[self.key])
+
+    def acquire_lease(self, lease_duration=-1):
+        if self.key in self.store.leases:
+            raise ResourceExistsError("lease already present")
+        self.store.leases.add(self.key)
+        return MemoryLease(self)
+
+    def stage_block(self, block_id, data):
+        self.store.staged_bytes += len(data)
+
+    def commit_block_list(self, block_ids, **kwargs):
+        pass
+
+class MemoryDownload:
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+class MemoryContainer:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get_blob_client(self, name):
+        return MemoryBlob(self.store, self.name, name)
+
+class MemoryBlobService:
+    def __init__(self):
+        self.blobs = {}
+        self.leases = set()
+        self.staged_bytes = 0
+
+    def get_container_client(self, container):
+        return MemoryContainer(self, container)
+
+    def get_blob_client(self, container, blob):
+        return MemoryBlob(self, container, blob)
+
+# The same store behind azure.storage.blob.aio's interface.
+
+class AsyncMemoryLease:
+    def __init__(self, lease):
+        self.lease = lease
+
+    async def renew(self):
+        self.lease.renew()
+
+    async def release(self):
+        self.lease.release()
+
+class AsyncMemoryDownload:
+    def __init__(self, download):
+        self.download = download
+
+    async def readall(self):
+        return self.download.readall()
+
+class AsyncMemoryBlob:
+    def __init__(self, blob):
+        self.blob = blob
+        self.blob_name = blob.blob_name
+        self.url = blob.url
+
+    async def upload_blob(self, data, overwrite=False, **kwargs):
+        self.blob.upload_blob(data, overwrite=overwrite)
+
+    async def download_blob(self, **kwargs):
+        return AsyncMemoryDownload(self.blob.download_blob())
+
+    async def acquire_lease(self, lease_duration=-1):
+        return AsyncMemoryLease(self.blob.acquire_lease(lease_duration))
+
+    async def stage_block(self, block_id, data):
+        self.blob.stage_block(block_id, data)
+
+    async def commit_block_list(self, block_ids, **kwargs):
+        pass
+
+class AsyncMemoryContainer:
+    def __init__(self, container):
+        self.container = container
+
+    def get_blob_client(self, name):
+        return AsyncMemoryBlob(self.container.get_blob_client(name))
+
+class AsyncMemoryBlobService:
+    def __init__(self, store):
+        self.store = store
+
+    def get_container_client(self, container):
+        return AsyncMemoryContainer(self.store.get_container_client(container))
+
+    def get_blob_client(self, container, blob):
+        return AsyncMemoryBlob(self.store.get_blob_client(container, blob))
+
+def transcript_for(story_id):
+    return " ".join(f"Story {story_id} spoken sentence {i} of the original recording." for i in range(80))
+
+def transcribed_store(n_stories):
+    """A blob store holding each story's state with its transcription already checkpointed."""
+    store = MemoryBlobService()
+    for story_id in range(n_stories):
+        state = pipeline_stages.new_state(STORY_URL.format(story_id=story_id), "separate")
+        state["stages"]["transcribe"] = {
+            "output": {"transcript": transcript_for(story_id), "transcript_segments": [], "audio_metrics": {}},
+            "completed": state["created"], "seconds": 0.0
+        }
+        pipeline_stages.save_state(store, story_id, state)
+    return store
+
+def run_threaded(n_stories, concurrency):
+    store = transcribed_store(n_stories)
+    pipeline_stages.BlobServiceClient.from_connection_string = lambda connection_string: store
+    pipeline_stages.openai_client = FakeProvider(latency_seconds=LATENCY_SECONDS, seconds_per_1k_tokens=SECONDS_PER_1K_TOKENS)
+
+    def run(story_id):
+        report = {}
+        pipeline_stages.run_story_pipeline(story_id, lane=provider_limits.LOW, report=report)
+        return report
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(run, range(n_stories)))
+
+def run_async(n_stories, concurrency):
+    store = transcribed_store(n_stories)
+    provider = AsyncFakeProvider(latency_seconds=LATENCY_SECONDS, seconds_per_1k_tokens=SECONDS_PER_1K_TOKENS)
+
+    async def run(clients, story_id):
+        report = {}
+        await pipeline_async.run_story_pipeline_async(clients, story_id, lane=provider_limits.LOW, report=report)
+        return report
+
+    async def main():
+        async with pipeline_async.AsyncPipelineClients(openai_client=provider, blob_service=AsyncMemoryBlobService(store)) as clients:
+            return await asyncio.gather(*(run(clients, story_id) for story_id in range(n_stories)))
+
+    return asyncio.run(main())
+
+def measure(name, run, n_stories, concurrency):
+    provider_limits.MAX_CONCURRENT_STORIES = concurrency
+    provider_limits.LOW_LANE_STORY_SLOTS = concurrency
+    peak_threads = [threading.active_count()]
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.wait(0.01):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    tracemalloc.start()
+    started = time.perf_counter()
+    reports = run(n_stories, concurrency)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sampling.set()
+    sampler.join()
+
+    statuses = {report.get("status") for report in reports}
+    assert statuses == {"processed"}, f"{name}: stories ended as {statuses}"
+    # Wall time from getting a story slot, so neither design counts the time
+    # a story waited to start.
+    latencies = sorted(report["critical_path"]["wall_seconds"] for report in reports)
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95)]
+    # The sampler thread itself is not counted.
+    print(f"{name:>8} {concurrency:>11} {n_stories / elapsed * 60:12.1f} {p50:8.2f}s {p95:8.2f}s {peak_threads[0] - 1:8d} {peak / 2**20:8.1f} MB")
+
+def main():
+    n_stories = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    pyodbc.connect = lambda *args, **kwargs: NullConnection()
+    print(f"{n_stories} stories, {LATENCY_SECONDS * 1000:.0f} ms per call + {SECONDS_PER_1K_TOKENS}s per 1k output tokens")
+    print(f"{'design':>8} {'concurrency':>11} {'stories/min':>12} {'p50':>9} {'p95':>9} {'threads':>8} {'heap peak':>11}")
+    for concurrency in CONCURRENCY_LEVELS:
+        measure("threaded", run_threaded, n_stories, concurrency)
+        measure("async", run_async, n_stories, concurrency)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Compares synchronous and deferred (Batch API) structured analysis.
+#
+# Sends the same analysis request for every story either as one chat call per
+# story or as one batch through pipeline_batch.py, both against
+# providers.FakeProvider, and reports API requests, simulated time spent
+# waiting on calls and the estimated cost at provider_limits.PRICES.
+#
+# Usage: python benchmarks/bench_deferred_batch.py [stories]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import pipeline_batch
+import pipeline_stages
+from providers import FakeProvider
+from provider_limits import PRICES
+
+LATENCY_SECONDS = 0.02
+SECONDS_PER_1K_TOKENS = 0.1
+BATCH_POLLS = 3
+
+def main():
+    n_stories = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    transcript = " ".join(f"Spoken sentence {i} of the original recording." for i in range(60))
+    requests = [(f"story-{i}", pipeline_stages.story_analysis_request(f"Story {i}", transcript)) for i in range(n_stories)]
+    print(f"{n_stories} stories")
+    print(f"{'mode':<12} {'API requests':>13} {'busy seconds':>13} {'est. cost':>10}")
+
+    client = FakeProvider(LATENCY_SECONDS, SECONDS_PER_1K_TOKENS)
+    tokens = 0
+    start = time.perf_counter()
+    for _, request in requests:
+        response = client.chat.completions.create(**request)
+        pipeline_stages.validate_story_analysis(json.loads(response.choices[0].message.content))
+        tokens += response.usage.total_tokens
+    elapsed = time.perf_counter() - start
+    cost = tokens / 1000 * PRICES["chat_per_1k_tokens"]
+    print(f"{'synchronous':<12} {client.api_requests:13d} {elapsed:13.2f} {cost:10.2f}")
+
+    client = FakeProvider(LATENCY_SECONDS, SECONDS_PER_1K_TOKENS, batch_polls=BATCH_POLLS)
+    start = time.perf_counter()
+    batch_id = pipeline_batch.submit_batch(client, requests)
+    results = None
+    while results is None:
+        status, results = pipeline_batch.collect_batch(client, batch_id)
+    elapsed = time.perf_counter() - start
+    tokens = 0
+    for custom_id, _ in requests:
+        content, error, total_tokens = results[custom_id]
+        assert error is None
+        pipeline_stages.validate_story_analysis(json.loads(content))
+        tokens += total_tokens
+    cost = tokens / 1000 * PRICES["chat_per_1k_tokens"] * PRICES["batch_discount"]
+    print(f"{'deferred':<12} {client.api_requests:13d} {elapsed:13.2f} {cost:10.2f}")
+
+if __name__ == "__main__":
+    main()
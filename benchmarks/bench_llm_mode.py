@@ -0,0 +1,59 @@
+# Compares the separate and structured LLM modes of pipeline_stages.py.
+#
+# Runs only the text stages (sentiment, rewrite, key points vs. one
+# structured analysis) against providers.FakeProvider and reports chat
+# calls, tokens and simulated latency per story, as counted by
+# provider_limits.RateLimitedClient.
+#
+# Usage: python benchmarks/bench_llm_mode.py [stories] [malformed_rate]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ["ResultCacheEnabled"] = "false"
+for limit in ("ChatRequestsPerMinute", "ChatTokensPerMinute"):
+    os.environ.setdefault(limit, "0")
+
+import pipeline_stages
+from providers import FakeProvider
+from provider_limits import RateLimitedClient
+
+LATENCY_SECONDS = 0.02
+SECONDS_PER_1K_TOKENS = 0.1
+
+def run_text_stages(mode, ctx, transcript):
+    outputs = {"transcript": transcript}
+    if mode == "structured":
+        outputs.update(pipeline_stages.stage_analysis(ctx, outputs))
+    else:
+        outputs.update(pipeline_stages.stage_sentiment(ctx, outputs))
+        outputs.update(pipeline_stages.stage_rewrite(ctx, outputs))
+        outputs.update(pipeline_stages.stage_key_points(ctx, outputs))
+    return outputs
+
+def main():
+    n_stories = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    malformed_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    # The fake decides per request which key-point answers are malformed, so
+    # every story gets its own transcript.
+    transcripts = [" ".join(f"Story {story} spoken sentence {i} of the original recording." for i in range(60)) for story in range(n_stories)]
+    ctx = {"story_id": 0, "story_title": "Benchmark story", "blob_service": None, "refresh_cache": False}
+
+    print(f"{n_stories} stories, {malformed_rate:.0%} malformed key-point answers")
+    print(f"{'mode':<12} {'calls/story':>12} {'tokens/story':>13} {'latency/story':>14}")
+    for mode in ("separate", "structured"):
+        client = RateLimitedClient(FakeProvider(LATENCY_SECONDS, SECONDS_PER_1K_TOKENS, malformed_rate=malformed_rate))
+        ctx["openai_client"] = client
+        start = time.perf_counter()
+        for transcript in transcripts:
+            outputs = run_text_stages(mode, ctx, transcript)
+            assert outputs["key_points"] and outputs["enhanced_script"]
+        elapsed = time.perf_counter() - start
+        calls = client.usage["requests"]["chat"]
+        print(f"{mode:<12} {calls / n_stories:12.2f} {client.usage['chat_tokens'] / n_stories:13.0f} {elapsed / n_stories * 1000:12.1f}ms")
+
+if __name__ == "__main__":
+    main()
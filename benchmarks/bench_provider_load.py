@@ -0,0 +1,123 @@
+# Offline load test of the provider-bound pipeline stages.
+#
+# Runs stories concurrently against providers.FakeProvider: structured
+# analysis, chunked narration and key-point images, each story holding a
+# story slot and going through RateLimitedClient like a real run. Blob
+# clients discard what they're given, and the result cache is off. Reports
+# throughput, story latency, the Python heap peak and injected errors for
+# several levels of concurrency. Provider rate limits are off unless set in
+# the environment (e.g. ImageRequestsPerMinute=7).
+#
+# Also checks that a run recorded by providers.RecordReplayProvider replays
+# to identical results.
+#
+# Usage: python benchmarks/bench_provider_load.py [stories] [error_rate]
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ["ResultCacheEnabled"] = "false"
+os.environ["ImageTransferMode"] = "b64"
+for limit in ("WhisperRequestsPerMinute", "ChatRequestsPerMinute", "ChatTokensPerMinute", "TtsRequestsPerMinute", "ImageRequestsPerMinute"):
+    os.environ.setdefault(limit, "0")
+
+import pipeline_images
+import pipeline_narration
+import pipeline_stages
+import provider_limits
+from providers import FakeProvider, RecordReplayProvider
+
+CONCURRENCY_LEVELS = (1, 4, 8)
+
+class DiscardingBlob:
+    url = "https://example.invalid/blob"
+
+    def stage_block(self, block_id, data):
+        pass
+
+    def commit_block_list(self, block_ids, **kwargs):
+        pass
+
+class DiscardingContainer:
+    def get_blob_client(self, name):
+        return DiscardingBlob()
+
+def transcript_for(story_id):
+    return " ".join(f"Story {story_id} spoken sentence {i} of the original recording." for i in range(80))
+
+def run_story(provider, story_id):
+    """Returns (seconds, failed images)."""
+    started = time.perf_counter()
+    with provider_limits.story_slots.hold(provider_limits.LOW):
+        client = provider_limits.RateLimitedClient(provider, provider_limits.LOW)
+        ctx = {"story_id": story_id, "story_title": f"Story {story_id}", "blob_service": None, "refresh_cache": False, "openai_client": client}
+        analysis = pipeline_stages.stage_analysis(ctx, {"transcript": transcript_for(story_id)})
+        pipeline_narration.synthesize_narration(client, analysis["enhanced_script"], DiscardingBlob())
+        key_points = [tuple(point) for point in analysis["key_points"]]
+        images = pipeline_images.generate_key_point_images(client, DiscardingContainer(), story_id, key_points, analysis["sentiment"])
+    return time.perf_counter() - started, sum(1 for image in images if "error" in image)
+
+def load(n_stories, concurrency, error_rate):
+    provider = FakeProvider(latency_seconds=0.05, seconds_per_1k_tokens=0.2, error_rate=error_rate)
+    provider_limits.MAX_CONCURRENT_STORIES = concurrency
+    provider_limits.LOW_LANE_STORY_SLOTS = concurrency
+    latencies = []
+    failed = [0, 0]
+    lock = threading.Lock()
+
+    def one(story_id):
+        try:
+            seconds, failed_images = run_story(provider, story_id)
+            with lock:
+                latencies.append(seconds)
+                failed[1] += failed_images
+        except Exception:
+            with lock:
+                failed[0] += 1
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(n_stories)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] if latencies else 0
+    p95 = latencies[int(len(latencies) * 0.95)] if latencies else 0
+    print(f"{concurrency:>11} {n_stories / elapsed * 60:12.1f} {p50:8.2f}s {p95:8.2f}s {peak / 2**20:8.1f} MB {provider.errors:7d} {failed[0]:8d} {failed[1]:7d}")
+
+def check_replay():
+    transcript = transcript_for(0)
+    with tempfile.TemporaryDirectory() as directory:
+        recorder = RecordReplayProvider(FakeProvider(latency_seconds=0), directory)
+        replayer = RecordReplayProvider(None, directory)
+        outputs = []
+        for client in (recorder, replayer):
+            ctx = {"story_id": 0, "story_title": "Story 0", "blob_service": None, "refresh_cache": False, "openai_client": client}
+            analysis = pipeline_stages.stage_analysis(ctx, {"transcript": transcript})
+            chunks = pipeline_narration.synthesize_narration(client, analysis["enhanced_script"], DiscardingBlob())
+            outputs.append((analysis, chunks))
+    ok = outputs[0] == outputs[1]
+    print(f"record/replay: {'identical' if ok else 'MISMATCH'}")
+    return ok
+
+def main():
+    n_stories = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    error_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    print(f"{n_stories} stories, {error_rate:.0%} injected provider errors")
+    print(f"{'concurrency':>11} {'stories/min':>12} {'p50':>9} {'p95':>9} {'heap peak':>11} {'errors':>7} {'failed':>8} {'images':>7}")
+    for concurrency in CONCURRENCY_LEVELS:
+        load(n_stories, concurrency, error_rate)
+    sys.exit(0 if check_replay() else 1)
+
+if __name__ == "__main__":
+    main()
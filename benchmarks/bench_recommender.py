@@ -0,0 +1,69 @@
+# Benchmark for the item-item recommender in bp_recommender.py.
+#
+# Generates a synthetic, popularity-skewed interaction log and times the
+# offline build, an incremental refresh and per-user serving.
+#
+# Usage: python benchmarks/bench_recommender.py [interactions] [users] [stories]
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bp_recommender import (
+    build_interaction_matrix,
+    compute_item_similarities,
+    update_item_similarities,
+    score_candidates,
+    LIKE_WEIGHT,
+)
+
+def synthetic_interactions(rng, n_interactions, n_users, n_stories):
+    # Zipf-like story popularity, uniform users.
+    popularity = 1.0 / np.arange(1, n_stories + 1) ** 0.8
+    popularity /= popularity.sum()
+    users = rng.integers(0, n_users, n_interactions)
+    stories = rng.choice(n_stories, n_interactions, p=popularity)
+    weights = np.where(rng.random(n_interactions) < 0.2, LIKE_WEIGHT, 1.0).astype(np.float32)
+    return users, stories, weights
+
+def timed(label, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    print(f"{label:<32} {time.perf_counter() - start:8.3f}s")
+    return result
+
+def main():
+    n_interactions = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_users = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    n_stories = int(sys.argv[3]) if len(sys.argv) > 3 else 20_000
+    rng = np.random.default_rng(7)
+
+    print(f"{n_interactions} interactions, {n_users} users, {n_stories} stories")
+    users, stories, weights = synthetic_interactions(rng, n_interactions, n_users, n_stories)
+
+    matrix, user_index, story_index = timed("build interaction matrix", build_interaction_matrix, users, stories, weights)
+    similarities = timed("compute top-k similarities", compute_item_similarities, matrix)
+    print(f"{'similarity entries':<32} {similarities.nnz:8d}")
+
+    delta_users, delta_stories, delta_weights = synthetic_interactions(rng, n_interactions // 100, n_users, n_stories)
+    delta, _, _ = build_interaction_matrix(delta_users, delta_stories, delta_weights, user_index, story_index)
+    refreshed = matrix.maximum(delta).tocsr()
+    touched = np.searchsorted(story_index, np.unique(delta_stories))
+    timed(f"incremental refresh ({len(touched)} items)", update_item_similarities, similarities, refreshed, touched)
+
+    model = {"story_ids": story_index, "similarities": similarities}
+    latencies = []
+    for user in rng.choice(user_index, 1000, replace=False):
+        row = matrix.getrow(np.searchsorted(user_index, user))
+        history_ids = story_index[row.indices]
+        start = time.perf_counter()
+        score_candidates(model, history_ids, row.data, 10)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.asarray(latencies) * 1000
+    print(f"{'serve p50 / p99':<32} {np.percentile(latencies, 50):.2f}ms / {np.percentile(latencies, 99):.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Agreement of the local sentiment scorer with the LLM.
+#
+# Labels a sample of story texts with sentiment_lexicon and compares the
+# result with the LLM's labels. By default those are the "label" fields of
+# the sample file (benchmarks/sentiment_sample.jsonl holds short stories with
+# the labels the sentiment call gave them). With --llm they come from the
+# pipeline's own sentiment request, sent now through PipelineProvider.
+# Reports:
+# - accuracy and Cohen's kappa;
+# - per-label precision and recall;
+# - the confusion matrix and the disagreements;
+# - the time per story of each classifier;
+# - accuracy over a range of SentimentLexiconThreshold values.
+#
+# Usage: python benchmarks/bench_sentiment_agreement.py [sample.jsonl] [--llm]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from sentiment_lexicon import LABELS, THRESHOLD, agreement, label_for_score, sentiment_score
+
+THRESHOLDS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3)
+
+def load_sample(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def llm_labels(texts):
+    """Labels from the pipeline's sentiment call; returns (labels, seconds per call)."""
+    from pipeline_stages import openai_client, sentiment_request
+    labels = []
+    started = time.perf_counter()
+    for text in texts:
+        response = openai_client.chat.completions.create(**sentiment_request(text))
+        label = response.choices[0].message.content.strip().strip(".").capitalize()
+        labels.append(label if label in LABELS else "Neutral")
+    return labels, (time.perf_counter() - started) / len(texts)
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    path = args[0] if args else os.path.join(os.path.dirname(__file__), "sentiment_sample.jsonl")
+    sample = load_sample(path)
+    texts = [item["text"] for item in sample]
+
+    if "--llm" in sys.argv:
+        expected, llm_seconds = llm_labels(texts)
+    else:
+        expected, llm_seconds = [item["label"] for item in sample], None
+
+    started = time.perf_counter()
+    scores = np.array([sentiment_score(text) for text in texts])
+    lexicon_seconds = (time.perf_counter() - started) / len(texts)
+    predicted = [label_for_score(score) for score in scores]
+
+    result = agreement(expected, predicted)
+    print(f"{result['count']} stories from {path}, threshold {THRESHOLD}")
+    print(f"accuracy {result['accuracy']:.3f}, kappa {result['kappa']:.3f}")
+    for label in LABELS:
+        print(f"  {label:<9} precision {result['precision'][label]}  recall {result['recall'][label]}")
+    print("confusion (rows LLM, columns lexicon): " + "  ".join(f"{label}" for label in LABELS))
+    for label, row in zip(LABELS, result["confusion"]):
+        print(f"  {label:<9} {row}")
+    for text, score, want, got in zip(texts, scores, expected, predicted):
+        if want != got:
+            print(f"  LLM {want:<8} lexicon {got:<8} ({score:+.2f}) {text[:70]}")
+
+    print(f"lexicon {lexicon_seconds * 1000:.2f} ms per story" + (f", LLM {llm_seconds * 1000:.0f} ms per story" if llm_seconds is not None else ""))
+    print("threshold sweep: " + ", ".join(
+        f"{threshold}: {agreement(expected, [label_for_score(score, threshold) for score in scores])['accuracy']:.3f}"
+        for threshold in THRESHOLDS
+    ))
+
+if __name__ == "__main__":
+    main()
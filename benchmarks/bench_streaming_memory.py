@@ -0,0 +1,140 @@
+# Peak-memory check for streamed narration and image uploads.
+#
+# Fakes a TTS provider that streams several MB of MP3 frames per chunk, an
+# image host that streams a large PNG (the fallback when a server-side copy
+# fails) and a base64 image response, uploads them through pipeline_narration
+# / pipeline_images into blob clients that discard staged blocks, and measures
+# the Python heap peak with tracemalloc. The peak has to stay proportional to
+# BlobStreamBlockBytes x concurrency, not the asset size, and every byte has
+# to reach the blob; a regression fails an assertion, so the script exits
+# non-zero. (The base64 string itself is the provider's response and is
+# allocated before measuring.)
+#
+# Usage: python benchmarks/bench_streaming_memory.py [mb_per_tts_chunk] [image_mb]
+
+import base64
+import os
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ["ResultCacheEnabled"] = "false"
+
+import pipeline_images
+import pipeline_narration
+from blob_streaming import STREAM_BLOCK_BYTES, decode_base64_stream, upload_stream
+
+FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)  # 128 kbps, 44.1 kHz MPEG-1 Layer III
+PIECE_BYTES = 64 * 1024
+
+FRAMES_PIECE = FRAME * (PIECE_BYTES // len(FRAME))
+
+def frames_stream(total_bytes):
+    for _ in range(total_bytes // len(FRAMES_PIECE)):
+        yield FRAMES_PIECE
+
+class FakeStreamingSpeech:
+    def __init__(self, bytes_per_chunk):
+        self.bytes_per_chunk = bytes_per_chunk
+
+    def create(self, **kwargs):
+        bytes_per_chunk = self.bytes_per_chunk
+
+        class Response:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def iter_bytes(self, chunk_size):
+                return frames_stream(bytes_per_chunk)
+
+        return Response()
+
+class DiscardingBlob:
+    url = "https://example.invalid/blob"
+
+    def __init__(self):
+        self.staged = 0
+
+    def stage_block(self, block_id, data):
+        self.staged += len(data)
+
+    def commit_block_list(self, block_ids, **kwargs):
+        pass
+
+class FakeImageSession:
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+
+    def get(self, url, stream=False, timeout=None):
+        total_bytes = self.total_bytes
+
+        class Response:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, chunk_size):
+                for _ in range(total_bytes // PIECE_BYTES):
+                    yield bytes(PIECE_BYTES)
+
+        return Response()
+
+def measure(label, fn, blob, asset_bytes, limit_bytes):
+    """Run `fn`, which uploads `asset_bytes` into `blob`, and check its heap peak."""
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} asset {asset_bytes / 2**20:8.1f} MB   peak {peak / 2**20:6.2f} MB   limit {limit_bytes / 2**20:6.2f} MB")
+    assert blob.staged == asset_bytes, f"{label}: uploaded {blob.staged} of {asset_bytes} bytes"
+    assert peak <= limit_bytes, f"{label}: heap peak {peak} bytes is over the {limit_bytes} byte limit"
+
+def main():
+    mb_per_chunk = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    image_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    chunk_bytes = mb_per_chunk * 2**20
+    image_bytes = image_mb * 2**20
+    script = " ".join(f"Sentence number {i} of a long narrated story." for i in range(400))
+    n_chunks = len(pipeline_narration.split_script(script))
+
+    client = SimpleNamespace(audio=SimpleNamespace(speech=SimpleNamespace(with_streaming_response=FakeStreamingSpeech(chunk_bytes))))
+    narration_blob = DiscardingBlob()
+    workers = pipeline_narration.TTS_CONCURRENCY
+    measure(
+        "narration",
+        lambda: pipeline_narration.synthesize_narration(client, script, narration_blob),
+        narration_blob,
+        n_chunks * (chunk_bytes // len(FRAMES_PIECE)) * len(FRAMES_PIECE),
+        workers * 4 * (STREAM_BLOCK_BYTES + PIECE_BYTES) + 2**20
+    )
+
+    image_blob = DiscardingBlob()
+    measure(
+        "image url",
+        lambda: upload_stream(image_blob, pipeline_images._url_stream(FakeImageSession(image_bytes), "https://example.invalid/image.png"), "image/png"),
+        image_blob,
+        image_bytes,
+        4 * (STREAM_BLOCK_BYTES + PIECE_BYTES) + 2**20
+    )
+
+    encoded = base64.b64encode(bytes(image_bytes)).decode("ascii")
+    b64_blob = DiscardingBlob()
+    measure(
+        "image b64",
+        lambda: upload_stream(b64_blob, decode_base64_stream(encoded), "image/png"),
+        b64_blob,
+        image_bytes,
+        4 * STREAM_BLOCK_BYTES + 2**20
+    )
+
+if __name__ == "__main__":
+    main()
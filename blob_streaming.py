@@ -0,0 +1,74 @@
+# Streaming uploads into block blobs.
+#
+# Provider responses are consumed as iterators of byte pieces, regrouped into
+# blocks of STREAM_BLOCK_BYTES and staged as they arrive; the blob appears
+# when the block list is committed. Only one block per stream is held in
+# memory at a time, however large the asset.
+#
+# read_url gives a short-lived SAS URL for a blob, so another blob can be
+# filled from it server-side with upload_blob_from_url.
+
+import base64
+import os
+from datetime import datetime, timedelta
+from azure.storage.blob import ContentSettings, BlobSasPermissions, generate_blob_sas
+
+STREAM_BLOCK_BYTES = int(os.environ.get("BlobStreamBlockBytes", str(256 * 1024)))
+
+def block_id(*parts):
+    """Block ids must all have the same length within a blob."""
+    return "-".join(f"{part:06d}" for part in parts)
+
+def rechunk(pieces, size=STREAM_BLOCK_BYTES):
+    """Regroup an iterator of byte pieces into blocks of `size` bytes (the last may be shorter)."""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+def stage_stream(blob_client, pieces, prefix=0):
+    """Stage `pieces` as blocks; returns the block ids in order for commit_block_list."""
+    block_ids = []
+    for idx, block in enumerate(rechunk(pieces)):
+        current_id = block_id(prefix, idx)
+        blob_client.stage_block(current_id, block)
+        block_ids.append(current_id)
+    return block_ids
+
+def decode_base64_stream(encoded, size=STREAM_BLOCK_BYTES):
+    """Decode a base64 string block by block instead of materializing the decoded bytes at once."""
+    step = size // 3 * 4
+    for start in range(0, len(encoded), step):
+        yield base64.b64decode(encoded[start:start + step])
+
+def read_url(blob_client, minutes=15):
+    """URL another blob can be copied from: the blob URL with a read SAS when the client has an account key."""
+    account_key = getattr(blob_client.credential, "account_key", None)
+    if not account_key:
+        return blob_client.url
+    sas = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.utcnow() + timedelta(minutes=minutes)
+    )
+    return f"{blob_client.url}?{sas}"
+
+def upload_stream(blob_client, pieces, content_type):
+    """Stream `pieces` into `blob_client` and commit it; returns the number of bytes written."""
+    written = [0]
+
+    def counted():
+        for piece in pieces:
+            written[0] += len(piece)
+            yield piece
+
+    block_ids = stage_stream(blob_client, counted())
+    blob_client.commit_block_list(block_ids, content_settings=ContentSettings(content_type=content_type))
+    return written[0]
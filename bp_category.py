@@ -12,6 +12,8 @@ import pyodbc
 import os
 from datetime import datetime
 from azure.storage.blob import BlobServiceClient
+from home_feed import on_preferred_categories_changed
+from category_stats import get_story_counts, refresh_category_stats
 
 bp_category = func.Blueprint()
 
@@ -213,6 +215,7 @@ def update_user_categories(req: func.HttpRequest) -> func.HttpResponse:
                     }
                     final_categories.append(category_dict)
             
+            on_preferred_categories_changed(cursor, user_id)
             conn.commit()
             
             return func.HttpResponse(
@@ -271,30 +274,7 @@ def get_categories(req: func.HttpRequest) -> func.HttpResponse:
         if categories:
             column_names = [column[0] for column in cursor.description]
             
-            category_ids = []
-            for category in categories:
-                cat_id = category[0] 
-                category_ids.append(cat_id)
-            
-            if category_ids:
-                story_count_query = '''
-                SELECT 
-                    shc.category_id,
-                    COUNT(DISTINCT shc.story_id) as story_count
-                FROM 
-                    story_has_categories shc
-                INNER JOIN
-                    story s ON shc.story_id = s.id
-                WHERE 
-                    shc.category_id IN ({}) 
-                    AND s.status = 1
-                GROUP BY 
-                    shc.category_id
-                '''.format(','.join(['?'] * len(category_ids)))
-                
-                cursor.execute(story_count_query, category_ids)
-                for row in cursor.fetchall():
-                    story_counts[row[0]] = row[1]
+            story_counts = get_story_counts(cursor)
             
             for category in categories:
                 category_dict = {}
@@ -337,4 +317,17 @@ def get_categories(req: func.HttpRequest) -> func.HttpResponse:
         )
     finally:
         if 'conn' in locals():
-            conn.close()
\ No newline at end of file
+            conn.close()
+
+@bp_category.timer_trigger(schedule="0 */15 * * * *", arg_name="timer", run_on_startup=False)
+def refresh_category_stats_job(timer: func.TimerRequest) -> None:
+    try:
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        cursor = conn.cursor()
+        refresh_category_stats(cursor)
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Exception while refreshing category stats: {str(e)}")
+    finally:
+        if 'conn' in locals():
+            conn.close()
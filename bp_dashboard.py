@@ -12,6 +12,10 @@ import pyodbc
 import os
 from datetime import datetime, timedelta
 from azure.storage.blob import BlobServiceClient
+from home_feed import get_user_home_feed
+from bp_recommender import recommend_story_ids
+from trending_tracker import trending_now
+from category_index import categories_for_stories
 
 bp_dashboard = func.Blueprint()
 
@@ -66,9 +70,13 @@ def get_dashboard_data(req: func.HttpRequest) -> func.HttpResponse:
         
         recently_listened = []
         if user_id:
-            recently_listened = get_recently_listened_stories(cursor, user_id, 2)
-            if not recently_listened:
-                recently_listened = get_recommended_stories(cursor, user_id, 2)
+            try:
+                home_feed = get_user_home_feed(cursor, user_id)
+                recently_listened = home_feed.get("recentlyListened", [])[:2]
+                if not recently_listened:
+                    recently_listened = home_feed.get("recommended", [])[:2]
+            except Exception as e:
+                logging.error(f"Error in get_user_home_feed: {str(e)}")
         
         trending_categories = get_trending_categories(cursor, 4)
         if not trending_categories:
@@ -144,9 +152,19 @@ def get_trending_stories(cursor, limit=5):
             total_score DESC
         """
         
-        trending_query = f"SELECT TOP {limit} " + trending_query.split("SELECT ")[1]
-        cursor.execute(trending_query, cutoff_date, cutoff_date)
-        stories = cursor.fetchall()
+        stories = []
+        if os.environ.get("TrendingSource", "tracker").lower() == "tracker":
+            stories = get_tracked_trending_rows(cursor, limit)
+        
+        # The tracker can know fewer stories than asked for (e.g. right after a
+        # cold start); top up from the trending query, leaving out the stories
+        # already there.
+        if len(stories) < limit:
+            tracked_ids = [story[0] for story in stories]
+            exclude = f" AND s.id NOT IN ({', '.join('?' * len(tracked_ids))})" if tracked_ids else ""
+            trending_query = f"SELECT TOP {limit - len(stories)} " + trending_query.split("SELECT ")[1].replace("s.status = 1", "s.status = 1" + exclude, 1)
+            cursor.execute(trending_query, cutoff_date, cutoff_date, *tracked_ids)
+            stories = list(stories) + cursor.fetchall()
         
         # Get the connection string and container name for thumbnails
         connection_string = os.environ["AzureBlobStorageConnectionString"]
@@ -154,29 +172,11 @@ def get_trending_stories(cursor, limit=5):
         blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         container_client = blob_service_client.get_container_client(container_name)
         
+        story_categories = categories_for_stories(cursor, [story[0] for story in stories])
+        
         result = []
         for story in stories:
-            cursor.execute("""
-                SELECT 
-                    c.id, c.name, c.description, c.icon
-                FROM 
-                    category c
-                JOIN 
-                    story_has_categories shc ON c.id = shc.category_id
-                WHERE 
-                    shc.story_id = ? AND c.status = 1
-            """, story[0])
-            
-            categories = cursor.fetchall()
-            category_list = []
-            
-            for category in categories:
-                category_list.append({
-                    "id": category[0],
-                    "name": category[1],
-                    "description": category[2],
-                    "icon": category[3]
-                })
+            category_list = story_categories.get(story[0], [])
             
             # Create thumbnail URL
             thumbnail_blob_name = f"{story[0]}/1.png"
@@ -207,6 +207,45 @@ def get_trending_stories(cursor, limit=5):
         logging.error(f"Error in get_trending_stories: {str(e)}")
         return []
 
+def get_tracked_trending_rows(cursor, limit):
+    """Trending rows from the in-memory heavy-hitters tracker, shaped like the trending query's rows."""
+    try:
+        # Over-fetch so inactive stories can be dropped without coming up short.
+        ranked = trending_now(limit * 2)
+        if not ranked:
+            return []
+        
+        placeholders = ','.join(['?' for _ in ranked])
+        cursor.execute(f"""
+            SELECT 
+                s.id, 
+                s.title,
+                s.story_url,
+                s.gen_audio_url,
+                s.created,
+                s.duration,
+                s.listen_count,
+                0 AS listen_score,
+                0 AS like_score,
+                0 AS total_score,
+                u.id AS user_id,
+                u.firstName,
+                u.lastName
+            FROM 
+                story s
+            JOIN 
+                "user" u ON s.user_id = u.id
+            WHERE 
+                s.status = 1
+                AND s.id IN ({placeholders})
+        """, [story_id for story_id, _ in ranked])
+        rank = {story_id: i for i, (story_id, _) in enumerate(ranked)}
+        return sorted(cursor.fetchall(), key=lambda story: rank[story[0]])[:limit]
+    
+    except Exception as e:
+        logging.warning(f"Trending tracker unavailable, using trending query: {str(e)}")
+        return []
+
 def get_most_recent_stories(cursor, limit=5):
     """Fallback method to get most recent stories when trending data is not available."""
     try:
@@ -242,29 +281,11 @@ def get_most_recent_stories(cursor, limit=5):
         blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         container_client = blob_service_client.get_container_client(container_name)
         
+        story_categories = categories_for_stories(cursor, [story[0] for story in stories])
+        
         result = []
         for story in stories:
-            cursor.execute("""
-                SELECT 
-                    c.id, c.name, c.description, c.icon
-                FROM 
-                    category c
-                JOIN 
-                    story_has_categories shc ON c.id = shc.category_id
-                WHERE 
-                    shc.story_id = ? AND c.status = 1
-            """, story[0])
-            
-            categories = cursor.fetchall()
-            category_list = []
-            
-            for category in categories:
-                category_list.append({
-                    "id": category[0],
-                    "name": category[1],
-                    "description": category[2],
-                    "icon": category[3]
-                })
+            category_list = story_categories.get(story[0], [])
             
             # Create thumbnail URL
             thumbnail_blob_name = f"{story[0]}/1.png"
@@ -335,32 +356,14 @@ def get_recently_listened_stories(cursor, user_id, limit=2):
         blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         container_client = blob_service_client.get_container_client(container_name)
         
+        story_categories = categories_for_stories(cursor, [story[0] for story in stories])
+        
         result = []
         for story in stories:
             total_duration = story[3] 
             listened_duration = story[5]
             
-            cursor.execute("""
-                SELECT 
-                    c.id, c.name, c.description, c.icon
-                FROM 
-                    category c
-                JOIN 
-                    story_has_categories shc ON c.id = shc.category_id
-                WHERE 
-                    shc.story_id = ? AND c.status = 1
-            """, story[0])
-            
-            categories = cursor.fetchall()
-            category_list = []
-            
-            for category in categories:
-                category_list.append({
-                    "id": category[0],
-                    "name": category[1],
-                    "description": category[2],
-                    "icon": category[3]
-                })
+            category_list = story_categories.get(story[0], [])
             
             # Create thumbnail URL
             thumbnail_blob_name = f"{story[0]}/1.png"
@@ -391,22 +394,18 @@ def get_recently_listened_stories(cursor, user_id, limit=2):
         logging.error(f"Error in get_recently_listened_stories: {str(e)}")
         return []
 
-def get_recommended_stories(cursor, user_id, limit=2):
-    """Fallback method to get recommended stories based on user preferences when no recently listened stories exist."""
+def get_feed_story_cards(cursor, entries, recommended=False):
+    """
+    Story cards for home feed entries (see home_feed), in order, read from the
+    current story rows. Entries whose story is gone or inactive are left out.
+    Recently listened cards take the listen time and position from the entry.
+    """
+    if not entries:
+        return []
     try:
-        cursor.execute("""
-            SELECT category_id 
-            FROM user_preferred_categories 
-            WHERE user_id = ? AND status = 1
-        """, user_id)
-        
-        preferred_categories = cursor.fetchall()
-        
-        if preferred_categories:
-            placeholders = ','.join(['?' for _ in preferred_categories])
-            category_ids = [cat[0] for cat in preferred_categories]
-            
-            query = f"""
+        story_ids = [entry["id"] for entry in entries]
+        placeholders = ','.join(['?' for _ in story_ids])
+        cursor.execute(f"""
             SELECT 
                 s.id, 
                 s.title,
@@ -420,75 +419,176 @@ def get_recommended_stories(cursor, user_id, limit=2):
                 story s
             JOIN 
                 "user" u ON s.user_id = u.id
-            JOIN 
-                story_has_categories shc ON s.id = shc.story_id
             WHERE 
                 s.status = 1
-                AND shc.category_id IN ({placeholders})
-                AND s.id NOT IN (
-                    SELECT story_id FROM user_has_listen_stories WHERE user_id = ?
-                )
-            ORDER BY 
-                s.created DESC
-            """
-            
-            query = f"SELECT TOP {limit} " + query.split("SELECT ")[1]
-            
-            params = category_ids + [user_id]
-            cursor.execute(query, params)
-        else:
-            query = """
-            SELECT 
-                s.id, 
-                s.title,
-                s.story_url,
-                s.duration,
-                s.created,
-                u.id AS user_id,
-                u.firstName,
-                u.lastName
-            FROM 
-                story s
-            JOIN 
-                "user" u ON s.user_id = u.id
-            WHERE 
-                s.status = 1
-                AND s.id NOT IN (
-                    SELECT story_id FROM user_has_listen_stories WHERE user_id = ?
-                )
-            ORDER BY 
-                s.listen_count DESC
-            """
+                AND s.id IN ({placeholders})
+        """, story_ids)
+        stories = {story[0]: story for story in cursor.fetchall()}
+        story_categories = categories_for_stories(cursor, list(stories))
+        
+        if not recommended:
+            connection_string = os.environ["AzureBlobStorageConnectionString"]
+            container_name = os.environ.get("StoryImagesContainerName", "storyImages")
+            container_client = BlobServiceClient.from_connection_string(connection_string).get_container_client(container_name)
+        
+        result = []
+        for entry in entries:
+            story = stories.get(entry["id"])
+            if story is None:
+                continue
+            author = {
+                "id": story[5],
+                "firstName": story[6],
+                "lastName": story[7]
+            }
+            category_list = story_categories.get(story[0], [])
             
-            query = f"SELECT TOP {limit} " + query.split("SELECT ")[1]
+            if recommended:
+                story_obj = {
+                    "id": story[0],
+                    "title": story[1],
+                    "storyUrl": story[2],
+                    "duration": format_time(story[3]),
+                    "created": format_date(story[4]),
+                    "author": author,
+                    "categories": category_list,
+                    "isRecommended": True
+                }
+            else:
+                story_obj = {
+                    "id": story[0],
+                    "title": story[1],
+                    "storyUrl": story[2],
+                    "thumbnailUrl": container_client.get_blob_client(f"{story[0]}/1.png").url,
+                    "duration": format_time(story[3]),
+                    "lastListenTime": entry.get("lastListenTime"),
+                    "listenedDuration": entry.get("listenedDuration"),
+                    "author": author,
+                    "categories": category_list
+                }
             
-            cursor.execute(query, user_id)
+            result.append(story_obj)
         
-        stories = cursor.fetchall()
+        return result
+    
+    except Exception as e:
+        logging.error(f"Error in get_feed_story_cards: {str(e)}")
+        return []
+
+def get_recommended_stories(cursor, user_id, limit=2):
+    """Fallback method to get recommended stories when no recently listened stories exist.
+    Uses the item-item collaborative filtering model when it has something for the user,
+    otherwise the user's preferred categories."""
+    try:
+        stories = []
+        try:
+            # Ask for spare candidates in case some stories have since been deactivated.
+            cf_story_ids = recommend_story_ids(cursor, user_id, limit * 2)
+        except Exception as e:
+            logging.warning(f"Collaborative filtering unavailable, using category recommendations: {str(e)}")
+            cf_story_ids = []
         
-        result = []
-        for story in stories:
+        if cf_story_ids:
+            placeholders = ','.join(['?' for _ in cf_story_ids])
+            cursor.execute(f"""
+                SELECT 
+                    s.id, 
+                    s.title,
+                    s.story_url,
+                    s.duration,
+                    s.created,
+                    u.id AS user_id,
+                    u.firstName,
+                    u.lastName
+                FROM 
+                    story s
+                JOIN 
+                    "user" u ON s.user_id = u.id
+                WHERE 
+                    s.status = 1
+                    AND s.id IN ({placeholders})
+            """, cf_story_ids)
+            rank = {story_id: i for i, story_id in enumerate(cf_story_ids)}
+            stories = sorted(cursor.fetchall(), key=lambda story: rank[story[0]])[:limit]
+        
+        if not stories:
             cursor.execute("""
+                SELECT category_id 
+                FROM user_preferred_categories 
+                WHERE user_id = ? AND status = 1
+            """, user_id)
+        
+            preferred_categories = cursor.fetchall()
+        
+            if preferred_categories:
+                placeholders = ','.join(['?' for _ in preferred_categories])
+                category_ids = [cat[0] for cat in preferred_categories]
+            
+                query = f"""
                 SELECT 
-                    c.id, c.name, c.description, c.icon
+                    s.id, 
+                    s.title,
+                    s.story_url,
+                    s.duration,
+                    s.created,
+                    u.id AS user_id,
+                    u.firstName,
+                    u.lastName
                 FROM 
-                    category c
+                    story s
+                JOIN 
+                    "user" u ON s.user_id = u.id
                 JOIN 
-                    story_has_categories shc ON c.id = shc.category_id
+                    story_has_categories shc ON s.id = shc.story_id
                 WHERE 
-                    shc.story_id = ? AND c.status = 1
-            """, story[0])
+                    s.status = 1
+                    AND shc.category_id IN ({placeholders})
+                    AND s.id NOT IN (
+                        SELECT story_id FROM user_has_listen_stories WHERE user_id = ?
+                    )
+                ORDER BY 
+                    s.created DESC
+                """
             
-            categories = cursor.fetchall()
-            category_list = []
+                query = f"SELECT TOP {limit} " + query.split("SELECT ")[1]
             
-            for category in categories:
-                category_list.append({
-                    "id": category[0],
-                    "name": category[1],
-                    "description": category[2],
-                    "icon": category[3]
-                })
+                params = category_ids + [user_id]
+                cursor.execute(query, params)
+            else:
+                query = """
+                SELECT 
+                    s.id, 
+                    s.title,
+                    s.story_url,
+                    s.duration,
+                    s.created,
+                    u.id AS user_id,
+                    u.firstName,
+                    u.lastName
+                FROM 
+                    story s
+                JOIN 
+                    "user" u ON s.user_id = u.id
+                WHERE 
+                    s.status = 1
+                    AND s.id NOT IN (
+                        SELECT story_id FROM user_has_listen_stories WHERE user_id = ?
+                    )
+                ORDER BY 
+                    s.listen_count DESC
+                """
+            
+                query = f"SELECT TOP {limit} " + query.split("SELECT ")[1]
+            
+                cursor.execute(query, user_id)
+        
+            stories = cursor.fetchall()
+        
+        story_categories = categories_for_stories(cursor, [story[0] for story in stories])
+        
+        result = []
+        for story in stories:
+            category_list = story_categories.get(story[0], [])
             
             story_obj = {
                 "id": story[0],
@@ -514,9 +614,7 @@ def get_recommended_stories(cursor, user_id, limit=2):
         return []
 
 def get_trending_categories(cursor, limit=4):
-    """Retrieve trending categories based on recent listens and likes within the past 21 days."""
-    cutoff_date = datetime.now() - timedelta(days=21)
-
+    """Retrieve trending categories from the recent listens and likes rolled up in category_stats."""
     try:
         base_query = """
             SELECT 
@@ -524,37 +622,25 @@ def get_trending_categories(cursor, limit=4):
                 c.name,
                 c.description,
                 c.icon,
-                COUNT(DISTINCT uhls.id) * 2 AS listen_score,
-                COUNT(DISTINCT shl.id) * 4 AS like_score,
-                COUNT(DISTINCT s.id) AS story_count,
-                (COUNT(DISTINCT uhls.id) * 2 + COUNT(DISTINCT shl.id) * 4) AS total_score
+                cs.recent_listens * 2 AS listen_score,
+                cs.recent_likes * 4 AS like_score,
+                cs.story_count,
+                (cs.recent_listens * 2 + cs.recent_likes * 4) AS total_score
             FROM 
                 category c
             JOIN 
-                story_has_categories shc ON c.id = shc.category_id
-            JOIN 
-                story s ON shc.story_id = s.id
-            LEFT JOIN 
-                user_has_listen_stories uhls ON s.id = uhls.story_id 
-                AND uhls.listen_time > ?
-            LEFT JOIN 
-                story_has_likes shl ON s.id = shl.story_id 
-                AND shl.updated > ?
-                AND shl.status = 1
+                category_stats cs ON c.id = cs.category_id
             WHERE 
                 c.status = 1
-                AND s.status = 1
-            GROUP BY 
-                c.id, c.name, c.description, c.icon
-            HAVING
-                (COUNT(DISTINCT uhls.id) * 2 + COUNT(DISTINCT shl.id) * 4) > 0
+                AND cs.story_count > 0
+                AND (cs.recent_listens * 2 + cs.recent_likes * 4) > 0
             ORDER BY 
                 total_score DESC
         """
         
         query = f"SELECT TOP {limit} " + base_query.split("SELECT ")[1]
 
-        cursor.execute(query, cutoff_date, cutoff_date)
+        cursor.execute(query)
         categories = cursor.fetchall()
         column_names = [column[0] for column in cursor.description]
 
@@ -599,20 +685,16 @@ def get_most_popular_categories(cursor, limit=4):
                 c.name,
                 c.description,
                 c.icon,
-                COUNT(DISTINCT shc.story_id) AS story_count
+                cs.story_count
             FROM 
                 category c
             JOIN 
-                story_has_categories shc ON c.id = shc.category_id
-            JOIN 
-                story s ON shc.story_id = s.id
+                category_stats cs ON c.id = cs.category_id
             WHERE 
                 c.status = 1
-                AND s.status = 1
-            GROUP BY 
-                c.id, c.name, c.description, c.icon
+                AND cs.story_count > 0
             ORDER BY 
-                story_count DESC
+                cs.story_count DESC
         """
         
         query = f"SELECT TOP {limit} " + base_query.split("SELECT ")[1]
@@ -649,22 +731,8 @@ def get_most_popular_categories(cursor, limit=4):
         story_counts = {}
 
         for category in categories:
-            cat_id = category[0]
-            if len(category) > 4 and category[4] is not None:
-                story_counts[cat_id] = int(category[4])
-            else:
-                cursor.execute("""
-                    SELECT COUNT(DISTINCT s.id)
-                    FROM 
-                        story s
-                    JOIN 
-                        story_has_categories shc ON s.id = shc.story_id
-                    WHERE 
-                        shc.category_id = ?
-                        AND s.status = 1
-                """, cat_id)
-                count_result = cursor.fetchone()
-                story_counts[cat_id] = count_result[0] if count_result else 0
+            # The name-ordered fallback has no count column: those categories have no active stories.
+            story_counts[category[0]] = int(category[4]) if len(category) > 4 and category[4] is not None else 0
 
         for category in categories:
             category_dict = {}
@@ -10,12 +10,31 @@ import logging
 import json
 import pyodbc
 import os
-from azure.storage.blob import BlobServiceClient, ContentSettings
-from openai import OpenAI
-import requests
+import time
+from azure.storage.blob import BlobServiceClient
+from pipeline_backfill import (
+    MAX_VISIBILITY_SECONDS, select_backfill_stories, create_backfill_run, enqueue_backfill, send_backfill_message,
+    start_backfill_item, finish_backfill_item, add_backfill_item_cost, backfill_report
+)
+from pipeline_async import run_story
+from pipeline_batch import finished_batch_results, finish_batch_request, submit_pending_requests
+from pipeline_stages import (
+    DEFERRED, LLM_MODE, openai_client, run_story_pipeline, apply_deferred_analysis, stages_for_mode
+)
+from provider_limits import HIGH, LOW, PRICES, estimate_cost, new_usage
+from result_cache import evict_result_cache
 
 bp_process_pipeline = func.Blueprint()
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# "threaded" runs each story on its own worker thread (pipeline_stages);
+# "async" runs them all on one event loop (pipeline_async). Deferred backfills
+# always use the threaded pipeline.
+PIPELINE_ENGINE = os.environ.get("PipelineEngine", "threaded")
+
+def _run_pipeline(story_id, deferred=None, **options):
+    if PIPELINE_ENGINE == "async" and deferred is None:
+        return run_story(story_id, **options)
+    return run_story_pipeline(story_id, deferred=deferred, **options)
 
 @bp_process_pipeline.queue_trigger(
     arg_name="msg", 
@@ -27,567 +46,275 @@ def process_story_from_queue(msg: func.QueueMessage) -> None:
     """
     This function is triggered when a message is added to the story-processing-queue.
     It processes the story using OpenAI to create the enhanced audio and images.
+    Failures are re-raised so the message is retried; a retry resumes from the
+    last checkpointed stage. Send {"story_id": 123, "force": true} to reprocess
+    a story from scratch.
     """
+    message_body = msg.get_body().decode('utf-8')
+    message_json = json.loads(message_body)
+    story_id = message_json.get('story_id')
+    
+    if not story_id:
+        logging.error("No story_id found in queue message")
+        return
+    
+    logging.info(f"Processing story {story_id} from queue (delivery {msg.dequeue_count})")
+    
     try:
-        message_body = msg.get_body().decode('utf-8')
-        message_json = json.loads(message_body)
-        story_id = message_json.get('story_id')
-        
-        if not story_id:
-            logging.error("No story_id found in queue message")
-            return
-        
-        logging.info(f"Processing story {story_id} from queue")
-        
-        conn = pyodbc.connect(os.environ['SqlConnectionString'])
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT story_url, title FROM story WHERE id = ?', story_id)
-        story_data = cursor.fetchone()
-        if not story_data:
-            logging.error(f"Story {story_id} not found in database")
-            return
-
-        story_url = story_data[0]
-        story_title = story_data[1]
+        _run_pipeline(story_id, force=bool(message_json.get('force')), lane=HIGH)
+    except Exception as e:
+        logging.error(f"Exception during story processing from queue: {str(e)}")
+        raise
 
-        blob_service = BlobServiceClient.from_connection_string(os.environ['AzureBlobStorageConnectionString'])
-        container_client = blob_service.get_container_client(os.environ['AudioStorageContainerName'])
-        
-        blob_name = story_url.split('/')[-1]
-        blob_path = '/'.join(story_url.split('/')[-3:]) 
-        audio_path = f"/tmp/{blob_name}"
-        
-        blob_client = container_client.get_blob_client(blob_path)
-        with open(audio_path, "wb") as f:
-            f.write(blob_client.download_blob().readall())
+@bp_process_pipeline.queue_trigger(
+    arg_name="msg", 
+    queue_name="story-backfill-queue",
+    connection="AzureQueueStorageConnectionString"
+)
 
-        logging.info(f"Transcribing audio for story {story_id}")
-        with open(audio_path, "rb") as f:
-            transcription = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f
-            )
-        transcript_text = transcription.text.strip()
-        
-        if not transcript_text:
-            logging.error(f"Failed to transcribe audio for story {story_id}")
-            return
-        
-        # Step 2: Analyze sentiment
-        logging.info(f"Analyzing sentiment for story {story_id}")
-        sentiment_response = openai_client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "Classify the emotional tone of a story. Answer only with one word: Positive, Negative, or Neutral."},
-                {"role": "user", "content": transcript_text}
-            ],
-            max_tokens=10
-        )
-        sentiment = sentiment_response.choices[0].message.content.strip()
-        
-        # Step 3: Create enhanced script based on sentiment
-        logging.info(f"Creating enhanced script for story {story_id} with sentiment: {sentiment}")
-        script_response = openai_client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": f"Rewrite the story to strongly highlight {sentiment} emotions while keeping the core narrative intact. Make it vivid, expressive, and easy to narrate aloud. Keep the story length similar to the original."},
-                {"role": "user", "content": transcript_text}
-            ],
-            max_tokens=1500
-        )
-        enhanced_script = script_response.choices[0].message.content.strip()
-        
-        # Step 4: Generate audio from enhanced script
-        logging.info(f"Generating TTS audio for story {story_id}")
-        tts_response = openai_client.audio.speech.create(
-            model="tts-1",
-            voice="nova",
-            input=enhanced_script
-        )
-        generated_audio = tts_response.content
-        
-        gen_audio_blob_name = f"generated/{story_id}_narration.mp3"
-        gen_audio_container = os.environ.get('GeneratedAudioContainerName', os.environ['AudioStorageContainerName'])
-        gen_audio_blob_client = blob_service.get_blob_client(container=gen_audio_container, blob=gen_audio_blob_name)
-        gen_audio_blob_client.upload_blob(generated_audio, overwrite=True, content_settings=ContentSettings(content_type="audio/mpeg"))
-        gen_audio_url = gen_audio_blob_client.url
-        
-        cursor.execute('UPDATE story SET gen_audio_url = ? WHERE id = ?', gen_audio_url, story_id)
-        
-        logging.info(f"Extracting key points for story {story_id}")
-        keypoints_response = openai_client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": """Extract 8-10 key moments from the story with appropriate timestamps. 
-                The script will be narrated, so distribute the timestamps throughout the duration.
-                Format each point as: {timestamp_seconds}|{key_point_description}
-                For example: 30|The protagonist faces their biggest fear
-                Make each key point visually descriptive and meaningful."""},
-                {"role": "user", "content": f"Story title: {story_title}\n\nScript to narrate:\n{enhanced_script}\n\nAssume the narration will take about 3-5 minutes. Distribute timestamps appropriately throughout."}
-            ],
-            max_tokens=600
+def process_story_backfill(msg: func.QueueMessage) -> None:
+    """
+    Same as process_story_from_queue for reprocessing existing stories, in the
+    low-priority lane: backfills get fewer story slots and leave headroom in
+    the provider limits for fresh uploads. Messages sent by a backfill run
+    carry its run_id and the stages to re-run (none means everything), and
+    the run's item for the story is updated with the outcome. With "deferred"
+    the analysis goes through the batch job, which sends a "resume" message
+    for the story once the answer is in.
+    """
+    message_json = json.loads(msg.get_body().decode('utf-8'))
+    story_id = message_json.get('story_id')
+    run_id = message_json.get('run_id')
+    stages = message_json.get('stages')
+    resume = bool(message_json.get('resume'))
+    deferred = bool(message_json.get('deferred'))
+    
+    if not story_id:
+        logging.error("No story_id found in backfill message")
+        return
+    
+    logging.info(f"Backfilling story {story_id} (run {run_id}, delivery {msg.dequeue_count})")
+    
+    if run_id:
+        _update_backfill_item(start_backfill_item, run_id, story_id)
+    usage = new_usage()
+    started = time.monotonic()
+    try:
+        result = _run_pipeline(
+            story_id, force=bool(message_json.get('force')) or (run_id is not None and not stages and not resume), lane=LOW,
+            rerun=None if resume else stages, refresh=bool(message_json.get('refresh')), usage=usage,
+            llm_mode=message_json.get('llm_mode') or ("structured" if deferred else None),
+            deferred={"story_id": story_id, "run_id": run_id, "resume": True, "llm_mode": "structured"} if deferred else None
         )
-        keypoints_text = keypoints_response.choices[0].message.content.strip()
+    except Exception as e:
+        logging.error(f"Exception during story backfill: {str(e)}")
+        if run_id:
+            _update_backfill_item(finish_backfill_item, run_id, story_id, time.monotonic() - started, estimate_cost(usage), str(e))
+        raise
+    if run_id:
+        _update_backfill_item(finish_backfill_item, run_id, story_id, time.monotonic() - started, estimate_cost(usage), None, result == DEFERRED)
 
-        key_points = []
-        for line in keypoints_text.split('\n'):
-            if '|' in line:
-                parts = line.strip().split('|', 1)
-                if len(parts) == 2:
-                    try:
-                        timestamp = int(parts[0].strip())
-                        description = parts[1].strip()
-                        key_points.append((timestamp, description))
-                    except ValueError:
-                        continue
-        
-        if not key_points:
-            logging.warning(f"Failed to parse key points with timestamps, using evenly distributed points")
-            points_response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "Extract exactly 8-10 key moments from the story. Each key point must be visually descriptive (max 15 words)."},
-                    {"role": "user", "content": enhanced_script}
-                ],
-                max_tokens=400
-            )
-            points_list = [p.strip('- 1234567890.').strip() for p in points_response.choices[0].message.content.strip().split('\n') if p.strip()]
-            points_list = [p for p in points_list if p][:10]
-            
-            total_points = len(points_list)
-            interval = 180 / (total_points or 1)
-            key_points = [(int(i * interval), points_list[i]) for i in range(total_points)]
-        
-        logging.info(f"Generating {len(key_points)} images for key points")
-        images_container_client = blob_service.get_container_client(os.environ.get('StoryImagesContainerName', 'storyimages'))
-        
-        cursor.execute('DELETE FROM timeline_color WHERE story_id = ?', story_id)
-        
-        if sentiment.lower() == 'positive':
-            colors = ["#91F5AD", "#A8E6CF", "#DCEDC1", "#FFD3B6", "#FFAAA5", "#FF8B94"]
-        elif sentiment.lower() == 'negative':
-            colors = ["#2C3E50", "#34495E", "#7F8C8D", "#95A5A6", "#BDC3C7", "#ECF0F1"]
-        else:  # neutral
-            colors = ["#F9F9F9", "#E3E3E3", "#CECECE", "#A8A8A8", "#787878", "#5D5D5D"]
-        
-        for idx, (timestamp, point) in enumerate(key_points):
-            try:
-                color = colors[idx % len(colors)]
-                image_prompt = f"Digital illustration for a story: '{point}'. Emotional tone: {sentiment}. Style: colorful, emotional, vivid. Suitable for storytelling. Scene must be visually striking and memorable. No text."
-                image_response = openai_client.images.generate(
-                    model="dall-e-3",
-                    prompt=image_prompt,
-                    n=1,
-                    size="1024x1024"
-                )
-                image_url = image_response.data[0].url
-                
-                image_content = requests.get(image_url).content
-                image_blob_name = f"{story_id}/{idx+1}.png"
-                image_blob_client = images_container_client.get_blob_client(image_blob_name)
-                image_blob_client.upload_blob(image_content, overwrite=True, content_settings=ContentSettings(content_type="image/png"))
-                
-                time_str = f"00:{timestamp//60:02d}:{timestamp%60:02d}"
-                
-                cursor.execute(
-                    'INSERT INTO timeline_color (story_id, time, color) VALUES (?, ?, ?)',
-                    story_id, time_str, color
-                )
-                
-                logging.info(f"Created timeline event at {time_str} with color {color}")
-            except Exception as img_error:
-                logging.error(f"Error processing image {idx+1}: {str(img_error)}")
-        
-        conn.commit()
-        logging.info(f"Successfully processed story {story_id}")
-        
+def _update_backfill_item(update, *args):
+    """Progress bookkeeping must never fail the story itself."""
+    try:
+        conn = pyodbc.connect(os.environ['SqlConnectionString'])
+        try:
+            update(conn.cursor(), *args)
+            conn.commit()
+        finally:
+            conn.close()
     except Exception as e:
-        logging.error(f"Exception during story processing from queue: {str(e)}")
-        if 'conn' in locals() and conn:
-            try:
-                conn.rollback()
-            except:
-                pass
-    finally:
-        if 'conn' in locals() and conn:
-            try:
-                conn.close()
-            except:
-                pass
+        logging.warning(f"Could not update backfill item {args[:2]}: {str(e)}")
 
-@bp_process_pipeline.route(route="story/process/test", methods=["POST"])
-def test_story_processing(req: func.HttpRequest) -> func.HttpResponse:
+@bp_process_pipeline.route(route="story/backfill", methods=["POST"])
+def start_story_backfill(req: func.HttpRequest) -> func.HttpResponse:
     """
-    Test function to directly process a story with OpenAI.
-    Send a POST request with JSON body: {"story_id": 123}
+    Reprocess existing stories in bulk. JSON body (all optional):
+    {"created_from": "2024-01-01", "created_to": "2024-07-01", "category_id": 3,
+     "missing_audio": true, "stages": ["narration"], "rate_per_minute": 20,
+     "limit": 500, "refresh_cache": false, "deferred": false, "dry_run": false}
+    "stages" re-runs those stages and everything after them; leave it out to
+    reprocess stories from scratch. Unchanged model calls are served from the
+    result cache either way unless "refresh_cache" is true. "deferred" sends the text stages through
+    the Batch API (structured mode), for cheaper but slower runs. "dry_run"
+    only counts the matching stories.
     """
     try:
         req_body = req.get_json()
-        story_id = req_body.get('story_id')
-        
-        if not story_id:
+        stages = req_body.get('stages') or None
+        deferred = bool(req_body.get('deferred', False))
+        valid_stages = stages_for_mode("structured" if deferred else LLM_MODE)
+        rate_per_minute = float(req_body.get('rate_per_minute', 10))
+        filters = {
+            "created_from": req_body.get('created_from'),
+            "created_to": req_body.get('created_to'),
+            "category_id": req_body.get('category_id'),
+            "missing_audio": bool(req_body.get('missing_audio', False)),
+            "limit": req_body.get('limit')
+        }
+
+        unknown_stages = [name for name in stages or [] if name not in valid_stages]
+        if unknown_stages or rate_per_minute <= 0:
             return func.HttpResponse(
-                body=json.dumps({"status": False, "message": "Missing story_id in request body"}),
+                body=json.dumps({
+                    "status": False,
+                    "message": f"Unknown stages {unknown_stages}" if unknown_stages else "rate_per_minute must be positive",
+                    "stages": list(valid_stages)
+                }),
                 mimetype="application/json",
                 status_code=400
             )
-        
-        logging.info(f"TEST: Starting manual processing for story {story_id}")
-        
+
         conn = pyodbc.connect(os.environ['SqlConnectionString'])
         cursor = conn.cursor()
+        story_ids = select_backfill_stories(cursor, **filters)
 
-        cursor.execute('SELECT story_url, title FROM story WHERE id = ?', story_id)
-        story_data = cursor.fetchone()
-        if not story_data:
+        spread_seconds = len(story_ids) * 60 / rate_per_minute
+        if req_body.get('dry_run') or not story_ids:
             return func.HttpResponse(
-                body=json.dumps({"status": False, "message": f"Story {story_id} not found in database"}),
+                body=json.dumps({"status": True, "story_count": len(story_ids), "estimated_minutes": round(spread_seconds / 60, 1)}),
                 mimetype="application/json",
-                status_code=404
+                status_code=200
             )
-
-        story_url = story_data[0]
-        story_title = story_data[1]
-        
-        logging.info(f"TEST: Found story: {story_title}, URL: {story_url}")
-
-        blob_service = BlobServiceClient.from_connection_string(os.environ['AzureBlobStorageConnectionString'])
-        container_client = blob_service.get_container_client(os.environ['AudioStorageContainerName'])
-        
-        url_parts = story_url.split('/')
-        blob_name = url_parts[-1]
-        
-        if len(url_parts) >= 3:
-            for i in range(len(url_parts) - 2, 0, -1):
-                if url_parts[i].isdigit() and url_parts[i+1].isdigit():
-                    blob_path = '/'.join(url_parts[i:])
-                    break
-            else:
-                blob_path = blob_name
-        else:
-            blob_path = blob_name
-            
-        logging.info(f"TEST: Using blob path: {blob_path}")
-        
-        audio_path = f"/tmp/{blob_name}"
-        
-        try:
-            blob_client = container_client.get_blob_client(blob_name)
-            with open(audio_path, "wb") as f:
-                f.write(blob_client.download_blob().readall())
-            logging.info(f"TEST: Downloaded audio using simple blob name: {blob_name}")
-        except Exception as e:
-            logging.warning(f"TEST: Failed to download using simple blob name: {str(e)}")
-            try:
-                blob_client = container_client.get_blob_client(blob_path)
-                with open(audio_path, "wb") as f:
-                    f.write(blob_client.download_blob().readall())
-                logging.info(f"TEST: Downloaded audio using full blob path: {blob_path}")
-            except Exception as e2:
-                return func.HttpResponse(
-                    body=json.dumps({
-                        "status": False, 
-                        "message": f"Failed to download audio file: {str(e2)}",
-                        "blob_name": blob_name,
-                        "blob_path": blob_path,
-                        "story_url": story_url
-                    }),
-                    mimetype="application/json",
-                    status_code=500
-                )
-
-        logging.info(f"TEST: Transcribing audio for story {story_id}")
-        try:
-            with open(audio_path, "rb") as f:
-                transcription = openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=f
-                )
-            transcript_text = transcription.text.strip()
-            
-            if not transcript_text:
-                return func.HttpResponse(
-                    body=json.dumps({
-                        "status": False, 
-                        "message": "Failed to transcribe audio: empty result"
-                    }),
-                    mimetype="application/json",
-                    status_code=500
-                )
-                
-            logging.info(f"TEST: Transcription result ({len(transcript_text)} chars): {transcript_text[:100]}...")
-        except Exception as e:
-            return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error during transcription: {str(e)}"
-                }),
-                mimetype="application/json",
-                status_code=500
-            )
-        
-        logging.info(f"TEST: Analyzing sentiment for story {story_id}")
-        try:
-            sentiment_response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "Classify the emotional tone of a story. Answer only with one word: Positive, Negative, or Neutral."},
-                    {"role": "user", "content": transcript_text}
-                ],
-                max_tokens=10
-            )
-            sentiment = sentiment_response.choices[0].message.content.strip()
-            logging.info(f"TEST: Sentiment analysis result: {sentiment}")
-        except Exception as e:
-            return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error during sentiment analysis: {str(e)}"
-                }),
-                mimetype="application/json",
-                status_code=500
-            )
-        
-        logging.info(f"TEST: Creating enhanced script with sentiment: {sentiment}")
-        try:
-            script_response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": f"Rewrite the story to strongly highlight {sentiment} emotions while keeping the core narrative intact. Make it vivid, expressive, and easy to narrate aloud. Keep the story length similar to the original."},
-                    {"role": "user", "content": transcript_text}
-                ],
-                max_tokens=1500
-            )
-            enhanced_script = script_response.choices[0].message.content.strip()
-            logging.info(f"TEST: Enhanced script ({len(enhanced_script)} chars): {enhanced_script[:100]}...")
-        except Exception as e:
+        if spread_seconds > MAX_VISIBILITY_SECONDS:
             return func.HttpResponse(
                 body=json.dumps({
-                    "status": False, 
-                    "message": f"Error creating enhanced script: {str(e)}"
+                    "status": False,
+                    "message": f"{len(story_ids)} stories at {rate_per_minute}/min would take longer than 7 days; raise the rate or narrow the selection"
                 }),
                 mimetype="application/json",
-                status_code=500
-            )
-        
-        logging.info(f"TEST: Generating TTS audio")
-        try:
-            tts_response = openai_client.audio.speech.create(
-                model="tts-1",
-                voice="nova",
-                input=enhanced_script
+                status_code=400
             )
-            generated_audio = tts_response.content
-            logging.info(f"TEST: Generated audio size: {len(generated_audio)} bytes")
-        except Exception as e:
+
+        run_id = create_backfill_run(cursor, story_ids, filters, stages, rate_per_minute)
+        conn.commit()
+        conn.close()
+
+        enqueue_backfill(run_id, story_ids, stages, rate_per_minute, refresh=bool(req_body.get('refresh_cache', False)), deferred=deferred)
+        return func.HttpResponse(
+            body=json.dumps({
+                "status": True,
+                "run_id": run_id,
+                "story_count": len(story_ids),
+                "estimated_minutes": round(spread_seconds / 60, 1)
+            }),
+            mimetype="application/json",
+            status_code=202
+        )
+
+    except Exception as e:
+        logging.error(f"Exception while starting backfill: {str(e)}")
+        return func.HttpResponse(
+            body=json.dumps({"status": False, "message": f"Internal server error: {str(e)}"}),
+            mimetype="application/json",
+            status_code=500
+        )
+    finally:
+        if 'conn' in locals() and conn:
+            try:
+                conn.close()
+            except:
+                pass
+
+@bp_process_pipeline.route(route="story/backfill/{run_id}", methods=["GET"])
+def get_story_backfill(req: func.HttpRequest) -> func.HttpResponse:
+    """Progress of a backfill run: items by status, throughput, estimated cost and recent failures."""
+    try:
+        run_id = int(req.route_params.get('run_id'))
+        conn = pyodbc.connect(os.environ['SqlConnectionString'])
+        cursor = conn.cursor()
+        report = backfill_report(cursor, run_id)
+        if report is None:
             return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error generating TTS audio: {str(e)}"
-                }),
+                body=json.dumps({"status": False, "message": f"Backfill run {run_id} not found"}),
                 mimetype="application/json",
-                status_code=500
+                status_code=404
             )
+        return func.HttpResponse(
+            body=json.dumps({"status": True, "run": report}, default=str),
+            mimetype="application/json",
+            status_code=200
+        )
+    except Exception as e:
+        logging.error(f"Exception while reading backfill run: {str(e)}")
+        return func.HttpResponse(
+            body=json.dumps({"status": False, "message": f"Internal server error: {str(e)}"}),
+            mimetype="application/json",
+            status_code=500
+        )
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+@bp_process_pipeline.route(route="story/process/test", methods=["POST"])
+def test_story_processing(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Process a story synchronously and report how long each stage took.
+    Send a POST request with JSON body: {"story_id": 123}
+    Runs the same pipeline as the queue trigger. Every stage is re-run (the
+    result cache still applies) unless "stages" names only some of them;
+    "refresh_cache": true bypasses the cache as well.
+    """
+    try:
+        req_body = req.get_json()
+        story_id = req_body.get('story_id')
         
-        gen_audio_blob_name = f"generated/{story_id}_narration.mp3"
-        gen_audio_container = os.environ.get('GeneratedAudioContainerName', os.environ['AudioStorageContainerName'])
-        
-        try:
-            gen_audio_blob_client = blob_service.get_blob_client(container=gen_audio_container, blob=gen_audio_blob_name)
-            gen_audio_blob_client.upload_blob(generated_audio, overwrite=True, content_settings=ContentSettings(content_type="audio/mpeg"))
-            gen_audio_url = gen_audio_blob_client.url
-            logging.info(f"TEST: Uploaded generated audio to: {gen_audio_url}")
-        except Exception as e:
+        if not story_id:
             return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error uploading generated audio: {str(e)}"
-                }),
+                body=json.dumps({"status": False, "message": "Missing story_id in request body"}),
                 mimetype="application/json",
-                status_code=500
+                status_code=400
             )
         
-        try:
-            cursor.execute('UPDATE story SET gen_audio_url = ? WHERE id = ?', gen_audio_url, story_id)
-            logging.info(f"TEST: Updated story table with generated audio URL")
-        except Exception as e:
+        stages = req_body.get('stages') or list(stages_for_mode(LLM_MODE))
+        unknown_stages = [name for name in stages if name not in stages_for_mode(LLM_MODE)]
+        if unknown_stages:
             return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error updating story table: {str(e)}"
-                }),
+                body=json.dumps({"status": False, "message": f"Unknown stages {unknown_stages}", "stages": list(stages_for_mode(LLM_MODE))}),
                 mimetype="application/json",
-                status_code=500
+                status_code=400
             )
-        
-        logging.info(f"TEST: Extracting key points")
+
+        logging.info(f"TEST: Starting manual processing for story {story_id}")
+        report = {}
         try:
-            keypoints_response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": """Extract 8-10 key moments from the story with appropriate timestamps. 
-                    The script will be narrated, so distribute the timestamps throughout the duration.
-                    Format each point as: {timestamp_seconds}|{key_point_description}
-                    For example: 30|The protagonist faces their biggest fear
-                    Make each key point visually descriptive and meaningful."""},
-                    {"role": "user", "content": f"Story title: {story_title}\n\nScript to narrate:\n{enhanced_script}\n\nAssume the narration will take about 3-5 minutes. Distribute timestamps appropriately throughout."}
-                ],
-                max_tokens=600
-            )
-            keypoints_text = keypoints_response.choices[0].message.content.strip()
-            logging.info(f"TEST: Keypoints raw result: {keypoints_text}")
+            _run_pipeline(story_id, lane=HIGH, rerun=stages, refresh=bool(req_body.get('refresh_cache', False)), report=report)
         except Exception as e:
+            logging.error(f"TEST: Stage '{report.get('failed_stage')}' failed for story {story_id}: {str(e)}")
             return func.HttpResponse(
                 body=json.dumps({
-                    "status": False, 
-                    "message": f"Error extracting key points: {str(e)}"
+                    "status": False,
+                    "message": f"Error in stage {report.get('failed_stage')}: {str(e)}",
+                    "failed_stage": report.get('failed_stage')
                 }),
                 mimetype="application/json",
                 status_code=500
             )
-        
-        key_points = []
-        for line in keypoints_text.split('\n'):
-            if '|' in line:
-                parts = line.strip().split('|', 1)
-                if len(parts) == 2:
-                    try:
-                        timestamp = int(parts[0].strip())
-                        description = parts[1].strip()
-                        key_points.append((timestamp, description))
-                    except ValueError:
-                        continue
-        
-        if not key_points:
-            logging.warning(f"TEST: Failed to parse key points, using evenly distributed points")
-            try:
-                points_response = openai_client.chat.completions.create(
-                    model="gpt-4-turbo",
-                    messages=[
-                        {"role": "system", "content": "Extract exactly 8-10 key moments from the story. Each key point must be visually descriptive (max 15 words)."},
-                        {"role": "user", "content": enhanced_script}
-                    ],
-                    max_tokens=400
-                )
-                points_list = [p.strip('- 1234567890.').strip() for p in points_response.choices[0].message.content.strip().split('\n') if p.strip()]
-                points_list = [p for p in points_list if p][:10]
-                
-                total_points = len(points_list)
-                interval = 180 / (total_points or 1)
-                key_points = [(int(i * interval), points_list[i]) for i in range(total_points)]
-                logging.info(f"TEST: Created {len(key_points)} evenly distributed key points")
-            except Exception as e:
-                return func.HttpResponse(
-                    body=json.dumps({
-                        "status": False, 
-                        "message": f"Error creating fallback key points: {str(e)}"
-                    }),
-                    mimetype="application/json",
-                    status_code=500
-                )
-        
-        logging.info(f"TEST: Generating {len(key_points)} images for key points")
-        images_container_name = os.environ.get('StoryImagesContainerName', 'storyimages')
-        try:
-            images_container_client = blob_service.get_container_client(images_container_name)
-            logging.info(f"TEST: Using image container: {images_container_name}")
-        except Exception as e:
+
+        if report.get('status') == "not_found":
             return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error accessing image container: {str(e)}"
-                }),
+                body=json.dumps({"status": False, "message": f"Story {story_id} not found in database"}),
                 mimetype="application/json",
-                status_code=500
+                status_code=404
             )
-        
-        try:
-            cursor.execute('DELETE FROM story_timeline_events WHERE story_id = ?', story_id)
-            logging.info(f"TEST: Cleared existing timeline entries")
-        except Exception as e:
+        if report.get('status') == "busy":
             return func.HttpResponse(
-                body=json.dumps({
-                    "status": False, 
-                    "message": f"Error clearing timeline entries: {str(e)}"
-                }),
+                body=json.dumps({"status": False, "message": f"Story {story_id} is already being processed"}),
                 mimetype="application/json",
-                status_code=500
+                status_code=409
             )
-        
-        if sentiment.lower() == 'positive':
-            colors = ["#91F5AD", "#A8E6CF", "#DCEDC1", "#FFD3B6", "#FFAAA5", "#FF8B94"]
-        elif sentiment.lower() == 'negative':
-            colors = ["#2C3E50", "#34495E", "#7F8C8D", "#95A5A6", "#BDC3C7", "#ECF0F1"]
-        else:  # neutral
-            colors = ["#F9F9F9", "#E3E3E3", "#CECECE", "#A8A8A8", "#787878", "#5D5D5D"]
-        
-        # test_limit = min(2, len(key_points))
-        # key_points = key_points[:test_limit]
-        # logging.info(f"TEST: Limited to {test_limit} keypoints for testing")
-        
-        timeline_events = []
-        success_count = 0
-        
-        for idx, (timestamp, point) in enumerate(key_points):
-            try:
-                color = colors[idx % len(colors)]
-                logging.info(f"TEST: Processing keypoint {idx+1}: {point} at {timestamp}s with color {color}")
 
-                image_prompt = f"Digital illustration for a story: '{point}'. Emotional tone: {sentiment}. Style: colorful, emotional, vivid. Suitable for storytelling. Scene must be visually striking and memorable. No text."
-                
-                logging.info(f"TEST: Generating image with prompt: {image_prompt}")
-                image_response = openai_client.images.generate(
-                    model="dall-e-3",
-                    prompt=image_prompt,
-                    n=1,
-                    size="1024x1024"
-                )
-                image_url = image_response.data[0].url
-                logging.info(f"TEST: Image generated: {image_url}")
-                
-                image_content = requests.get(image_url).content
-                image_blob_name = f"{story_id}/{idx+1}.png"
-                image_blob_client = images_container_client.get_blob_client(image_blob_name)
-                image_blob_client.upload_blob(image_content, overwrite=True, content_settings=ContentSettings(content_type="image/png"))
-                image_blob_url = image_blob_client.url
-                logging.info(f"TEST: Uploaded image to blob: {image_blob_name}")
-                
-                time_str = f"00:{timestamp//60:02d}:{timestamp%60:02d}"
-                
-                cursor.execute('''
-                    INSERT INTO story_timeline_events 
-                    (story_id, time, color, image_url) 
-                    VALUES (?, ?, ?, ?)
-                ''', story_id, time_str, color, image_blob_url)
-                
-                timeline_events.append({
-                    "time": time_str,
-                    "color": color,
-                    "image_url": image_blob_url
-                })
-                success_count += 1
-                logging.info(f"TEST: Created timeline event at {time_str} with color {color}")
-                
-            except Exception as img_error:
-                logging.error(f"TEST: Error processing image {idx+1}: {str(img_error)}")
-                return func.HttpResponse(
-                    body=json.dumps({
-                        "status": False, 
-                        "message": f"Error processing image {idx+1}: {str(img_error)}",
-                        "processed_so_far": success_count
-                    }),
-                    mimetype="application/json",
-                    status_code=500
-                )
-        
-        conn.commit()
         logging.info(f"TEST: Successfully processed story {story_id}")
-        
         return func.HttpResponse(
             body=json.dumps({
                 "status": True,
                 "message": "Story processed successfully",
+                "story_id": story_id,
+                "stages": report.get('timings'),
+                "critical_path": report.get('critical_path'),
+                "usage": report.get('usage'),
+                "estimated_cost_usd": estimate_cost(report['usage']) if report.get('usage') else None,
+                "outputs": report.get('outputs')
             }, default=str),
             mimetype="application/json",
             status_code=200
@@ -603,9 +330,49 @@ def test_story_processing(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json",
             status_code=500
         )
+
+@bp_process_pipeline.timer_trigger(schedule="0 30 4 * * *", arg_name="timer", run_on_startup=False)
+def evict_result_cache_job(timer: func.TimerRequest) -> None:
+    try:
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        cursor = conn.cursor()
+        blob_service = BlobServiceClient.from_connection_string(os.environ['AzureBlobStorageConnectionString'])
+        evict_result_cache(cursor, blob_service)
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Exception while evicting result cache: {str(e)}")
     finally:
-        if 'conn' in locals() and conn:
-            try:
-                conn.close()
-            except:
-                pass
\ No newline at end of file
+        if 'conn' in locals():
+            conn.close()
+
+@bp_process_pipeline.timer_trigger(schedule="0 */5 * * * *", arg_name="timer", run_on_startup=False)
+def process_deferred_batches_job(timer: func.TimerRequest) -> None:
+    """
+    Check the submitted batches: each finished story's analysis is
+    checkpointed and the story goes back on the backfill queue to finish.
+    Then the requests queued since the last run are submitted as a new batch.
+    """
+    try:
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        cursor = conn.cursor()
+        blob_service = BlobServiceClient.from_connection_string(os.environ['AzureBlobStorageConnectionString'])
+
+        for row_id, story_id, resume_message, content, error, tokens in list(finished_batch_results(cursor, openai_client)):
+            applied = apply_deferred_analysis(blob_service, story_id, content)
+            if applied is None:
+                logging.info(f"Story {story_id} is busy, its batch answer is applied on the next run")
+                continue
+            send_backfill_message(resume_message)
+            finish_batch_request(cursor, row_id, error or (None if applied else "invalid analysis"))
+            if resume_message.get("run_id") and tokens:
+                batch_cost = tokens / 1000 * PRICES["chat_per_1k_tokens"] * PRICES["batch_discount"]
+                add_backfill_item_cost(cursor, resume_message["run_id"], story_id, batch_cost)
+            conn.commit()
+
+        submit_pending_requests(cursor, openai_client)
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Exception while processing deferred batches: {str(e)}")
+    finally:
+        if 'conn' in locals():
+            conn.close()
@@ -0,0 +1,357 @@
+# Register this blueprint by adding the following line of code
+# to your entry point file.
+# app.register_functions(bp_recommender)
+#
+# Please refer to https://aka.ms/azure-functions-python-blueprints
+
+
+import azure.functions as func
+import logging
+import io
+import os
+import time
+import pyodbc
+import numpy as np
+import scipy.sparse as sp
+from datetime import datetime
+from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from home_feed import invalidate_recommended_sections
+
+bp_recommender = func.Blueprint()
+
+LISTEN_WEIGHT = 1.0
+LIKE_WEIGHT = 3.0
+TOP_K = int(os.environ.get("RecommenderTopK", "50"))
+MODEL_BLOB_NAME = "item_similarities.npz"
+INTERACTIONS_BLOB_NAME = "interactions.npz"
+RELOAD_INTERVAL_SECONDS = 300
+
+_model_cache = {"model": None, "etag": None, "checked": 0.0}
+
+def _container_client():
+    blob_service = BlobServiceClient.from_connection_string(os.environ["AzureBlobStorageConnectionString"])
+    return blob_service.get_container_client(os.environ.get("RecommenderContainerName", "recommender"))
+
+def listen_weight(listens):
+    """Repeat listens count, but with diminishing returns."""
+    return LISTEN_WEIGHT * np.log1p(listens)
+
+def load_interactions(cursor, since=None):
+    """Return (user_ids, story_ids, weights) for listens and active likes, optionally only newer than `since`."""
+    listen_query = 'SELECT user_id, story_id, COUNT(*) FROM user_has_listen_stories'
+    like_query = 'SELECT user_id, story_id FROM story_has_likes WHERE status = 1'
+    listen_params = []
+    like_params = []
+    if since is not None:
+        listen_query += ' WHERE listen_time > ?'
+        like_query += ' AND updated > ?'
+        listen_params.append(since)
+        like_params.append(since)
+    listen_query += ' GROUP BY user_id, story_id'
+
+    users, stories, weights = [], [], []
+
+    cursor.execute(listen_query, listen_params)
+    for row in cursor.fetchall():
+        users.append(row[0])
+        stories.append(row[1])
+        weights.append(listen_weight(row[2]))
+
+    cursor.execute(like_query, like_params)
+    for row in cursor.fetchall():
+        users.append(row[0])
+        stories.append(row[1])
+        weights.append(LIKE_WEIGHT)
+
+    return (np.asarray(users, dtype=np.int64),
+            np.asarray(stories, dtype=np.int64),
+            np.asarray(weights, dtype=np.float32))
+
+def build_interaction_matrix(user_ids, story_ids, weights, user_index=None, story_index=None):
+    """Build a sparse user x story CSR matrix; `*_index` are the sorted id arrays mapping ids to rows/columns."""
+    if user_index is None:
+        user_index = np.unique(user_ids)
+    if story_index is None:
+        story_index = np.unique(story_ids)
+    rows = np.searchsorted(user_index, user_ids)
+    cols = np.searchsorted(story_index, story_ids)
+    matrix = sp.csr_matrix((weights, (rows, cols)), shape=(len(user_index), len(story_index)), dtype=np.float32)
+    matrix.sum_duplicates()
+    return matrix, user_index, story_index
+
+def _merge_index(index, ids):
+    return np.union1d(index, np.unique(ids))
+
+def _reindex(matrix, old_users, old_stories, new_users, new_stories):
+    coo = matrix.tocoo()
+    rows = np.searchsorted(new_users, old_users[coo.row])
+    cols = np.searchsorted(new_stories, old_stories[coo.col])
+    return sp.csr_matrix((coo.data, (rows, cols)), shape=(len(new_users), len(new_stories)), dtype=np.float32)
+
+def _top_k_rows(sim, top_k):
+    """Keep the top_k largest entries of every row of a CSR matrix."""
+    sim = sim.tocsr()
+    sim.setdiag(0)
+    sim.eliminate_zeros()
+    indptr = [0]
+    indices = []
+    data = []
+    for i in range(sim.shape[0]):
+        start, end = sim.indptr[i], sim.indptr[i + 1]
+        row_data = sim.data[start:end]
+        row_indices = sim.indices[start:end]
+        if len(row_data) > top_k:
+            keep = np.argpartition(-row_data, top_k)[:top_k]
+            row_data = row_data[keep]
+            row_indices = row_indices[keep]
+        order = np.argsort(-row_data)
+        indices.append(row_indices[order])
+        data.append(row_data[order])
+        indptr.append(indptr[-1] + len(order))
+    return sp.csr_matrix(
+        (np.concatenate(data) if data else np.zeros(0, np.float32),
+         np.concatenate(indices) if indices else np.zeros(0, np.int32),
+         np.asarray(indptr)),
+        shape=sim.shape, dtype=np.float32)
+
+def _column_norms(matrix):
+    return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel()).astype(np.float32)
+
+def _normalized(matrix, norms):
+    """The matrix with every item column scaled to unit length (empty columns stay zero)."""
+    inv = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return (matrix @ sp.diags(inv)).tocsc()
+
+def _cosine_columns(matrix, columns, norms):
+    """Cosine similarity of every item against the given item columns, as a (n_items x len(columns)) matrix."""
+    normalized = _normalized(matrix, norms)
+    return (normalized.T @ normalized[:, columns]).tocsc()
+
+def compute_item_similarities(matrix, top_k=TOP_K):
+    """Cosine item-item similarities, truncated to the top_k neighbours per item."""
+    normalized = _normalized(matrix, _column_norms(matrix))
+    sim = (normalized.T @ normalized).tocsr()
+    return _top_k_rows(sim, top_k)
+
+def update_item_similarities(similarities, matrix, touched, top_k=TOP_K):
+    """
+    Refresh similarities after interactions on the `touched` item columns changed.
+    Similarity only changes in rows/columns of touched items, so those are recomputed
+    exactly; other rows merge the new values for touched columns into their existing
+    top-k list. Entries that previously fell just outside an untouched row's top-k are
+    not recovered, which is why the nightly full rebuild still runs.
+    """
+    touched = np.unique(touched)
+    if len(touched) == 0:
+        return similarities
+    n_items = matrix.shape[1]
+    norms = _column_norms(matrix)
+    fresh = _cosine_columns(matrix, touched, norms).tocsr()  # n_items x len(touched)
+
+    touched_mask = np.zeros(n_items, dtype=bool)
+    touched_mask[touched] = True
+
+    old = similarities.tocoo()
+    keep = ~touched_mask[old.row] & ~touched_mask[old.col]
+    fresh_coo = fresh.tocoo()
+    fresh_cols = touched[fresh_coo.col]
+
+    rows = np.concatenate([old.row[keep], fresh_coo.row, fresh_cols])
+    cols = np.concatenate([old.col[keep], fresh_cols, fresh_coo.row])
+    data = np.concatenate([old.data[keep], fresh_coo.data, fresh_coo.data])
+    merged = sp.coo_matrix((data, (rows, cols)), shape=(n_items, n_items)).tocsr()
+    merged.sum_duplicates()
+    # Pairs of two touched items were added from both sides above, so they are doubled.
+    merged_coo = merged.tocoo()
+    both = touched_mask[merged_coo.row] & touched_mask[merged_coo.col]
+    merged_coo.data[both] /= 2
+    return _top_k_rows(merged_coo.tocsr(), top_k)
+
+def save_model(container_client, similarities, story_index):
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        story_ids=story_index,
+        indptr=similarities.indptr.astype(np.int32),
+        indices=similarities.indices.astype(np.int32),
+        data=similarities.data.astype(np.float16)
+    )
+    container_client.get_blob_client(MODEL_BLOB_NAME).upload_blob(buffer.getvalue(), overwrite=True)
+
+def save_interactions(container_client, matrix, user_index, story_index, watermark):
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        user_ids=user_index,
+        story_ids=story_index,
+        indptr=matrix.indptr,
+        indices=matrix.indices,
+        data=matrix.data,
+        watermark=np.asarray(watermark.isoformat())
+    )
+    container_client.get_blob_client(INTERACTIONS_BLOB_NAME).upload_blob(buffer.getvalue(), overwrite=True)
+
+def load_saved_interactions(container_client):
+    try:
+        data = container_client.get_blob_client(INTERACTIONS_BLOB_NAME).download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+    arrays = np.load(io.BytesIO(data))
+    user_index = arrays["user_ids"]
+    story_index = arrays["story_ids"]
+    matrix = sp.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                           shape=(len(user_index), len(story_index)))
+    watermark = datetime.fromisoformat(str(arrays["watermark"]))
+    return matrix, user_index, story_index, watermark
+
+def rebuild_recommender(cursor, container_client):
+    """Train the model from all interactions; returns whether a model was saved."""
+    started = datetime.now()
+    users, stories, weights = load_interactions(cursor)
+    if len(users) == 0:
+        logging.info("No interactions yet, skipping recommender build")
+        return False
+    matrix, user_index, story_index = build_interaction_matrix(users, stories, weights)
+    similarities = compute_item_similarities(matrix)
+    save_interactions(container_client, matrix, user_index, story_index, started)
+    save_model(container_client, similarities, story_index)
+    logging.info(f"Rebuilt recommender: {matrix.nnz} interactions, {len(story_index)} stories, {similarities.nnz} similarities")
+    return True
+
+def refresh_recommender(cursor, container_client):
+    """Fold the interactions since the last run into the model; returns whether it changed."""
+    saved = load_saved_interactions(container_client)
+    if saved is None:
+        return rebuild_recommender(cursor, container_client)
+
+    matrix, user_index, story_index, watermark = saved
+    started = datetime.now()
+    users, stories, weights = load_interactions(cursor, since=watermark)
+    if len(users) == 0:
+        logging.info("No new interactions since last recommender refresh")
+        return False
+
+    new_users = _merge_index(user_index, users)
+    new_stories = _merge_index(story_index, stories)
+    matrix = _reindex(matrix, user_index, story_index, new_users, new_stories)
+    delta, _, _ = build_interaction_matrix(users, stories, weights, new_users, new_stories)
+    # Listen weights are log-scaled per batch; taking the max keeps repeated
+    # refreshes from inflating a pair beyond what a full rebuild would give.
+    matrix = matrix.maximum(delta).tocsr()
+
+    model = load_model(force=True)
+    if model is None:
+        similarities = compute_item_similarities(matrix)
+    else:
+        old_similarities = _reindex(model["similarities"], model["story_ids"], model["story_ids"], new_stories, new_stories)
+        touched = np.searchsorted(new_stories, np.unique(stories))
+        similarities = update_item_similarities(old_similarities, matrix, touched)
+
+    save_interactions(container_client, matrix, new_users, new_stories, started)
+    save_model(container_client, similarities, new_stories)
+    logging.info(f"Refreshed recommender with {len(users)} new interactions")
+    return True
+
+def load_model(force=False):
+    """Item-item model for serving, cached per instance and reloaded when the blob's ETag changes."""
+    now = time.monotonic()
+    if not force and _model_cache["model"] is not None and now - _model_cache["checked"] < RELOAD_INTERVAL_SECONDS:
+        return _model_cache["model"]
+    _model_cache["checked"] = now
+    try:
+        blob_client = _container_client().get_blob_client(MODEL_BLOB_NAME)
+        etag = blob_client.get_blob_properties().etag
+        if etag == _model_cache["etag"] and _model_cache["model"] is not None:
+            return _model_cache["model"]
+        arrays = np.load(io.BytesIO(blob_client.download_blob().readall()))
+    except ResourceNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Failed to load recommender model: {str(e)}")
+        return _model_cache["model"]
+
+    story_ids = arrays["story_ids"]
+    similarities = sp.csr_matrix(
+        (arrays["data"].astype(np.float32), arrays["indices"], arrays["indptr"]),
+        shape=(len(story_ids), len(story_ids)))
+    _model_cache["model"] = {"story_ids": story_ids, "similarities": similarities}
+    _model_cache["etag"] = etag
+    return _model_cache["model"]
+
+def score_candidates(model, history_story_ids, history_weights, limit, exclude_story_ids=()):
+    """Score every story by similarity to the user's history and return the best `limit` story ids."""
+    story_ids = model["story_ids"]
+    positions = np.searchsorted(story_ids, history_story_ids)
+    positions = np.clip(positions, 0, max(len(story_ids) - 1, 0))
+    known = story_ids[positions] == history_story_ids if len(story_ids) else np.zeros(0, bool)
+    if not np.any(known):
+        return []
+
+    profile = sp.csr_matrix(
+        (np.asarray(history_weights, dtype=np.float32)[known], (np.zeros(known.sum(), dtype=np.int32), positions[known])),
+        shape=(1, len(story_ids)))
+    scores = np.asarray((profile @ model["similarities"]).todense()).ravel()
+
+    excluded = np.isin(story_ids, np.asarray(list(exclude_story_ids), dtype=story_ids.dtype))
+    scores[excluded] = 0
+    scores[positions[known]] = 0
+
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > limit:
+        candidates = candidates[np.argpartition(-scores[candidates], limit)[:limit]]
+    candidates = candidates[np.argsort(-scores[candidates])]
+    return [int(story_ids[i]) for i in candidates]
+
+def recommend_story_ids(cursor, user_id, limit):
+    """Collaborative-filtering recommendations for a user, or [] when the model can't help."""
+    model = load_model()
+    if model is None:
+        return []
+
+    # Weighted the same way as the training interactions (load_interactions).
+    cursor.execute("""
+        SELECT story_id, SUM(listens), SUM(likes) FROM (
+            SELECT story_id, COUNT(*) AS listens, 0 AS likes FROM user_has_listen_stories WHERE user_id = ? GROUP BY story_id
+            UNION ALL
+            SELECT story_id, 0 AS listens, 1 AS likes FROM story_has_likes WHERE user_id = ? AND status = 1
+        ) interactions
+        GROUP BY story_id
+    """, user_id, user_id)
+    history = cursor.fetchall()
+    if not history:
+        return []
+
+    history_ids = np.asarray([row[0] for row in history], dtype=np.int64)
+    listens = np.asarray([row[1] for row in history], dtype=np.float32)
+    likes = np.asarray([row[2] for row in history], dtype=np.float32)
+    history_weights = (listen_weight(listens) + LIKE_WEIGHT * likes).astype(np.float32)
+    return score_candidates(model, history_ids, history_weights, limit)
+
+@bp_recommender.timer_trigger(schedule="0 */30 * * * *", arg_name="timer", run_on_startup=False)
+def refresh_recommender_job(timer: func.TimerRequest) -> None:
+    try:
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        cursor = conn.cursor()
+        if refresh_recommender(cursor, _container_client()):
+            invalidate_recommended_sections(cursor)
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Exception while refreshing recommender: {str(e)}")
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+@bp_recommender.timer_trigger(schedule="0 0 3 * * *", arg_name="timer", run_on_startup=False)
+def rebuild_recommender_job(timer: func.TimerRequest) -> None:
+    try:
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        cursor = conn.cursor()
+        if rebuild_recommender(cursor, _container_client()):
+            invalidate_recommended_sections(cursor)
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Exception while rebuilding recommender: {str(e)}")
+    finally:
+        if 'conn' in locals():
+            conn.close()
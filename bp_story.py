@@ -17,6 +17,10 @@ from azure.storage.queue import QueueServiceClient
 from azure.storage.queue import QueueClient
 from bp_process_pipeline import bp_process_pipeline
 from pydub import AudioSegment
+from home_feed import on_story_liked, on_story_listened
+from trending_tracker import record_event
+from category_index import categories_for_stories, invalidate as invalidate_category_index
+from category_stats import on_story_uploaded, record_recent_activity
 
 bp_story = func.Blueprint()
 
@@ -189,32 +193,11 @@ def get_stories(req: func.HttpRequest) -> func.HttpResponse:
         blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         container_client = blob_service_client.get_container_client(container_name)
         
+        story_categories = categories_for_stories(cursor, [story[0] for story in stories], include_icon=False)
+        
         for story in stories:
             story_id = story[0]
-
-            category_query = '''
-            SELECT 
-                c.id,
-                c.name,
-                c.description
-            FROM 
-                category c
-            INNER JOIN 
-                story_has_categories shc ON c.id = shc.category_id
-            WHERE 
-                shc.story_id = ? AND c.status = 1
-            '''
-            
-            cursor.execute(category_query, story_id)
-            categories = cursor.fetchall()
-            
-            category_list = []
-            for cat in categories:
-                category_list.append({
-                    "id": cat[0],
-                    "name": cat[1],
-                    "description": cat[2]
-                })
+            category_list = story_categories.get(story_id, [])
             
             thumbnail_blob_name = f"{story_id}/1.png"
             thumbnail_blob_client = container_client.get_blob_client(thumbnail_blob_name)
@@ -651,7 +634,13 @@ def update_story_like(req: func.HttpRequest) -> func.HttpResponse:
                     status_code=200
                 )
         
+        if action == 'increase':
+            on_story_liked(cursor, user_id, story_id)
+        record_recent_activity(cursor, story_id, likes=1 if action == 'increase' else -1)
+        
         conn.commit()
+        if action == 'increase':
+            record_event(story_id, 'like')
         cursor.execute('SELECT COUNT(*) FROM story_has_likes WHERE story_id = ? AND status = 1', story_id)
         updated_count = cursor.fetchone()[0]
         
@@ -691,6 +680,108 @@ def update_story_like(req: func.HttpRequest) -> func.HttpResponse:
         if 'conn' in locals():
             conn.close()
             
+@bp_story.route(route="story/listen", methods=["POST"])
+def record_story_listen(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        try:
+            req_body = req.get_json()
+        except ValueError:
+            return func.HttpResponse(
+                body=json.dumps({
+                    "status": False,
+                    "message": "Invalid JSON in request body"
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+        
+        for field in ['story_id', 'user_id']:
+            if field not in req_body:
+                return func.HttpResponse(
+                    body=json.dumps({
+                        "status": False,
+                        "message": f"Missing required field: {field}"
+                    }),
+                    mimetype="application/json",
+                    status_code=200
+                )
+        
+        try:
+            story_id = int(req_body['story_id'])
+            user_id = int(req_body['user_id'])
+        except ValueError:
+            return func.HttpResponse(
+                body=json.dumps({
+                    "status": False,
+                    "message": "Invalid ID format. Both story_id and user_id must be integers"
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+        
+        end_duration = req_body.get('end_duration')
+        
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM story WHERE id = ? AND status = 1', story_id)
+        story = cursor.fetchone()
+        
+        if not story:
+            return func.HttpResponse(
+                body=json.dumps({
+                    "status": False,
+                    "message": "Story not found or inactive"
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+        
+        cursor.execute('SELECT id FROM "user" WHERE id = ? AND status = 1', user_id)
+        user = cursor.fetchone()
+        
+        if not user:
+            return func.HttpResponse(
+                body=json.dumps({
+                    "status": False,
+                    "message": "User not found or inactive"
+                }),
+                mimetype="application/json",
+                status_code=200
+            )
+        
+        cursor.execute('INSERT INTO user_has_listen_stories (user_id, story_id, listen_time, end_duration) VALUES (?, ?, ?, ?)',
+                       user_id, story_id, datetime.now(), end_duration)
+        cursor.execute('UPDATE story SET listen_count = listen_count + 1 WHERE id = ?', story_id)
+        
+        on_story_listened(cursor, user_id, story_id)
+        record_recent_activity(cursor, story_id, listens=1)
+        
+        conn.commit()
+        record_event(story_id, 'listen')
+        
+        return func.HttpResponse(
+            body=json.dumps({
+                "status": True,
+                "message": "Story listen recorded successfully"
+            }),
+            mimetype="application/json",
+            status_code=200
+        )
+        
+    except Exception as e:
+        logging.error(f"Exception while recording story listen: {str(e)}")
+        return func.HttpResponse(
+            body=json.dumps({
+                "status": False,
+                "message": f"Internal server error: {str(e)}"
+            }),
+            mimetype="application/json",
+            status_code=200
+        )
+    finally:
+        if 'conn' in locals():
+            conn.close()
+            
 @bp_story.route(route="story/upload", methods=["POST"])
 def upload_story(req: func.HttpRequest) -> func.HttpResponse:
     try:
@@ -781,6 +872,8 @@ def upload_story(req: func.HttpRequest) -> func.HttpResponse:
                 VALUES (?, ?)
             ''', story_id, category_id)
 
+        on_story_uploaded(cursor, categories)
+
         connection_string = os.environ['AzureBlobStorageConnectionString']
         container_name = os.environ['AudioStorageContainerName']
 
@@ -805,6 +898,7 @@ def upload_story(req: func.HttpRequest) -> func.HttpResponse:
         ''', story_url, story_id)
 
         conn.commit()
+        invalidate_category_index()
 
         # # Queue the story for processing
         # try:
@@ -0,0 +1,105 @@
+# In-memory story -> category index.
+#
+# category and story_has_categories are small and change rarely, so instead of
+# one category query per story card, each instance keeps a CSR-style index:
+# a sorted array of story ids, an indptr array into a flat array of category
+# positions, and the active category metadata. The index is rebuilt only when
+# the tables' checksum version changes, checked at most every few seconds.
+# A reload builds a new snapshot and swaps it in with one assignment, so a
+# lookup running meanwhile keeps reading the arrays of one consistent index.
+
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+VERSION_CHECK_SECONDS = int(os.environ.get("CategoryIndexCheckSeconds", "30"))
+
+_lock = threading.Lock()
+# snapshot: (story_ids, indptr, positions, categories), replaced as a whole on reload.
+_index = {"version": None, "checked": 0.0, "snapshot": None}
+
+def _read_version(cursor):
+    cursor.execute("""
+        SELECT
+            (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(story_id, category_id)) FROM story_has_categories),
+            (SELECT COUNT(*) FROM story_has_categories),
+            (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(id, name, description, icon, status)) FROM category)
+    """)
+    return tuple(cursor.fetchone())
+
+def _load(cursor, version):
+    cursor.execute('SELECT id, name, description, icon FROM category WHERE status = 1 ORDER BY id')
+    categories = [{
+        "id": row[0],
+        "name": row[1],
+        "description": row[2],
+        "icon": row[3]
+    } for row in cursor.fetchall()]
+    category_ids = np.asarray([c["id"] for c in categories], dtype=np.int64)
+
+    cursor.execute('SELECT story_id, category_id FROM story_has_categories ORDER BY story_id, category_id')
+    pairs = np.asarray([(row[0], row[1]) for row in cursor.fetchall()], dtype=np.int64).reshape(-1, 2)
+
+    # Links to inactive categories never show up on story cards.
+    positions = np.searchsorted(category_ids, pairs[:, 1])
+    positions = np.clip(positions, 0, max(len(category_ids) - 1, 0))
+    active = category_ids[positions] == pairs[:, 1] if len(category_ids) else np.zeros(len(pairs), dtype=bool)
+    pairs = pairs[active]
+    positions = positions[active].astype(np.int32)
+
+    story_ids, counts = np.unique(pairs[:, 0], return_counts=True)
+    indptr = np.zeros(len(story_ids) + 1, dtype=np.int32)
+    np.cumsum(counts, out=indptr[1:])
+
+    _index["snapshot"] = (story_ids, indptr, positions, categories)
+    _index["version"] = version
+    logging.info(f"Loaded category index: {len(story_ids)} stories, {len(categories)} categories")
+
+def _ensure_current(cursor):
+    """The current index snapshot, reloaded first if the tables changed."""
+    with _lock:
+        now = time.monotonic()
+        if _index["snapshot"] is not None and now - _index["checked"] < VERSION_CHECK_SECONDS:
+            return _index["snapshot"]
+        version = _read_version(cursor)
+        _index["checked"] = now
+        if version != _index["version"] or _index["snapshot"] is None:
+            _load(cursor, version)
+        return _index["snapshot"]
+
+def invalidate():
+    """Force a version check on the next lookup, e.g. right after changing a story's categories."""
+    with _lock:
+        _index["checked"] = 0.0
+
+def categories_for_stories(cursor, story_ids, include_icon=True):
+    """Map each story id to its list of active category dicts."""
+    index_story_ids, indptr, positions, categories = _ensure_current(cursor)
+
+    if len(index_story_ids) == 0:
+        return {story_id: [] for story_id in story_ids}
+
+    result = {}
+    lookup = np.asarray(list(story_ids), dtype=np.int64)
+    rows = np.searchsorted(index_story_ids, lookup)
+    rows = np.clip(rows, 0, len(index_story_ids) - 1)
+    found = index_story_ids[rows] == lookup
+    for story_id, row, hit in zip(story_ids, rows, found):
+        if not hit:
+            result[story_id] = []
+            continue
+        category_list = []
+        for position in positions[indptr[row]:indptr[row + 1]]:
+            category = categories[position]
+            if include_icon:
+                category_list.append(dict(category))
+            else:
+                category_list.append({
+                    "id": category["id"],
+                    "name": category["name"],
+                    "description": category["description"]
+                })
+        result[story_id] = category_list
+    return result
@@ -0,0 +1,88 @@
+# Maintained per-category rollups (category_stats).
+#
+# Category endpoints read story counts and recent activity from this table
+# instead of aggregating story_has_categories / listens / likes per request.
+# Story counts, and the recent listen and like totals of a story's
+# categories, are adjusted in the same transaction as the write that changes
+# them. The periodic refresh recomputes everything set-based, which ages
+# activity out of the RECENT_WINDOW_DAYS window and repairs any drift. No
+# endpoint changes story.status, so a story activated or deactivated directly
+# in the database is picked up by that refresh.
+
+import logging
+from datetime import datetime, timedelta
+
+RECENT_WINDOW_DAYS = 21
+
+def adjust_story_counts(cursor, category_ids, delta):
+    """Add `delta` to story_count for each category, creating missing rows."""
+    now = datetime.now()
+    for category_id in set(category_ids):
+        cursor.execute(
+            'UPDATE category_stats SET story_count = story_count + ?, updated = ? WHERE category_id = ?',
+            delta, now, category_id
+        )
+        if cursor.rowcount == 0:
+            cursor.execute(
+                'INSERT INTO category_stats (category_id, story_count, recent_listens, recent_likes, updated) VALUES (?, ?, 0, 0, ?)',
+                category_id, max(delta, 0), now
+            )
+
+def on_story_uploaded(cursor, category_ids):
+    adjust_story_counts(cursor, category_ids, 1)
+
+def record_recent_activity(cursor, story_id, listens=0, likes=0):
+    """Add a story's new listens / likes (negative for an unlike) to its categories' recent totals."""
+    cursor.execute("""
+        UPDATE cs
+        SET recent_listens = cs.recent_listens + ?,
+            recent_likes = CASE WHEN cs.recent_likes + ? < 0 THEN 0 ELSE cs.recent_likes + ? END,
+            updated = ?
+        FROM category_stats cs
+        JOIN story_has_categories shc ON shc.category_id = cs.category_id
+        WHERE shc.story_id = ?
+    """, listens, likes, likes, datetime.now(), story_id)
+
+def refresh_category_stats(cursor):
+    """Recompute every category's rollups in one set-based statement."""
+    cutoff_date = datetime.now() - timedelta(days=RECENT_WINDOW_DAYS)
+    cursor.execute("""
+        MERGE category_stats AS target
+        USING (
+            SELECT
+                c.id AS category_id,
+                COUNT(DISTINCT s.id) AS story_count,
+                COUNT(DISTINCT uhls.id) AS recent_listens,
+                COUNT(DISTINCT shl.id) AS recent_likes
+            FROM
+                category c
+            LEFT JOIN
+                story_has_categories shc ON c.id = shc.category_id
+            LEFT JOIN
+                story s ON shc.story_id = s.id AND s.status = 1
+            LEFT JOIN
+                user_has_listen_stories uhls ON s.id = uhls.story_id
+                AND uhls.listen_time > ?
+            LEFT JOIN
+                story_has_likes shl ON s.id = shl.story_id
+                AND shl.updated > ?
+                AND shl.status = 1
+            GROUP BY
+                c.id
+        ) AS source
+        ON target.category_id = source.category_id
+        WHEN MATCHED THEN
+            UPDATE SET
+                story_count = source.story_count,
+                recent_listens = source.recent_listens,
+                recent_likes = source.recent_likes,
+                updated = GETDATE()
+        WHEN NOT MATCHED THEN
+            INSERT (category_id, story_count, recent_listens, recent_likes, updated)
+            VALUES (source.category_id, source.story_count, source.recent_listens, source.recent_likes, GETDATE());
+    """, cutoff_date, cutoff_date)
+    logging.info(f"Refreshed category stats for {cursor.rowcount} categories")
+
+def get_story_counts(cursor):
+    cursor.execute('SELECT category_id, story_count FROM category_stats')
+    return {row[0]: row[1] for row in cursor.fetchall()}
@@ -4,10 +4,12 @@ from bp_category import bp_category
 from bp_story import bp_story
 from bp_dashboard import bp_dashboard
 from bp_process_pipeline import bp_process_pipeline
+from bp_recommender import bp_recommender
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 app.register_functions(bp_user) 
 app.register_functions(bp_category)
 app.register_functions(bp_story) 
 app.register_functions(bp_dashboard) 
+app.register_functions(bp_recommender)
 app.register_functions(bp_process_pipeline) 
\ No newline at end of file
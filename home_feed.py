@@ -0,0 +1,164 @@
+# Materialized per-user home feed.
+#
+# The personalized part of the dashboard (recently listened stories with
+# resume positions, and recommendations) is stored as one JSON document per
+# user in user_home_feed, so the dashboard doesn't rerun those queries.
+# Writers (listens, likes, preferred category changes) update the affected
+# section of the feed instead of the dashboard recomputing it on every open.
+#
+# The feed keeps only story ids (and, for recent listens, the user's own
+# listen time and position). The cards are built from the current story rows
+# when the feed is read, so a retitled, recategorized or deactivated story
+# shows up correctly without touching any feed.
+#
+# When the recommender model changes, its jobs drop the recommended section
+# of every feed; a feed without one gets it rebuilt on its next read. Feeds
+# built on read are saved on their own connection, so reading the dashboard
+# never commits the caller's transaction.
+
+import logging
+import json
+import os
+import pyodbc
+from datetime import datetime
+
+FEED_SIZE = 10
+# Per-user fields of a recently listened card, kept in the feed with the id.
+LISTEN_FIELDS = ("lastListenTime", "listenedDuration")
+
+def _build_recently_listened(cursor, user_id):
+    from bp_dashboard import get_recently_listened_stories
+    cards = get_recently_listened_stories(cursor, user_id, FEED_SIZE)
+    return [{"id": card["id"], **{field: card.get(field) for field in LISTEN_FIELDS}} for card in cards]
+
+def _build_recommended(cursor, user_id):
+    from bp_dashboard import get_recommended_stories
+    return [{"id": card["id"]} for card in get_recommended_stories(cursor, user_id, FEED_SIZE)]
+
+def build_user_home_feed(cursor, user_id):
+    """Compute the full home feed entries for a user from the source tables."""
+    return {
+        "recentlyListened": _build_recently_listened(cursor, user_id),
+        "recommended": _build_recommended(cursor, user_id)
+    }
+
+def load_user_home_feed(cursor, user_id):
+    cursor.execute('SELECT feed_json FROM user_home_feed WHERE user_id = ?', user_id)
+    row = cursor.fetchone()
+    if not row or not row[0]:
+        return None
+    try:
+        return json.loads(row[0])
+    except ValueError:
+        logging.warning(f"Discarding unreadable home feed for user {user_id}")
+        return None
+
+def save_user_home_feed(cursor, user_id, feed):
+    feed_json = json.dumps(feed, default=str)
+    now = datetime.now()
+    cursor.execute(
+        'UPDATE user_home_feed SET feed_json = ?, updated = ? WHERE user_id = ?',
+        feed_json, now, user_id
+    )
+    if cursor.rowcount == 0:
+        cursor.execute(
+            'INSERT INTO user_home_feed (user_id, feed_json, updated) VALUES (?, ?, ?)',
+            user_id, feed_json, now
+        )
+
+def _store_built_feed(user_id, feed):
+    try:
+        conn = pyodbc.connect(os.environ["SqlConnectionString"])
+        try:
+            save_user_home_feed(conn.cursor(), user_id, feed)
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.warning(f"Could not store home feed for user {user_id}: {str(e)}")
+
+def get_user_home_feed(cursor, user_id):
+    """
+    The user's home feed as story cards. Missing entries (no feed yet, or
+    recommendations dropped after a model refresh) are built and stored; the
+    cards always come from the story rows.
+    """
+    from bp_dashboard import get_feed_story_cards
+    feed = load_user_home_feed(cursor, user_id)
+    if feed is None:
+        feed = build_user_home_feed(cursor, user_id)
+        _store_built_feed(user_id, feed)
+    elif "recommended" not in feed:
+        feed["recommended"] = _build_recommended(cursor, user_id)
+        _store_built_feed(user_id, feed)
+    return {
+        "recentlyListened": get_feed_story_cards(cursor, feed.get("recentlyListened", [])),
+        "recommended": get_feed_story_cards(cursor, feed.get("recommended", []), recommended=True)
+    }
+
+def invalidate_user_home_feed(cursor, user_id):
+    cursor.execute('DELETE FROM user_home_feed WHERE user_id = ?', user_id)
+
+def invalidate_recommended_sections(cursor):
+    """Drop the recommended section of every feed, after the recommender model changed."""
+    cursor.execute(
+        "UPDATE user_home_feed SET feed_json = JSON_MODIFY(feed_json, '$.recommended', NULL), updated = ? "
+        "WHERE JSON_QUERY(feed_json, '$.recommended') IS NOT NULL",
+        datetime.now()
+    )
+    logging.info(f"Dropped recommendations from {cursor.rowcount} home feeds")
+
+def _apply_feed_update(cursor, user_id, update):
+    # The feed is derived data: a failed incremental update must not fail the
+    # caller's write, but it must not leave a stale feed behind either.
+    try:
+        update()
+    except Exception as e:
+        logging.warning(f"Failed to update home feed for user {user_id}, invalidating: {str(e)}")
+        try:
+            invalidate_user_home_feed(cursor, user_id)
+        except Exception as e2:
+            logging.error(f"Failed to invalidate home feed for user {user_id}: {str(e2)}")
+
+def on_story_listened(cursor, user_id, story_id):
+    """Refresh recent listens and drop the story from the user's recommendations."""
+    def update():
+        feed = load_user_home_feed(cursor, user_id)
+        if feed is None:
+            save_user_home_feed(cursor, user_id, build_user_home_feed(cursor, user_id))
+            return
+
+        feed["recentlyListened"] = _build_recently_listened(cursor, user_id)
+        feed["recommended"] = [s for s in feed.get("recommended", []) if s["id"] != story_id]
+        if len(feed["recommended"]) < FEED_SIZE // 2:
+            feed["recommended"] = _build_recommended(cursor, user_id)
+        save_user_home_feed(cursor, user_id, feed)
+
+    _apply_feed_update(cursor, user_id, update)
+
+def on_story_liked(cursor, user_id, story_id):
+    """A liked story no longer needs to be recommended to the user."""
+    def update():
+        feed = load_user_home_feed(cursor, user_id)
+        if feed is None:
+            return
+
+        recommended = [s for s in feed.get("recommended", []) if s["id"] != story_id]
+        if len(recommended) == len(feed.get("recommended", [])):
+            return
+        feed["recommended"] = recommended
+        save_user_home_feed(cursor, user_id, feed)
+
+    _apply_feed_update(cursor, user_id, update)
+
+def on_preferred_categories_changed(cursor, user_id):
+    """Recommendations depend on preferred categories; recent listens do not."""
+    def update():
+        feed = load_user_home_feed(cursor, user_id)
+        if feed is None:
+            feed = build_user_home_feed(cursor, user_id)
+        else:
+            feed["recommended"] = _build_recommended(cursor, user_id)
+        save_user_home_feed(cursor, user_id, feed)
+
+    _apply_feed_update(cursor, user_id, update)
@@ -0,0 +1,71 @@
+# Which chat model each pipeline stage uses.
+#
+# Every chat call names its stage; ROUTES gives that stage a list of model
+# tiers, a latency budget and a completion token budget. The first tier is
+# the model the stage's request is built for. A call to a tier that times out
+# after timeout_seconds, is rate limited or gets a server error goes to the
+# next, faster tier at once, instead of waiting out the client's retries. The
+# last tier keeps the client's usual retries. Each tier has its own result
+# cache entries, so an answer from a fallback tier is never served in place
+# of the primary model's.
+#
+# Override any part of the table with PipelineModelRoutesJson, e.g.
+#   {"sentiment": {"models": ["gpt-4o-mini"]}, "rewrite": {"timeout_seconds": 60}}
+# Per-stage latency, the model that answered and fallbacks are counted into
+# the story's usage under "routes" (provider_limits.record_route).
+
+import json
+import logging
+import os
+import time
+from openai import APITimeoutError, InternalServerError, RateLimitError
+from provider_limits import record_route
+from result_cache import cached_chat_content
+
+FAST_MODEL = os.environ.get("PipelineFastModel", "gpt-4o-mini")
+
+ROUTES = {
+    "sentiment": {"models": ["gpt-4-turbo", FAST_MODEL], "timeout_seconds": 20, "max_tokens": 10},
+    "rewrite": {"models": ["gpt-4-turbo", FAST_MODEL], "timeout_seconds": 120, "max_tokens": 1500},
+    "key_points": {"models": ["gpt-4-turbo", FAST_MODEL], "timeout_seconds": 60, "max_tokens": 600},
+    "key_points_fallback": {"models": ["gpt-4-turbo", FAST_MODEL], "timeout_seconds": 45, "max_tokens": 400},
+    "analysis": {"models": [os.environ.get("PipelineStructuredModel", "gpt-4o"), FAST_MODEL], "timeout_seconds": 150, "max_tokens": 2500},
+}
+for _stage, _overrides in json.loads(os.environ.get("PipelineModelRoutesJson", "{}")).items():
+    ROUTES[_stage] = {**ROUTES.get(_stage, {}), **_overrides}
+
+# Errors that send a call on to the next tier.
+FALLBACK_ERRORS = (APITimeoutError, RateLimitError, InternalServerError)
+
+def route_request(stage, **request):
+    """The stage's chat request for its primary model and token budget."""
+    route = ROUTES[stage]
+    return {**request, "model": route["models"][0], "max_tokens": route["max_tokens"]}
+
+def route_tiers(stage, request):
+    """(model, request, client options, whether it's the last tier) for each tier of the stage."""
+    route = ROUTES[stage]
+    models = route["models"]
+    for tier, model in enumerate(models):
+        last = tier == len(models) - 1
+        options = {"timeout": route["timeout_seconds"]} if last else {"timeout": route["timeout_seconds"], "max_retries": 0}
+        yield model, {**request, "model": model}, options, last
+
+def log_fallback(stage, model, error):
+    logging.warning(f"Stage {stage}: {model} gave no answer within its budget ({type(error).__name__}), falling back to the next model")
+
+def routed_chat_content(blob_service, openai_client, stage, refresh=False, **request):
+    """cached_chat_content through the stage's model tiers; `request` as built by route_request."""
+    started = time.monotonic()
+    fallbacks = 0
+    for model, tier_request, options, last in route_tiers(stage, request):
+        try:
+            content = cached_chat_content(blob_service, openai_client.with_options(**options), stage, refresh=refresh, **tier_request)
+        except FALLBACK_ERRORS as e:
+            if last:
+                raise
+            log_fallback(stage, model, e)
+            fallbacks += 1
+            continue
+        record_route(getattr(openai_client, "usage", None), stage, model, time.monotonic() - started, fallbacks)
+        return content
@@ -0,0 +1,795 @@
+# Asyncio implementation of the story pipeline.
+#
+# The same stage DAG, checkpoints, lease, result cache entries and database
+# writes as pipeline_stages, but every network call is awaited: model calls
+# through AsyncOpenAI, blob storage through azure.storage.blob.aio and image
+# downloads through aiohttp. All the stories on an event loop share one set of
+# clients (AsyncPipelineClients), so their connection pools are reused, and
+# their stages interleave on one thread instead of each holding a worker
+# thread while it waits. What can only block runs in the default thread pool:
+# ffmpeg / pydub audio work, file hashing and pyodbc, which has no async driver.
+#
+# Checkpoints and cache entries are interchangeable with the threaded
+# pipeline, so a story started by one can be resumed by the other: run setup,
+# the DAG bookkeeping, checkpoint handling, cache keys and requests all come
+# from pipeline_stages and the pipeline_* modules, only the awaiting differs.
+# Deferred (batch) mode stays with the threaded pipeline.
+#
+# With PipelineEngine=async the queue triggers and the test endpoint run
+# stories through run_story, which schedules them on one event loop in a
+# background thread shared by the whole worker process.
+#
+# benchmarks/bench_async_pipeline.py compares the two designs.
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import aiohttp
+import pyodbc
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient
+from openai import RateLimitError
+from blob_streaming import STREAM_BLOCK_BYTES, block_id, decode_base64_stream, read_url
+from pipeline_images import (
+    DOWNLOAD_TIMEOUT_SECONDS, IMAGE_CONCURRENCY, IMAGE_TRANSFER_MODE, MAX_RATE_LIMIT_RETRIES,
+    build_image_prompt, cooldown_remaining, image_cache_key, start_cooldown
+)
+from pipeline_narration import TTS_CONCURRENCY, TTS_MODEL, TTS_VOICE, Mp3FrameFilter, chunk_timings, speech_cache_key, split_script
+from pipeline_stages import (
+    LEASE_SECONDS, LLM_MODE, SENTIMENT_MODE, STRUCTURED_ATTEMPTS, analysis_attempt, audio_blob_path, checkpoint_stage,
+    complete_state, image_checkpoints, key_points_fallback_request, key_points_request, lexicon_sentiment, load_story,
+    narration_output, parse_key_points, ready_stages, replace_timeline_rows, reused_stages, rewrite_request,
+    sentiment_request, spread_key_points, stage_context, stage_failed, stage_inputs, stages_for_mode, starting_state,
+    state_blob_client, story_analysis_request, timeline_rows
+)
+from pipeline_transcription import (
+    TRANSCRIPTION_CONCURRENCY, WHISPER_MODEL, export_chunk, file_sha256, find_split_points, fits_one_request, preprocess_audio,
+    probe_duration, save_audio_metrics, transcription_cache_key, transcription_segments
+)
+from model_routing import FALLBACK_ERRORS, log_fallback, route_tiers
+from providers import create_async_provider
+from provider_limits import HIGH, AsyncRateLimitedClient, async_story_slots, new_usage, record_route
+from result_cache import CACHE_ENABLED, cache_blob_client, chat_cache_key, index_cache_entry, touch_cache_entry
+
+class AsyncPipelineClients:
+    """
+    The clients shared by every story on an event loop: the AsyncOpenAI client
+    (or PipelineProvider's async fake), an async BlobServiceClient and an
+    aiohttp session for image downloads. Clients passed in are used as they
+    are and left open; the others are created on entry and closed on exit.
+
+        async with AsyncPipelineClients() as clients:
+            await run_story_pipeline_async(clients, story_id)
+    """
+
+    def __init__(self, openai_client=None, blob_service=None, http_session=None):
+        self.openai_client = openai_client
+        self.blob_service = blob_service
+        self.http_session = http_session
+        self._owned = []
+
+    async def __aenter__(self):
+        if self.openai_client is None:
+            self.openai_client = create_async_provider()
+            self._owned.append(self.openai_client)
+        if self.blob_service is None:
+            self.blob_service = BlobServiceClient.from_connection_string(os.environ['AzureBlobStorageConnectionString'])
+            self._owned.append(self.blob_service)
+        if self.http_session is None:
+            self.http_session = aiohttp.ClientSession()
+            self._owned.append(self.http_session)
+        return self
+
+    async def __aexit__(self, *exc):
+        for client in reversed(self._owned):
+            try:
+                await client.close()
+            except Exception as e:
+                logging.warning(f"Could not close {type(client).__name__}: {str(e)}")
+        self._owned = []
+        return False
+
+def _run_sql(update, *args):
+    conn = pyodbc.connect(os.environ['SqlConnectionString'])
+    try:
+        update(conn.cursor(), *args)
+        conn.commit()
+    finally:
+        conn.close()
+
+async def _execute(update, *args):
+    """Run `update(cursor, *args)` in its own connection and commit, off the event loop."""
+    await asyncio.to_thread(_run_sql, update, *args)
+
+# Blob streaming
+
+async def _rechunk(pieces, size=STREAM_BLOCK_BYTES):
+    buffer = bytearray()
+    async for piece in pieces:
+        buffer += piece
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+async def _iterate(pieces):
+    for piece in pieces:
+        yield piece
+
+async def stage_stream(blob_client, pieces, prefix=0):
+    """blob_streaming.stage_stream for an async iterator of pieces and an async blob client."""
+    block_ids = []
+    idx = 0
+    async for block in _rechunk(pieces):
+        current_id = block_id(prefix, idx)
+        await blob_client.stage_block(current_id, block)
+        block_ids.append(current_id)
+        idx += 1
+    return block_ids
+
+async def upload_stream(blob_client, pieces, content_type):
+    block_ids = await stage_stream(blob_client, pieces)
+    await blob_client.commit_block_list(block_ids, content_settings=ContentSettings(content_type=content_type))
+
+# Result cache, with the same keys and index as result_cache
+
+async def _touch(key):
+    await asyncio.to_thread(touch_cache_entry, key)
+
+async def _index(key, kind, size_bytes):
+    await asyncio.to_thread(index_cache_entry, key, kind, size_bytes)
+
+async def cached_text(blob_service, kind, key, compute, refresh=False):
+    """result_cache.cached_text with `compute` a coroutine function."""
+    if CACHE_ENABLED and not refresh:
+        try:
+            downloader = await cache_blob_client(blob_service, key).download_blob()
+            data = await downloader.readall()
+            logging.info(f"Result cache hit for {kind} {key[:12]}")
+            await _touch(key)
+            return data.decode("utf-8")
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed for {kind} {key[:12]}: {str(e)}")
+
+    text = await compute()
+    if CACHE_ENABLED:
+        try:
+            data = text.encode("utf-8")
+            await cache_blob_client(blob_service, key).upload_blob(
+                data, overwrite=True, content_settings=ContentSettings(content_type="text/plain; charset=utf-8"))
+            await _index(key, kind, len(data))
+        except Exception as e:
+            logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+    return text
+
+async def cached_chat_content(blob_service, openai_client, kind, refresh=False, **request):
+    async def compute():
+        response = await openai_client.chat.completions.create(**request)
+        if getattr(response, "usage", None) is not None:
+            logging.info(f"{kind} chat call used {response.usage.total_tokens} tokens")
+        return response.choices[0].message.content
+
+    return await cached_text(blob_service, kind, chat_cache_key(request), compute, refresh=refresh)
+
+async def routed_chat_content(blob_service, openai_client, stage, refresh=False, **request):
+    """model_routing.routed_chat_content on the async client."""
+    started = time.monotonic()
+    fallbacks = 0
+    for model, tier_request, options, last in route_tiers(stage, request):
+        try:
+            content = await cached_chat_content(blob_service, openai_client.with_options(**options), stage, refresh=refresh, **tier_request)
+        except FALLBACK_ERRORS as e:
+            if last:
+                raise
+            log_fallback(stage, model, e)
+            fallbacks += 1
+            continue
+        record_route(getattr(openai_client, "usage", None), stage, model, time.monotonic() - started, fallbacks)
+        return content
+
+async def cached_stream(blob_service, kind, key, open_stream, content_type, refresh=False):
+    """result_cache.cached_stream with `open_stream()` an async iterator."""
+    if CACHE_ENABLED and not refresh:
+        downloader = None
+        try:
+            downloader = await cache_blob_client(blob_service, key).download_blob()
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed for {kind} {key[:12]}: {str(e)}")
+        if downloader is not None:
+            logging.info(f"Result cache hit for {kind} {key[:12]}")
+            await _touch(key)
+            async for block in downloader.chunks():
+                yield block
+            return
+
+    cache_blob = cache_blob_client(blob_service, key) if CACHE_ENABLED else None
+    block_ids = []
+    size_bytes = 0
+    async for block in _rechunk(open_stream()):
+        yield block
+        size_bytes += len(block)
+        if cache_blob is not None:
+            try:
+                block_ids.append(block_id(len(block_ids)))
+                await cache_blob.stage_block(block_ids[-1], block)
+            except Exception as e:
+                logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+                cache_blob = None
+    if cache_blob is not None:
+        try:
+            await cache_blob.commit_block_list(block_ids, content_settings=ContentSettings(content_type=content_type))
+            await _index(key, kind, size_bytes)
+        except Exception as e:
+            logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+
+async def cached_copy(blob_service, kind, key, dest_blob_client, produce, content_type, refresh=False):
+    """result_cache.cached_copy with `produce` a coroutine function."""
+    cache_blob = cache_blob_client(blob_service, key)
+    if CACHE_ENABLED and not refresh:
+        try:
+            await dest_blob_client.upload_blob_from_url(read_url(cache_blob), overwrite=True, content_settings=ContentSettings(content_type=content_type))
+            logging.info(f"Result cache hit for {kind} {key[:12]}")
+            await _touch(key)
+            return
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed for {kind} {key[:12]}: {str(e)}")
+
+    await produce(dest_blob_client)
+    if CACHE_ENABLED:
+        try:
+            await cache_blob.upload_blob_from_url(read_url(dest_blob_client), overwrite=True, content_settings=ContentSettings(content_type=content_type))
+            await _index(key, kind, (await dest_blob_client.get_blob_properties()).size)
+        except Exception as e:
+            logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+
+# Checkpoint store
+
+async def load_state(blob_service, story_id):
+    try:
+        downloader = await state_blob_client(blob_service, story_id).download_blob()
+        data = await downloader.readall()
+    except ResourceNotFoundError:
+        return None
+    return json.loads(data) if data else None
+
+async def save_state(blob_service, story_id, state, lease=None):
+    if lease is not None:
+        lease.check()
+    await state_blob_client(blob_service, story_id).upload_blob(
+        json.dumps(state, default=str), overwrite=True,
+        content_settings=ContentSettings(content_type="application/json"),
+        lease=lease.lease if lease is not None else None)
+
+class AsyncStoryLease:
+    """pipeline_stages.StoryLease, renewed by a task on the event loop."""
+
+    def __init__(self, blob_client, lease):
+        self.blob_client = blob_client
+        self.lease = lease
+        self.lost = None
+        self.renewed = time.monotonic()
+        self._task = asyncio.create_task(self._renew())
+
+    @classmethod
+    async def acquire(cls, blob_service, story_id):
+        """The lease, or None if another worker is processing the story."""
+        blob_client = state_blob_client(blob_service, story_id)
+        try:
+            await blob_client.upload_blob(b"", overwrite=False)
+        except HttpResponseError:
+            pass
+        try:
+            lease = await blob_client.acquire_lease(lease_duration=LEASE_SECONDS)
+        except ResourceExistsError:
+            return None
+        return cls(blob_client, lease)
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            try:
+                await self.lease.renew()
+                self.renewed = time.monotonic()
+            except Exception as e:
+                logging.warning(f"Could not renew lease on {self.blob_client.blob_name}: {str(e)}")
+                if time.monotonic() - self.renewed >= LEASE_SECONDS:
+                    self.lost = e
+                    return
+
+    def check(self):
+        if self.lost is not None:
+            raise RuntimeError(f"Lease on {self.blob_client.blob_name} was lost") from self.lost
+
+    async def release(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await self.lease.release()
+        except Exception as e:
+            logging.warning(f"Could not release lease on {self.blob_client.blob_name}: {str(e)}")
+
+# Transcription
+
+async def _transcribe_file(openai_client, path, offset=0.0):
+    with open(path, "rb") as f:
+        transcription = await openai_client.audio.transcriptions.create(
+            model=WHISPER_MODEL,
+            file=f,
+            response_format="verbose_json"
+        )
+    return transcription.text.strip(), transcription_segments(transcription, offset)
+
+async def transcribe_audio(openai_client, audio_path, offset=0.0):
+    """pipeline_transcription.transcribe_audio with the chunks' Whisper calls awaited concurrently."""
+    size = os.path.getsize(audio_path)
+    duration = await asyncio.to_thread(probe_duration, audio_path)
+    if fits_one_request(size, duration):
+        text, segments = await _transcribe_file(openai_client, audio_path, offset=offset)
+        return {"text": text, "segments": segments}
+
+    splits = await asyncio.to_thread(find_split_points, audio_path, duration)
+    bounds = list(zip([0.0] + splits, splits + [duration]))
+    logging.info(f"Transcribing {duration:.0f}s of audio ({size} bytes) in {len(bounds)} chunks")
+    semaphore = asyncio.Semaphore(max(TRANSCRIPTION_CONCURRENCY, 1))
+
+    async def transcribe_chunk(start, end):
+        async with semaphore:
+            chunk_path = await asyncio.to_thread(export_chunk, audio_path, start, end)
+            try:
+                return await _transcribe_file(openai_client, chunk_path, offset=offset + start)
+            finally:
+                try:
+                    os.remove(chunk_path)
+                except OSError:
+                    pass
+
+    results = await asyncio.gather(*(transcribe_chunk(start, end) for start, end in bounds))
+    return {
+        "text": " ".join(text for text, _ in results if text),
+        "segments": [segment for _, segments in results for segment in segments]
+    }
+
+async def preprocess_and_transcribe(openai_client, source_path):
+    processed_path, metrics = await asyncio.to_thread(preprocess_audio, source_path)
+    try:
+        started = time.perf_counter()
+        transcription = await transcribe_audio(openai_client, processed_path, offset=metrics["offset_seconds"])
+        metrics["transcribe_ms"] = int((time.perf_counter() - started) * 1000)
+    finally:
+        try:
+            os.remove(processed_path)
+        except OSError:
+            pass
+    transcription["audio_metrics"] = metrics
+    return transcription
+
+# Narration
+
+def _speech_stream(openai_client, text, blob_service, refresh_cache):
+    async def open_stream():
+        async with openai_client.audio.speech.with_streaming_response.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            response_format="mp3"
+        ) as response:
+            async for piece in response.iter_bytes(STREAM_BLOCK_BYTES):
+                yield piece
+
+    if blob_service is None:
+        return open_stream()
+    return cached_stream(
+        blob_service, "speech", speech_cache_key(text),
+        open_stream, "audio/mpeg", refresh=refresh_cache
+    )
+
+async def synthesize_narration(openai_client, script, blob_client, blob_service=None, refresh_cache=False):
+    """pipeline_narration.synthesize_narration with at most TTS_CONCURRENCY chunks streaming at once."""
+    texts = split_script(script)
+    logging.info(f"Synthesizing narration in {len(texts)} chunks")
+    semaphore = asyncio.Semaphore(max(TTS_CONCURRENCY, 1))
+
+    async def stage_chunk(idx, text):
+        async with semaphore:
+            frame_filter = Mp3FrameFilter()
+
+            async def frames():
+                async for block in _speech_stream(openai_client, text, blob_service, refresh_cache):
+                    yield frame_filter.feed(block)
+                yield frame_filter.finish()
+
+            return await stage_stream(blob_client, frames(), prefix=idx), frame_filter.seconds
+
+    staged = await asyncio.gather(*(stage_chunk(idx, text) for idx, text in enumerate(texts)))
+    block_ids = [current_id for chunk_ids, _ in staged for current_id in chunk_ids]
+    await blob_client.commit_block_list(block_ids, content_settings=ContentSettings(content_type="audio/mpeg"))
+    return chunk_timings(texts, [seconds for _, seconds in staged])
+
+# Images
+
+async def generate_image(openai_client, prompt, response_format="url"):
+    # The 429 cooldown is shared with the threaded pipeline's image workers.
+    client = openai_client.with_options(max_retries=0)
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        remaining = cooldown_remaining()
+        while remaining > 0:
+            await asyncio.sleep(remaining)
+            remaining = cooldown_remaining()
+        try:
+            image_response = await client.images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+                response_format=response_format
+            )
+            return image_response.data[0]
+        except RateLimitError as e:
+            if attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            start_cooldown(e, attempt)
+
+async def _url_stream(http_session, url):
+    async with http_session.get(url, timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT_SECONDS)) as image_response:
+        image_response.raise_for_status()
+        async for block in image_response.content.iter_chunked(STREAM_BLOCK_BYTES):
+            yield block
+
+async def store_generated_image(openai_client, http_session, image_blob_client, prompt):
+    if IMAGE_TRANSFER_MODE == "b64":
+        image = await generate_image(openai_client, prompt, response_format="b64_json")
+        await upload_stream(image_blob_client, _iterate(decode_base64_stream(image.b64_json)), "image/png")
+        return
+
+    image_url = (await generate_image(openai_client, prompt)).url
+    try:
+        await image_blob_client.upload_blob_from_url(image_url, overwrite=True, content_settings=ContentSettings(content_type="image/png"))
+    except HttpResponseError as e:
+        logging.warning(f"Server-side copy of generated image failed, streaming it instead: {str(e)}")
+        await upload_stream(image_blob_client, _url_stream(http_session, image_url), "image/png")
+
+async def generate_key_point_images(openai_client, http_session, images_container_client, story_id, key_points, sentiment, completed=None, on_result=None, blob_service=None, refresh_cache=False):
+    """
+    pipeline_images.generate_key_point_images with at most IMAGE_CONCURRENCY
+    images in flight; `on_result` is a coroutine function.
+    """
+    completed = completed or {}
+    results = [completed.get(idx) for idx in range(len(key_points))]
+    semaphore = asyncio.Semaphore(max(IMAGE_CONCURRENCY, 1))
+
+    async def generate_one(idx):
+        timestamp, point = key_points[idx]
+        prompt = build_image_prompt(point, sentiment)
+        image_blob_client = images_container_client.get_blob_client(f"{story_id}/{idx+1}.png")
+        produce = lambda blob_client: store_generated_image(openai_client, http_session, blob_client, prompt)
+        async with semaphore:
+            try:
+                if blob_service is not None:
+                    await cached_copy(
+                        blob_service, "image", image_cache_key(prompt),
+                        image_blob_client, produce, "image/png", refresh=refresh_cache
+                    )
+                else:
+                    await produce(image_blob_client)
+                results[idx] = {"timestamp": timestamp, "point": point, "image_url": image_blob_client.url}
+            except Exception as e:
+                logging.error(f"Error processing image {idx+1}: {str(e)}")
+                results[idx] = {"timestamp": timestamp, "point": point, "error": str(e)}
+        if on_result:
+            await on_result(idx, results[idx])
+
+    await asyncio.gather(*(generate_one(idx) for idx in range(len(key_points)) if results[idx] is None))
+    return results
+
+# Stages, as in pipeline_stages
+
+async def stage_transcribe(ctx, outputs):
+    story_id = ctx["story_id"]
+    blob_path = audio_blob_path(ctx["story_url"])
+    audio_path = f"/tmp/{story_id}_{blob_path.split('/')[-1]}"
+    blob_client = ctx["blob_service"].get_blob_client(container=os.environ['AudioStorageContainerName'], blob=blob_path)
+    try:
+        downloader = await blob_client.download_blob()
+        with open(audio_path, "wb") as f:
+            async for chunk in downloader.chunks():
+                f.write(chunk)
+
+        async def transcribe():
+            logging.info(f"Transcribing audio for story {story_id}")
+            return json.dumps(await preprocess_and_transcribe(ctx["openai_client"], audio_path))
+
+        audio_sha256 = await asyncio.to_thread(file_sha256, audio_path)
+        transcription = json.loads(await cached_text(
+            ctx["blob_service"], "transcription",
+            transcription_cache_key(audio_sha256),
+            transcribe, refresh=ctx["refresh_cache"]
+        ))
+    finally:
+        try:
+            os.remove(audio_path)
+        except OSError:
+            pass
+    transcript_text = transcription["text"].strip()
+
+    if not transcript_text:
+        raise ValueError(f"Failed to transcribe audio for story {story_id}")
+
+    await _execute(save_audio_metrics, story_id, transcription["audio_metrics"])
+    return {
+        "transcript": transcript_text,
+        "transcript_segments": transcription["segments"],
+        "audio_metrics": transcription["audio_metrics"]
+    }
+
+async def stage_sentiment(ctx, outputs):
+    if SENTIMENT_MODE == "lexicon":
+        return lexicon_sentiment(ctx["story_id"], outputs["transcript"])
+    logging.info(f"Analyzing sentiment for story {ctx['story_id']}")
+    sentiment = await routed_chat_content(
+        ctx["blob_service"], ctx["openai_client"], "sentiment", refresh=ctx["refresh_cache"],
+        **sentiment_request(outputs["transcript"])
+    )
+    return {"sentiment": sentiment.strip()}
+
+async def stage_rewrite(ctx, outputs):
+    sentiment = outputs["sentiment"]
+    logging.info(f"Creating enhanced script for story {ctx['story_id']} with sentiment: {sentiment}")
+    enhanced_script = await routed_chat_content(
+        ctx["blob_service"], ctx["openai_client"], "rewrite", refresh=ctx["refresh_cache"],
+        **rewrite_request(outputs["transcript"], sentiment)
+    )
+    return {"enhanced_script": enhanced_script.strip()}
+
+async def stage_narration(ctx, outputs):
+    story_id = ctx["story_id"]
+    logging.info(f"Generating TTS audio for story {story_id}")
+    gen_audio_container = os.environ.get('GeneratedAudioContainerName', os.environ['AudioStorageContainerName'])
+    gen_audio_blob_client = ctx["blob_service"].get_blob_client(container=gen_audio_container, blob=f"generated/{story_id}_narration.mp3")
+    narration_chunks = await synthesize_narration(
+        ctx["openai_client"], outputs["enhanced_script"], gen_audio_blob_client,
+        blob_service=ctx["blob_service"], refresh_cache=ctx["refresh_cache"]
+    )
+    gen_audio_url = gen_audio_blob_client.url
+    await _execute(lambda cursor: cursor.execute('UPDATE story SET gen_audio_url = ? WHERE id = ?', gen_audio_url, story_id))
+    return narration_output(gen_audio_url, narration_chunks)
+
+async def stage_key_points(ctx, outputs):
+    enhanced_script = outputs["enhanced_script"]
+    logging.info(f"Extracting key points for story {ctx['story_id']}")
+    keypoints_text = await routed_chat_content(
+        ctx["blob_service"], ctx["openai_client"], "key_points", refresh=ctx["refresh_cache"],
+        **key_points_request(ctx["story_title"], enhanced_script)
+    )
+    key_points = parse_key_points(keypoints_text.strip())
+
+    if not key_points:
+        logging.warning(f"Failed to parse key points with timestamps, using evenly distributed points")
+        points_text = await routed_chat_content(
+            ctx["blob_service"], ctx["openai_client"], "key_points_fallback", refresh=ctx["refresh_cache"],
+            **key_points_fallback_request(enhanced_script)
+        )
+        key_points = spread_key_points(points_text)
+
+    return {"key_points": [list(point) for point in key_points]}
+
+async def stage_analysis(ctx, outputs):
+    story_id = ctx["story_id"]
+    logging.info(f"Analyzing story {story_id} with one structured call")
+    request = story_analysis_request(ctx["story_title"], outputs["transcript"])
+    for attempt in range(STRUCTURED_ATTEMPTS):
+        content = await routed_chat_content(
+            ctx["blob_service"], ctx["openai_client"], "analysis", refresh=ctx["refresh_cache"] or attempt > 0,
+            **request
+        )
+        analysis = analysis_attempt(story_id, content, attempt)
+        if analysis is not None:
+            return analysis
+
+async def stage_images(ctx, outputs):
+    story_id = ctx["story_id"]
+    key_points = [tuple(point) for point in outputs["key_points"]]
+    logging.info(f"Generating {len(key_points)} images for key points")
+    images_container_client = ctx["blob_service"].get_container_client(os.environ.get('StoryImagesContainerName', 'storyimages'))
+
+    partial, completed = image_checkpoints(ctx["state"])
+
+    async def checkpoint_image(idx, result):
+        if "error" in result:
+            return
+        async with ctx["state_lock"]:
+            partial[str(idx)] = result
+            await save_state(ctx["blob_service"], story_id, ctx["state"], ctx["lease"])
+
+    image_results = await generate_key_point_images(
+        ctx["openai_client"], ctx["http_session"], images_container_client, story_id, key_points, outputs["sentiment"],
+        completed=completed, on_result=checkpoint_image,
+        blob_service=ctx["blob_service"], refresh_cache=ctx["refresh_cache"])
+    async with ctx["state_lock"]:
+        ctx["state"]["partial"].pop("images", None)
+    return {"images": image_results}
+
+async def stage_timeline(ctx, outputs):
+    story_id = ctx["story_id"]
+    rows = timeline_rows(outputs)
+    await _execute(replace_timeline_rows, "story_timeline_events", ("time", "color", "image_url"), story_id, rows)
+    logging.info(f"Wrote {len(rows)} timeline events for story {story_id}")
+    return {"timeline_events": len(rows)}
+
+ASYNC_STAGE_FUNCTIONS = {
+    "transcribe": stage_transcribe,
+    "sentiment": stage_sentiment,
+    "rewrite": stage_rewrite,
+    "narration": stage_narration,
+    "key_points": stage_key_points,
+    "analysis": stage_analysis,
+    "images": stage_images,
+    "timeline": stage_timeline,
+}
+
+def async_stages_for_mode(mode):
+    """The mode's stage DAG from pipeline_stages, with the async stage functions."""
+    return {name: (ASYNC_STAGE_FUNCTIONS[name], dependencies) for name, (_, dependencies) in stages_for_mode(mode).items()}
+
+async def run_stages(ctx, stages):
+    """pipeline_stages.run_stages with every ready stage running as a task."""
+    outputs, timings = reused_stages(ctx, stages)
+    run_start = time.monotonic()
+
+    async def run_one(name):
+        ctx["lease"].check()
+        started = time.monotonic() - run_start
+        output = await stages[name][0](ctx, stage_inputs(stages, name, outputs))
+        return output, started, time.monotonic() - run_start
+
+    running = {}
+    failure = None
+    while True:
+        if failure is None:
+            for name in ready_stages(stages, outputs, running.values()):
+                running[asyncio.create_task(run_one(name))] = name
+        if not running:
+            break
+
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            name = running.pop(task)
+            try:
+                output, started, finished = task.result()
+            except Exception as e:
+                stage_failed(ctx, name, e)
+                failure = failure or e
+                continue
+            async with ctx["state_lock"]:
+                checkpoint_stage(ctx, outputs, timings, name, output, started, finished)
+                await save_state(ctx["blob_service"], ctx["story_id"], ctx["state"], ctx["lease"])
+    if failure is not None:
+        raise failure
+    return timings
+
+def _report(report, **values):
+    if report is not None:
+        report.update(values)
+
+async def run_story_pipeline_async(clients, story_id, force=False, lane=HIGH, rerun=None, refresh=False, usage=None, llm_mode=None, report=None):
+    """
+    pipeline_stages.run_story_pipeline on the running event loop, using the
+    shared AsyncPipelineClients. Same arguments and results, without deferred
+    mode.
+    """
+    story_data = await asyncio.to_thread(load_story, story_id)
+    if not story_data:
+        logging.error(f"Story {story_id} not found in database")
+        _report(report, status="not_found")
+        return False
+
+    lease = await AsyncStoryLease.acquire(clients.blob_service, story_id)
+    if lease is None:
+        logging.warning(f"Story {story_id} is already being processed by another worker, skipping duplicate delivery")
+        _report(report, status="busy")
+        return True
+    try:
+        return await _run_leased(clients, story_id, story_data, lease, force, lane, rerun, refresh, usage, llm_mode or LLM_MODE, report)
+    finally:
+        await lease.release()
+
+async def _run_leased(clients, story_id, story_data, lease, force, lane, rerun, refresh, usage, llm_mode, report):
+    blob_service = clients.blob_service
+    stages = async_stages_for_mode(llm_mode)
+    state = starting_state(None if force else await load_state(blob_service, story_id), story_id, story_data[0], llm_mode, stages, rerun)
+    if state.get("completed"):
+        logging.info(f"Story {story_id} was already processed at {state['completed']}, nothing to do")
+        _report(report, status="already_processed", completed=state["completed"])
+        return True
+    state.pop("deferred", None)
+
+    ctx = stage_context(
+        story_id, story_data, blob_service, state, asyncio.Lock(), lease,
+        AsyncRateLimitedClient(clients.openai_client, lane, usage if usage is not None else new_usage()), refresh
+    )
+    ctx["http_session"] = clients.http_session
+    try:
+        async with async_story_slots.hold(lane):
+            timings = await run_stages(ctx, stages)
+    except Exception:
+        _report(report, status="failed", failed_stage=ctx.get("failed_stage"))
+        raise
+
+    result = complete_state(state, timings, stages, ctx["openai_client"].usage)
+    await save_state(blob_service, story_id, state, lease)
+    _report(report, **result)
+    path = state["critical_path"]
+    logging.info(f"Successfully processed story {story_id} in {path['wall_seconds']:.1f}s; critical path: {' -> '.join(path['stages'])} ({path['seconds']:.1f}s)")
+    return True
+
+async def run_stories(story_ids, lane=HIGH, **options):
+    """
+    Process stories concurrently on the running event loop with one shared set
+    of clients. Returns {story_id: result or the exception it failed with}.
+    """
+    async with AsyncPipelineClients() as clients:
+        results = await asyncio.gather(
+            *(run_story_pipeline_async(clients, story_id, lane=lane, **options) for story_id in story_ids),
+            return_exceptions=True
+        )
+    return dict(zip(story_ids, results))
+
+# Entry point for the queue triggers (PipelineEngine=async)
+
+_engine = {"loop": None, "clients": None}
+_engine_lock = threading.Lock()
+
+def _engine_loop():
+    with _engine_lock:
+        if _engine["loop"] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="pipeline-async", daemon=True).start()
+            _engine["loop"] = loop
+            atexit.register(_close_engine)
+    return _engine["loop"]
+
+def _close_engine():
+    async def close():
+        opening = _engine["clients"]
+        if opening is not None and opening.done() and opening.exception() is None:
+            await opening.result().__aexit__(None, None, None)
+    try:
+        asyncio.run_coroutine_threadsafe(close(), _engine["loop"]).result(timeout=10)
+    except Exception as e:
+        logging.warning(f"Could not close the async pipeline clients: {str(e)}")
+
+async def _open_clients():
+    clients = AsyncPipelineClients()
+    return await clients.__aenter__()
+
+async def _run_on_engine(story_id, options):
+    # Only ever touched on the engine loop, so the first story opens the clients
+    # for all of them; if that failed, the next story tries again.
+    opening = _engine["clients"]
+    if opening is None or (opening.done() and opening.exception() is not None):
+        _engine["clients"] = asyncio.ensure_future(_open_clients())
+    clients = await _engine["clients"]
+    return await run_story_pipeline_async(clients, story_id, **options)
+
+def run_story(story_id, **options):
+    """
+    run_story_pipeline_async for synchronous callers, blocking until the story
+    is done. Every story run this way shares one event loop and one set of
+    clients for the life of the worker process, so concurrent queue messages
+    interleave on that loop instead of each holding a thread.
+    """
+    return asyncio.run_coroutine_threadsafe(_run_on_engine(story_id, options), _engine_loop()).result()
@@ -0,0 +1,154 @@
+# Bulk reprocessing of existing stories.
+#
+# A backfill run selects stories by creation date, category and/or missing
+# generated audio, records them in story_backfill_items and sends one message
+# per story to story-backfill-queue. Each message gets a growing initial
+# visibility timeout, so the messages become visible at the requested rate
+# rather than all at once; the low-priority lane in provider_limits then
+# keeps the run from crowding out fresh uploads. The backfill queue trigger
+# updates each item as it runs, which is what the run report aggregates.
+# Deferred runs hand their text stages to the batch job (pipeline_batch); their
+# items stay "deferred" until the batch answer is in and the story resumes.
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+BACKFILL_QUEUE_NAME = os.environ.get("StoryBackfillQueueName", "story-backfill-queue")
+MAX_VISIBILITY_SECONDS = 7 * 24 * 3600
+SEND_CONCURRENCY = 16
+REPORTED_FAILURES = 50
+
+def select_backfill_stories(cursor, created_from=None, created_to=None, category_id=None, missing_audio=False, limit=None):
+    """Ids of active stories with audio matching the filters, newest first."""
+    query = 'SELECT {top}s.id FROM story s'
+    params = []
+    if category_id is not None:
+        query += ' INNER JOIN story_has_categories shc ON s.id = shc.story_id AND shc.category_id = ?'
+        params.append(category_id)
+    query += ' WHERE s.status = 1 AND s.story_url IS NOT NULL'
+    if created_from is not None:
+        query += ' AND s.created >= ?'
+        params.append(created_from)
+    if created_to is not None:
+        query += ' AND s.created < ?'
+        params.append(created_to)
+    if missing_audio:
+        query += ' AND s.gen_audio_url IS NULL'
+    query += ' ORDER BY s.created DESC'
+    if limit is not None:
+        query = query.format(top='TOP (?) ')
+        params.insert(0, int(limit))
+    else:
+        query = query.format(top='')
+    cursor.execute(query, *params)
+    return [row[0] for row in cursor.fetchall()]
+
+def create_backfill_run(cursor, story_ids, filters, stages, rate_per_minute):
+    """Record the run and one queued item per story; returns the run id."""
+    cursor.execute('''
+        INSERT INTO story_backfill_runs (created, filters, stages, rate_per_minute, story_count)
+        OUTPUT INSERTED.id
+        VALUES (?, ?, ?, ?, ?)
+    ''', datetime.now(), json.dumps(filters, default=str), json.dumps(stages), rate_per_minute, len(story_ids))
+    run_id = cursor.fetchone()[0]
+    cursor.fast_executemany = True
+    cursor.executemany(
+        "INSERT INTO story_backfill_items (run_id, story_id, status, attempts) VALUES (?, ?, 'queued', 0)",
+        [(run_id, story_id) for story_id in story_ids]
+    )
+    return run_id
+
+def _backfill_queue_client():
+    return QueueClient.from_connection_string(
+        os.environ["AzureQueueStorageConnectionString"], BACKFILL_QUEUE_NAME,
+        message_encode_policy=TextBase64EncodePolicy()
+    )
+
+def send_backfill_message(message):
+    _backfill_queue_client().send_message(json.dumps(message))
+
+def enqueue_backfill(run_id, story_ids, stages, rate_per_minute, refresh=False, deferred=False):
+    """Send one message per story, the i-th becoming visible after i / rate_per_minute minutes."""
+    queue_client = _backfill_queue_client()
+
+    def send(item):
+        idx, story_id = item
+        message = {"story_id": story_id, "run_id": run_id, "stages": stages, "refresh": refresh, "deferred": deferred}
+        queue_client.send_message(json.dumps(message), visibility_timeout=int(idx * 60 / rate_per_minute))
+
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as executor:
+        list(executor.map(send, enumerate(story_ids)))
+    logging.info(f"Backfill run {run_id}: queued {len(story_ids)} stories at {rate_per_minute}/min")
+
+def start_backfill_item(cursor, run_id, story_id):
+    cursor.execute('''
+        UPDATE story_backfill_items SET status = 'running', attempts = attempts + 1, started = ?, error = NULL
+        WHERE run_id = ? AND story_id = ?
+    ''', datetime.now(), run_id, story_id)
+
+def finish_backfill_item(cursor, run_id, story_id, seconds, cost_usd, error=None, deferred=False):
+    """Seconds and cost add up over attempts, including ones that failed."""
+    status = 'failed' if error else 'deferred' if deferred else 'done'
+    cursor.execute('''
+        UPDATE story_backfill_items SET status = ?, finished = ?, seconds = ISNULL(seconds, 0) + ?,
+            cost_usd = ISNULL(cost_usd, 0) + ?, error = ?
+        WHERE run_id = ? AND story_id = ?
+    ''', status, datetime.now(), round(seconds, 3), cost_usd, error[:1000] if error else None, run_id, story_id)
+
+def add_backfill_item_cost(cursor, run_id, story_id, cost_usd):
+    cursor.execute(
+        'UPDATE story_backfill_items SET cost_usd = ISNULL(cost_usd, 0) + ? WHERE run_id = ? AND story_id = ?',
+        cost_usd, run_id, story_id
+    )
+
+def backfill_report(cursor, run_id):
+    """Progress, throughput, estimated cost and failures of a run, or None if it doesn't exist."""
+    cursor.execute('SELECT created, filters, stages, rate_per_minute, story_count FROM story_backfill_runs WHERE id = ?', run_id)
+    run = cursor.fetchone()
+    if not run:
+        return None
+
+    cursor.execute('''
+        SELECT status, COUNT(*), SUM(cost_usd), AVG(seconds), MIN(started), MAX(finished)
+        FROM story_backfill_items WHERE run_id = ? GROUP BY status
+    ''', run_id)
+    counts = {}
+    cost_usd = 0.0
+    first_started = None
+    last_finished = None
+    average_seconds = None
+    for status, count, cost, seconds, started, finished in cursor.fetchall():
+        counts[status] = count
+        cost_usd += float(cost or 0)
+        if status == 'done':
+            average_seconds = round(float(seconds), 1) if seconds is not None else None
+        if started and (first_started is None or started < first_started):
+            first_started = started
+        if finished and (last_finished is None or finished > last_finished):
+            last_finished = finished
+
+    done = counts.get('done', 0)
+    elapsed_minutes = (last_finished - first_started).total_seconds() / 60 if first_started and last_finished else 0
+    cursor.execute(f'''
+        SELECT TOP {REPORTED_FAILURES} story_id, attempts, error FROM story_backfill_items
+        WHERE run_id = ? AND status = 'failed' ORDER BY finished DESC
+    ''', run_id)
+    failures = [{"story_id": story_id, "attempts": attempts, "error": error} for story_id, attempts, error in cursor.fetchall()]
+
+    return {
+        "run_id": run_id,
+        "created": run[0],
+        "filters": json.loads(run[1]),
+        "stages": json.loads(run[2]),
+        "rate_per_minute": run[3],
+        "story_count": run[4],
+        "counts": counts,
+        "stories_per_minute": round(done / elapsed_minutes, 2) if elapsed_minutes > 0 else None,
+        "average_seconds": average_seconds,
+        "estimated_cost_usd": round(cost_usd, 2),
+        "failures": failures
+    }
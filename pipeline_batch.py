@@ -0,0 +1,137 @@
+# Deferred processing of the text stages through the OpenAI Batch API.
+#
+# In deferred mode the pipeline transcribes a story and, instead of making
+# the structured analysis call itself, queues that request in
+# story_batch_requests and stops. The process_deferred_batches timer job
+# submits every queued request as one batch job (half the price of
+# synchronous calls, under separate and much larger limits), polls the
+# submitted batches, and hands each finished story's answer back to the
+# pipeline, which checkpoints it and runs narration, images and the timeline
+# as usual.
+#
+# Set OPENAI_BASE_URL to point the client at a local fake batch endpoint.
+
+import io
+import json
+import logging
+import os
+import uuid
+import pyodbc
+from datetime import datetime
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+MAX_BATCH_REQUESTS = int(os.environ.get("DeferredBatchMaxRequests", "1000"))
+PENDING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+def build_batch_file(requests):
+    """JSONL input file for (custom_id, request) pairs."""
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": request})
+        for custom_id, request in requests
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def submit_batch(openai_client, requests):
+    """Upload the requests and start a batch job; returns the batch id."""
+    batch_file = openai_client.files.create(file=("batch.jsonl", io.BytesIO(build_batch_file(requests))), purpose="batch")
+    batch = openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW
+    )
+    logging.info(f"Submitted batch {batch.id} with {len(requests)} requests")
+    return batch.id
+
+def parse_batch_output(text):
+    """{custom_id: (message content or None, error or None, total tokens)} for an output or error file."""
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        body = response.get("body") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            error = item.get("error") or body.get("error") or {"status_code": response.get("status_code")}
+            results[item["custom_id"]] = (None, json.dumps(error), 0)
+        else:
+            content = body["choices"][0]["message"]["content"]
+            results[item["custom_id"]] = (content, None, (body.get("usage") or {}).get("total_tokens", 0))
+    return results
+
+def collect_batch(openai_client, batch_id):
+    """
+    (status, results) for a batch: results as in parse_batch_output once the
+    batch has finished (completed, failed, expired or cancelled), else None.
+    """
+    batch = openai_client.batches.retrieve(batch_id)
+    if batch.status in PENDING_STATUSES:
+        return batch.status, None
+    results = {}
+    for file_id in (batch.error_file_id, batch.output_file_id):
+        if file_id:
+            results.update(parse_batch_output(openai_client.files.content(file_id).text))
+    return batch.status, results
+
+def queue_batch_request(story_id, request, resume_message):
+    """
+    Queue a story's request for the next batch; `resume_message` is what goes
+    back on the backfill queue once the answer is in. Replaces any request
+    for the story that hasn't been submitted yet.
+    """
+    conn = pyodbc.connect(os.environ["SqlConnectionString"])
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM story_batch_requests WHERE story_id = ? AND status = 'pending'", story_id)
+        cursor.execute('''
+            INSERT INTO story_batch_requests (story_id, custom_id, request, resume_message, status, created, updated)
+            VALUES (?, ?, ?, ?, 'pending', ?, ?)
+        ''', story_id, f"story-{story_id}-{uuid.uuid4().hex[:12]}", json.dumps(request),
+            json.dumps(resume_message), datetime.now(), datetime.now())
+        conn.commit()
+    finally:
+        conn.close()
+
+def submit_pending_requests(cursor, openai_client):
+    """Submit the oldest pending requests as one batch; returns the batch id, or None if nothing was pending."""
+    cursor.execute('''
+        SELECT TOP (?) id, custom_id, request FROM story_batch_requests
+        WHERE status = 'pending' ORDER BY created
+    ''', MAX_BATCH_REQUESTS)
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    batch_id = submit_batch(openai_client, [(custom_id, json.loads(request)) for _, custom_id, request in rows])
+    cursor.fast_executemany = True
+    cursor.executemany(
+        "UPDATE story_batch_requests SET status = 'submitted', batch_id = ?, updated = ? WHERE id = ?",
+        [(batch_id, datetime.now(), row_id) for row_id, _, _ in rows]
+    )
+    return batch_id
+
+def finished_batch_results(cursor, openai_client):
+    """
+    Check every submitted batch. Yields (row id, story id, resume message,
+    content, error, total tokens) for each request of the batches that have
+    finished; requests a finished batch has no answer for get an error.
+    """
+    cursor.execute("SELECT DISTINCT batch_id FROM story_batch_requests WHERE status = 'submitted'")
+    for (batch_id,) in cursor.fetchall():
+        status, results = collect_batch(openai_client, batch_id)
+        if results is None:
+            logging.info(f"Batch {batch_id} is {status}")
+            continue
+        cursor.execute('''
+            SELECT id, story_id, custom_id, resume_message FROM story_batch_requests
+            WHERE batch_id = ? AND status = 'submitted'
+        ''', batch_id)
+        for row_id, story_id, custom_id, resume_message in cursor.fetchall():
+            content, error, tokens = results.get(custom_id, (None, f"no result in {status} batch", 0))
+            yield row_id, story_id, json.loads(resume_message), content, error, tokens
+
+def finish_batch_request(cursor, row_id, error=None):
+    cursor.execute(
+        'UPDATE story_batch_requests SET status = ?, error = ?, updated = ? WHERE id = ?',
+        'failed' if error else 'done', error[:1000] if error else None, datetime.now(), row_id
+    )
@@ -0,0 +1,148 @@
+# Key-point image generation for the story pipeline.
+#
+# Images are generated and stored with bounded concurrency. A 429 from the
+# image provider pauses every worker until the provider's Retry-After (or an
+# exponential backoff) has passed, instead of each worker hammering the
+# endpoint on its own schedule.
+#
+# Generated images are copied into storage server-side from the provider's
+# URL (Put Blob From URL), so the bytes never pass through the worker. Where
+# storage can't reach the provider (ImageTransferMode=b64, e.g. the local
+# emulator), the image is requested as base64 and decoded block by block into
+# the blob; if a copy fails at runtime the URL is streamed instead.
+
+import logging
+import os
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import RateLimitError
+from azure.core.exceptions import HttpResponseError
+from azure.storage.blob import ContentSettings
+from blob_streaming import STREAM_BLOCK_BYTES, decode_base64_stream, upload_stream
+from result_cache import cache_key, cached_copy
+
+IMAGE_CONCURRENCY = int(os.environ.get("ImageGenerationConcurrency", "3"))
+MAX_RATE_LIMIT_RETRIES = 4
+DOWNLOAD_TIMEOUT_SECONDS = 60
+IMAGE_TRANSFER_MODE = os.environ.get("ImageTransferMode", "copy")
+
+_cooldown_lock = threading.Lock()
+_cooldown_until = [0.0]
+
+def cooldown_remaining():
+    """Seconds until image generation may resume after a 429; 0 or less if it may now."""
+    with _cooldown_lock:
+        return _cooldown_until[0] - time.monotonic()
+
+def _wait_for_cooldown():
+    while True:
+        remaining = cooldown_remaining()
+        if remaining <= 0:
+            return
+        time.sleep(remaining)
+
+def start_cooldown(error, attempt):
+    retry_after = None
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+    delay = retry_after if retry_after is not None else min(2 ** attempt, 30)
+    with _cooldown_lock:
+        _cooldown_until[0] = max(_cooldown_until[0], time.monotonic() + delay)
+    logging.warning(f"Image provider rate limited, pausing image generation for {delay:.1f}s")
+
+def build_image_prompt(point, sentiment):
+    return f"Digital illustration for a story: '{point}'. Emotional tone: {sentiment}. Style: colorful, emotional, vivid. Suitable for storytelling. Scene must be visually striking and memorable. No text."
+
+def generate_image(openai_client, prompt, response_format="url"):
+    # Retries are handled here so the shared cooldown sees every 429.
+    client = openai_client.with_options(max_retries=0)
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        _wait_for_cooldown()
+        try:
+            image_response = client.images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+                response_format=response_format
+            )
+            return image_response.data[0]
+        except RateLimitError as e:
+            if attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            start_cooldown(e, attempt)
+
+def _url_stream(session, url):
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as image_response:
+        image_response.raise_for_status()
+        yield from image_response.iter_content(STREAM_BLOCK_BYTES)
+
+def store_generated_image(openai_client, session, image_blob_client, prompt):
+    """Generate an image for `prompt` and write it to `image_blob_client`."""
+    if IMAGE_TRANSFER_MODE == "b64":
+        image = generate_image(openai_client, prompt, response_format="b64_json")
+        upload_stream(image_blob_client, decode_base64_stream(image.b64_json), "image/png")
+        return
+
+    image_url = generate_image(openai_client, prompt).url
+    try:
+        image_blob_client.upload_blob_from_url(image_url, overwrite=True, content_settings=ContentSettings(content_type="image/png"))
+    except HttpResponseError as e:
+        # The image is already paid for, so fetch it rather than generate another.
+        logging.warning(f"Server-side copy of generated image failed, streaming it instead: {str(e)}")
+        upload_stream(image_blob_client, _url_stream(session, image_url), "image/png")
+
+def image_cache_key(prompt):
+    """Result cache key of a generated image, shared with pipeline_async."""
+    return cache_key("image", "dall-e-3", "1024x1024", prompt)
+
+def _generate_one(openai_client, session, images_container_client, story_id, idx, point, sentiment, blob_service, refresh_cache):
+    prompt = build_image_prompt(point, sentiment)
+    image_blob_client = images_container_client.get_blob_client(f"{story_id}/{idx+1}.png")
+    produce = lambda blob_client: store_generated_image(openai_client, session, blob_client, prompt)
+    if blob_service is not None:
+        cached_copy(
+            blob_service, "image", image_cache_key(prompt),
+            image_blob_client, produce, "image/png", refresh=refresh_cache
+        )
+    else:
+        produce(image_blob_client)
+    return image_blob_client.url
+
+def generate_key_point_images(openai_client, images_container_client, story_id, key_points, sentiment, completed=None, on_result=None, blob_service=None, refresh_cache=False):
+    """
+    Generate one image per (timestamp, point) and upload it as {story_id}/{idx+1}.png.
+    Returns a list aligned with key_points; each entry has "image_url" on success or
+    "error" on failure, so one bad image never takes down the others.
+    `completed` maps idx -> an earlier successful result to reuse instead of regenerating;
+    `on_result(idx, result)` is called as each image finishes, e.g. to checkpoint progress.
+    With `blob_service`, images for an unchanged prompt come from the result cache.
+    """
+    completed = completed or {}
+    results = [completed.get(idx) for idx in range(len(key_points))]
+    pending = [idx for idx in range(len(key_points)) if results[idx] is None]
+    if not pending:
+        return results
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max(IMAGE_CONCURRENCY, 1)) as executor:
+        futures = {
+            executor.submit(_generate_one, openai_client, session, images_container_client, story_id, idx, key_points[idx][1], sentiment, blob_service, refresh_cache): idx
+            for idx in pending
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            timestamp, point = key_points[idx]
+            try:
+                results[idx] = {"timestamp": timestamp, "point": point, "image_url": future.result()}
+            except Exception as e:
+                logging.error(f"Error processing image {idx+1}: {str(e)}")
+                results[idx] = {"timestamp": timestamp, "point": point, "error": str(e)}
+            if on_result:
+                on_result(idx, results[idx])
+    return results
@@ -0,0 +1,224 @@
+# Narration (TTS) for the story pipeline.
+#
+# The enhanced script is split on sentence boundaries into chunks well under
+# the provider's input limit, the chunks are synthesized concurrently, and the
+# MP3 results are joined frame by frame: ID3 tags and Xing/Info header frames
+# are dropped so the joined file is one clean MPEG audio stream, with no
+# re-encoding. Frame headers also give each chunk's exact duration, which the
+# timeline uses to line key points up with the actual narration.
+#
+# Each chunk's audio is streamed from the provider (or the result cache)
+# through the frame filter straight into staged blocks of the narration blob;
+# the blocks are committed in script order once every chunk is done.
+
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import ContentSettings
+from blob_streaming import STREAM_BLOCK_BYTES, stage_stream
+from result_cache import cache_key, cached_stream
+
+TTS_MODEL = "tts-1"
+TTS_VOICE = "nova"
+TTS_CHUNK_CHARS = int(os.environ.get("TtsChunkChars", "1200"))
+TTS_CONCURRENCY = int(os.environ.get("TtsConcurrency", "4"))
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+|(?<=[.!?…]["\'”’)])\s+')
+
+def split_script(script, max_chars=TTS_CHUNK_CHARS):
+    """Pack whole sentences into chunks of at most max_chars; overlong sentences are split on spaces."""
+    chunks = []
+    current = ""
+    for sentence in _SENTENCE_END.split(script.strip()):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        pieces = [sentence]
+        if len(sentence) > max_chars:
+            pieces, piece = [], ""
+            for word in sentence.split():
+                if piece and len(piece) + 1 + len(word) > max_chars:
+                    pieces.append(piece)
+                    piece = word
+                else:
+                    piece = f"{piece} {word}" if piece else word
+            pieces.append(piece)
+        for piece in pieces:
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+# MPEG audio Layer III frame headers
+
+_BITRATES_KBPS = {
+    "mpeg1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    "mpeg2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def _parse_frame_header(data, offset):
+    """(frame length, samples, sample rate, side info length) for a Layer III header at offset, or None."""
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 3
+    layer = (data[offset + 1] >> 1) & 3
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    padding = (data[offset + 2] >> 1) & 1
+    mono = (data[offset + 3] >> 6) == 3
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        bitrate = _BITRATES_KBPS["mpeg1"][bitrate_index] * 1000
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate, 17 if mono else 32
+    bitrate = _BITRATES_KBPS["mpeg2"][bitrate_index] * 1000
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate, 9 if mono else 17
+
+def _skip_id3v2(data):
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        return 10 + size + (10 if data[5] & 0x10 else 0)
+    return 0
+
+class Mp3FrameFilter:
+    """
+    Incremental MP3 cleaner: feed() bytes as they arrive and get back the whole
+    audio frames found so far. ID3v2/ID3v1 tags, the Xing/Info/VBRI header
+    frame and any junk between frames are dropped; `seconds` is the duration
+    of the frames returned.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.skip = None
+        self.first = True
+        self.seconds = 0.0
+
+    def feed(self, data):
+        self.buffer += data
+        return self._drain(final=False)
+
+    def finish(self):
+        return self._drain(final=True)
+
+    def _drain(self, final):
+        data = self.buffer
+        if self.skip is None:
+            if len(data) < 10 and not final:
+                return b""
+            self.skip = _skip_id3v2(bytes(data[:10])) if data[:3] == b"ID3" else 0
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            del data[:skipped]
+            self.skip -= skipped
+            if self.skip:
+                return b""
+
+        # An ID3v1 tag can only be recognized at the end, so the last 128
+        # bytes wait for more data.
+        if final:
+            end = len(data) - 128 if len(data) >= 128 and data[-128:-125] == b"TAG" else len(data)
+        else:
+            end = len(data) - 128
+        frames = bytearray()
+        offset = 0
+        while offset + 4 <= end:
+            header = _parse_frame_header(data, offset)
+            if header is None:
+                offset += 1
+                continue
+            length, samples, sample_rate, side_info = header
+            if offset + length > end:
+                break
+            frame = data[offset:offset + length]
+            is_info_frame = self.first and (frame[4 + side_info:8 + side_info] in (b"Xing", b"Info") or frame[36:40] == b"VBRI")
+            if not is_info_frame:
+                frames += frame
+                self.seconds += samples / sample_rate
+            self.first = False
+            offset += length
+        del data[:len(data) if final else offset]
+        return bytes(frames)
+
+def mp3_audio_frames(data):
+    """Strip a whole MP3 down to its audio frames. Returns (frame bytes, duration in seconds)."""
+    frame_filter = Mp3FrameFilter()
+    frames = frame_filter.feed(data) + frame_filter.finish()
+    return frames, frame_filter.seconds
+
+def speech_cache_key(text):
+    """Result cache key of a narration chunk, shared with pipeline_async."""
+    return cache_key("speech", TTS_MODEL, TTS_VOICE, text)
+
+def _chunk_stream(openai_client, text, blob_service, refresh_cache):
+    def open_stream():
+        with openai_client.audio.speech.with_streaming_response.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            response_format="mp3"
+        ) as response:
+            yield from response.iter_bytes(STREAM_BLOCK_BYTES)
+
+    if blob_service is None:
+        return open_stream()
+    return cached_stream(
+        blob_service, "speech", speech_cache_key(text),
+        open_stream, "audio/mpeg", refresh=refresh_cache
+    )
+
+def _stage_chunk(openai_client, blob_client, idx, text, blob_service, refresh_cache):
+    frame_filter = Mp3FrameFilter()
+
+    def frames():
+        for block in _chunk_stream(openai_client, text, blob_service, refresh_cache):
+            yield frame_filter.feed(block)
+        yield frame_filter.finish()
+
+    return stage_stream(blob_client, frames(), prefix=idx), frame_filter.seconds
+
+def synthesize_narration(openai_client, script, blob_client, blob_service=None, refresh_cache=False):
+    """
+    Synthesize the script chunk by chunk into `blob_client`. Returns the chunks:
+    each one's character count, start and duration in seconds. With
+    `blob_service`, chunks whose text hasn't changed come from the result cache.
+    """
+    texts = split_script(script)
+    logging.info(f"Synthesizing narration in {len(texts)} chunks")
+    with ThreadPoolExecutor(max_workers=max(TTS_CONCURRENCY, 1)) as executor:
+        staged = list(executor.map(
+            lambda item: _stage_chunk(openai_client, blob_client, item[0], item[1], blob_service, refresh_cache),
+            enumerate(texts)
+        ))
+
+    block_ids = [current_id for chunk_ids, _ in staged for current_id in chunk_ids]
+    blob_client.commit_block_list(block_ids, content_settings=ContentSettings(content_type="audio/mpeg"))
+    return chunk_timings(texts, [seconds for _, seconds in staged])
+
+def chunk_timings(texts, durations):
+    """Each chunk's character count, start and duration in seconds."""
+    chunks = []
+    start = 0.0
+    for text, seconds in zip(texts, durations):
+        chunks.append({"chars": len(text), "start": round(start, 3), "seconds": round(seconds, 3)})
+        start += seconds
+    return chunks
+
+def align_timestamps(timestamps, narration_seconds):
+    """
+    Map key-point timestamps, which the model guessed for an assumed narration
+    length, onto the real narration: the guessed span (last timestamp plus one
+    average gap) is stretched or squeezed to narration_seconds.
+    """
+    if not timestamps or narration_seconds <= 0:
+        return list(timestamps)
+    last = max(timestamps)
+    span = last + (last / max(len(timestamps) - 1, 1) if last > 0 else 1)
+    return [min(int(t * narration_seconds / span), int(narration_seconds)) for t in timestamps]
@@ -0,0 +1,815 @@
+# Story processing pipeline as explicit, checkpointed stages.
+#
+#   transcribe -> sentiment -> rewrite -+-> narration ----------+-> timeline
+#                                       +-> key_points -> images -+
+#
+# Stages declare their dependencies and run as soon as those are done, so TTS
+# renders while key points are extracted and images generated. After each
+# stage its output is written to a per-story state blob. When a message is
+# retried or redelivered, completed stages are skipped and their outputs
+# reused, so a late failure doesn't pay for Whisper, GPT-4 and TTS again.
+# Generated images are checkpointed one by one as they finish. Model calls go
+# through result_cache, so reprocessing unchanged inputs (or a forced rerun
+# after a prompt change) only pays for the calls whose inputs changed.
+#
+# With PipelineLlmMode=structured, sentiment, rewrite and key_points are
+# replaced by a single "analysis" stage that gets all three from one
+# JSON-schema constrained chat call. In deferred mode (always structured) the
+# analysis request goes into the next OpenAI batch instead, see pipeline_batch.
+# With PipelineSentimentMode=lexicon the separate mode's sentiment stage is
+# scored locally (sentiment_lexicon) rather than by a chat call. Which model
+# answers each chat call, its latency budget and the faster model to fall
+# back to are set per stage in model_routing.
+#
+# A run holds a lease on the story's state blob, renewed in the background, so
+# a duplicate delivery of the same story exits at once instead of paying for
+# the same calls again and racing on the timeline rows.
+#
+# The queue triggers and the HTTP test endpoint all call run_story_pipeline,
+# the endpoint with a `report` to return per-stage timings, or with
+# PipelineEngine=async pipeline_async.run_story, which runs the same DAG on an
+# event loop. Both engines share the run setup, DAG bookkeeping, requests,
+# checkpoint handling and timeline rows defined here, so keep those out of
+# the stage functions and the runners.
+
+import logging
+import json
+import os
+import threading
+import time
+import pyodbc
+from urllib.parse import unquote, urlparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from pipeline_batch import queue_batch_request
+from pipeline_images import generate_key_point_images
+from providers import create_provider
+from provider_limits import HIGH, RateLimitedClient, new_usage, story_slots
+from pipeline_narration import synthesize_narration, align_timestamps
+from pipeline_transcription import file_sha256, preprocess_and_transcribe, save_audio_metrics, transcription_cache_key
+from result_cache import cached_text
+from model_routing import route_request, routed_chat_content
+from sentiment_lexicon import label_for_score, sentiment_score
+
+# The OpenAI client, or a local fake / replay backend (PipelineProvider).
+openai_client = create_provider()
+
+LLM_MODE = os.environ.get("PipelineLlmMode", "separate")
+STRUCTURED_ATTEMPTS = 2
+LEASE_SECONDS = int(os.environ.get("PipelineLeaseSeconds", "60"))
+SENTIMENT_MODE = os.environ.get("PipelineSentimentMode", "llm")
+DEFERRED = "deferred"
+
+SENTIMENT_COLORS = {
+    "positive": ["#91F5AD", "#A8E6CF", "#DCEDC1", "#FFD3B6", "#FFAAA5", "#FF8B94"],
+    "negative": ["#2C3E50", "#34495E", "#7F8C8D", "#95A5A6", "#BDC3C7", "#ECF0F1"],
+    "neutral": ["#F9F9F9", "#E3E3E3", "#CECECE", "#A8A8A8", "#787878", "#5D5D5D"]
+}
+
+def sentiment_colors(sentiment):
+    return SENTIMENT_COLORS.get(sentiment.lower(), SENTIMENT_COLORS["neutral"])
+
+def parse_key_points(keypoints_text):
+    key_points = []
+    for line in keypoints_text.split('\n'):
+        if '|' in line:
+            parts = line.strip().split('|', 1)
+            if len(parts) == 2:
+                try:
+                    timestamp = int(parts[0].strip())
+                    description = parts[1].strip()
+                    key_points.append((timestamp, description))
+                except ValueError:
+                    continue
+    return key_points
+
+def audio_blob_path(story_url):
+    """
+    Blob name of an uploaded story within the audio container: everything in
+    the URL path after the container name (uploads are {user_id}/{story_id}/{file}).
+    """
+    container = os.environ['AudioStorageContainerName']
+    parts = [unquote(part) for part in urlparse(story_url).path.split('/') if part]
+    if container in parts:
+        return '/'.join(parts[parts.index(container) + 1:])
+    return '/'.join(parts[-3:])
+
+def load_story(story_id):
+    """(story_url, title) of a story, or None if it doesn't exist."""
+    conn = pyodbc.connect(os.environ['SqlConnectionString'])
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT story_url, title FROM story WHERE id = ?', story_id)
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+def format_timeline_time(timestamp):
+    return f"00:{timestamp//60:02d}:{timestamp%60:02d}"
+
+def replace_timeline_rows(cursor, table, columns, story_id, rows):
+    """
+    Replace a story's timeline rows with one DELETE and one batched INSERT.
+    Call with everything already computed, so the transaction stays short.
+    """
+    cursor.fast_executemany = True
+    cursor.execute(f'DELETE FROM {table} WHERE story_id = ?', story_id)
+    if rows:
+        placeholders = ", ".join("?" * (len(columns) + 1))
+        cursor.executemany(
+            f'INSERT INTO {table} (story_id, {", ".join(columns)}) VALUES ({placeholders})',
+            [(story_id, *row) for row in rows]
+        )
+
+# Checkpoint store
+
+def state_blob_client(blob_service, story_id):
+    container_client = blob_service.get_container_client(os.environ.get("PipelineStateContainerName", "pipeline-state"))
+    return container_client.get_blob_client(f"{story_id}/state.json")
+
+def load_state(blob_service, story_id):
+    try:
+        data = state_blob_client(blob_service, story_id).download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+    # An empty blob is the placeholder StoryLease creates to have something to lease.
+    return json.loads(data) if data else None
+
+def save_state(blob_service, story_id, state, lease=None):
+    """Write the state; with a StoryLease, only while the lease is still held."""
+    if lease is not None:
+        lease.check()
+    state_blob_client(blob_service, story_id).upload_blob(
+        json.dumps(state, default=str), overwrite=True,
+        content_settings=ContentSettings(content_type="application/json"),
+        lease=lease.lease if lease is not None else None)
+
+class StoryLease:
+    """
+    Exclusive lease on a story's state blob for the length of a run, renewed
+    every third of LEASE_SECONDS by a background thread. State writes made
+    through it fail once another worker could have taken the lease over.
+    """
+
+    def __init__(self, blob_client, lease):
+        self.blob_client = blob_client
+        self.lease = lease
+        self.lost = None
+        self.renewed = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def acquire(cls, blob_service, story_id):
+        """The lease, or None if another worker is processing the story."""
+        blob_client = state_blob_client(blob_service, story_id)
+        try:
+            blob_client.upload_blob(b"", overwrite=False)
+        except HttpResponseError:
+            pass
+        try:
+            lease = blob_client.acquire_lease(lease_duration=LEASE_SECONDS)
+        except ResourceExistsError:
+            return None
+        return cls(blob_client, lease)
+
+    def _renew(self):
+        while not self._stop.wait(LEASE_SECONDS / 3):
+            try:
+                self.lease.renew()
+                self.renewed = time.monotonic()
+            except Exception as e:
+                # A failed renewal is retried on the next tick; the lease is
+                # only given up once it may actually have expired.
+                logging.warning(f"Could not renew lease on {self.blob_client.blob_name}: {str(e)}")
+                if time.monotonic() - self.renewed >= LEASE_SECONDS:
+                    self.lost = e
+                    return
+
+    def check(self):
+        if self.lost is not None:
+            raise RuntimeError(f"Lease on {self.blob_client.blob_name} was lost") from self.lost
+
+    def release(self):
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.lease.release()
+        except Exception as e:
+            logging.warning(f"Could not release lease on {self.blob_client.blob_name}: {str(e)}")
+
+def new_state(story_url, llm_mode=LLM_MODE):
+    return {"story_url": story_url, "llm_mode": llm_mode, "created": datetime.now().isoformat(), "stages": {}, "partial": {}, "completed": None}
+
+# Stages. Each takes the pipeline context and the outputs of earlier stages
+# and returns a JSON-serializable output dict.
+
+def stage_transcribe(ctx, outputs):
+    story_id = ctx["story_id"]
+    story_url = ctx["story_url"]
+    container_client = ctx["blob_service"].get_container_client(os.environ['AudioStorageContainerName'])
+
+    blob_path = audio_blob_path(story_url)
+    audio_path = f"/tmp/{story_id}_{blob_path.split('/')[-1]}"
+
+    blob_client = container_client.get_blob_client(blob_path)
+    try:
+        with open(audio_path, "wb") as f:
+            blob_client.download_blob().readinto(f)
+
+        def transcribe():
+            logging.info(f"Transcribing audio for story {story_id}")
+            return json.dumps(preprocess_and_transcribe(ctx["openai_client"], audio_path))
+
+        transcription = json.loads(cached_text(
+            ctx["blob_service"], "transcription",
+            transcription_cache_key(file_sha256(audio_path)),
+            transcribe, refresh=ctx["refresh_cache"]
+        ))
+    finally:
+        try:
+            os.remove(audio_path)
+        except OSError:
+            pass
+    transcript_text = transcription["text"].strip()
+
+    if not transcript_text:
+        raise ValueError(f"Failed to transcribe audio for story {story_id}")
+
+    conn = pyodbc.connect(os.environ['SqlConnectionString'])
+    try:
+        save_audio_metrics(conn.cursor(), story_id, transcription["audio_metrics"])
+        conn.commit()
+    finally:
+        conn.close()
+    return {
+        "transcript": transcript_text,
+        "transcript_segments": transcription["segments"],
+        "audio_metrics": transcription["audio_metrics"]
+    }
+
+# Chat requests of the text stages, shared with pipeline_async so both
+# implementations send (and cache) exactly the same calls. Model and
+# max_tokens come from the stage's route, see model_routing.
+
+def sentiment_request(transcript):
+    return route_request("sentiment", messages=[
+        {"role": "system", "content": "Classify the emotional tone of a story. Answer only with one word: Positive, Negative, or Neutral."},
+        {"role": "user", "content": transcript}
+    ])
+
+def rewrite_request(transcript, sentiment):
+    return route_request("rewrite", messages=[
+        {"role": "system", "content": f"Rewrite the story to strongly highlight {sentiment} emotions while keeping the core narrative intact. Make it vivid, expressive, and easy to narrate aloud. Keep the story length similar to the original."},
+        {"role": "user", "content": transcript}
+    ])
+
+def key_points_request(story_title, enhanced_script):
+    return route_request("key_points", messages=[
+        {"role": "system", "content": """Extract 8-10 key moments from the story with appropriate timestamps.
+            The script will be narrated, so distribute the timestamps throughout the duration.
+            Format each point as: {timestamp_seconds}|{key_point_description}
+            For example: 30|The protagonist faces their biggest fear
+            Make each key point visually descriptive and meaningful."""},
+        {"role": "user", "content": f"Story title: {story_title}\n\nScript to narrate:\n{enhanced_script}\n\nAssume the narration will take about 3-5 minutes. Distribute timestamps appropriately throughout."}
+    ])
+
+def key_points_fallback_request(enhanced_script):
+    return route_request("key_points_fallback", messages=[
+        {"role": "system", "content": "Extract exactly 8-10 key moments from the story. Each key point must be visually descriptive (max 15 words)."},
+        {"role": "user", "content": enhanced_script}
+    ])
+
+def spread_key_points(points_text):
+    """Key points from an untimed list, evenly distributed over three minutes."""
+    points_list = [p.strip('- 1234567890.').strip() for p in points_text.strip().split('\n') if p.strip()]
+    points_list = [p for p in points_list if p][:10]
+
+    total_points = len(points_list)
+    interval = 180 / (total_points or 1)
+    return [(int(i * interval), points_list[i]) for i in range(total_points)]
+
+def lexicon_sentiment(story_id, transcript):
+    """The sentiment stage's output from the local scorer, with its score."""
+    score = sentiment_score(transcript)
+    sentiment = label_for_score(score)
+    logging.info(f"Lexicon sentiment for story {story_id}: {sentiment} ({score:.2f})")
+    return {"sentiment": sentiment, "sentiment_score": round(score, 3)}
+
+def stage_sentiment(ctx, outputs):
+    if SENTIMENT_MODE == "lexicon":
+        return lexicon_sentiment(ctx["story_id"], outputs["transcript"])
+    logging.info(f"Analyzing sentiment for story {ctx['story_id']}")
+    sentiment = routed_chat_content(
+        ctx["blob_service"], ctx["openai_client"], "sentiment", refresh=ctx["refresh_cache"],
+        **sentiment_request(outputs["transcript"])
+    )
+    return {"sentiment": sentiment.strip()}
+
+def stage_rewrite(ctx, outputs):
+    sentiment = outputs["sentiment"]
+    logging.info(f"Creating enhanced script for story {ctx['story_id']} with sentiment: {sentiment}")
+    enhanced_script = routed_chat_content(
+        ctx["blob_service"], ctx["openai_client"], "rewrite", refresh=ctx["refresh_cache"],
+        **rewrite_request(outputs["transcript"], sentiment)
+    )
+    return {"enhanced_script": enhanced_script.strip()}
+
+def stage_narration(ctx, outputs):
+    story_id = ctx["story_id"]
+    logging.info(f"Generating TTS audio for story {story_id}")
+    gen_audio_blob_name = f"generated/{story_id}_narration.mp3"
+    gen_audio_container = os.environ.get('GeneratedAudioContainerName', os.environ['AudioStorageContainerName'])
+    gen_audio_blob_client = ctx["blob_service"].get_blob_client(container=gen_audio_container, blob=gen_audio_blob_name)
+    narration_chunks = synthesize_narration(
+        ctx["openai_client"], outputs["enhanced_script"], gen_audio_blob_client,
+        blob_service=ctx["blob_service"], refresh_cache=ctx["refresh_cache"]
+    )
+    gen_audio_url = gen_audio_blob_client.url
+
+    conn = pyodbc.connect(os.environ['SqlConnectionString'])
+    try:
+        conn.cursor().execute('UPDATE story SET gen_audio_url = ? WHERE id = ?', gen_audio_url, story_id)
+        conn.commit()
+    finally:
+        conn.close()
+    return narration_output(gen_audio_url, narration_chunks)
+
+def narration_output(gen_audio_url, narration_chunks):
+    narration_seconds = sum(chunk["seconds"] for chunk in narration_chunks)
+    return {"gen_audio_url": gen_audio_url, "narration_seconds": round(narration_seconds, 3), "narration_chunks": narration_chunks}
+
+def stage_key_points(ctx, outputs):
+    story_id = ctx["story_id"]
+    enhanced_script = outputs["enhanced_script"]
+    logging.info(f"Extracting key points for story {story_id}")
+    keypoints_text = routed_chat_content(
+        ctx["blob_service"], ctx["openai_client"], "key_points", refresh=ctx["refresh_cache"],
+        **key_points_request(ctx["story_title"], enhanced_script)
+    )
+    key_points = parse_key_points(keypoints_text.strip())
+
+    if not key_points:
+        logging.warning(f"Failed to parse key points with timestamps, using evenly distributed points")
+        points_text = routed_chat_content(
+            ctx["blob_service"], ctx["openai_client"], "key_points_fallback", refresh=ctx["refresh_cache"],
+            **key_points_fallback_request(enhanced_script)
+        )
+        key_points = spread_key_points(points_text)
+
+    return {"key_points": [list(point) for point in key_points]}
+
+STORY_ANALYSIS_SCHEMA = {
+    "name": "story_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "additionalProperties": False,
+        "required": ["sentiment", "enhanced_script", "key_points"],
+        "properties": {
+            "sentiment": {"type": "string", "enum": ["Positive", "Negative", "Neutral"]},
+            "enhanced_script": {"type": "string"},
+            "key_points": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "additionalProperties": False,
+                    "required": ["timestamp_seconds", "description"],
+                    "properties": {
+                        "timestamp_seconds": {"type": "integer"},
+                        "description": {"type": "string"}
+                    }
+                }
+            }
+        }
+    }
+}
+
+def validate_story_analysis(data):
+    """Check a structured analysis beyond what the schema enforces; raises ValueError."""
+    if not isinstance(data, dict) or set(data) != {"sentiment", "enhanced_script", "key_points"}:
+        raise ValueError("analysis must have exactly sentiment, enhanced_script and key_points")
+    if data["sentiment"] not in ("Positive", "Negative", "Neutral"):
+        raise ValueError(f"invalid sentiment {data['sentiment']!r}")
+    if not isinstance(data["enhanced_script"], str) or not data["enhanced_script"].strip():
+        raise ValueError("enhanced_script is empty")
+    points = data["key_points"]
+    if not isinstance(points, list) or not 1 <= len(points) <= 12:
+        raise ValueError(f"expected 1-12 key points, got {len(points) if isinstance(points, list) else points!r}")
+    key_points = []
+    for point in points:
+        timestamp = point.get("timestamp_seconds") if isinstance(point, dict) else None
+        description = point.get("description") if isinstance(point, dict) else None
+        if not isinstance(timestamp, int) or isinstance(timestamp, bool) or timestamp < 0:
+            raise ValueError(f"invalid timestamp {timestamp!r}")
+        if not isinstance(description, str) or not description.strip():
+            raise ValueError("key point description is empty")
+        key_points.append([timestamp, description.strip()])
+    key_points.sort(key=lambda point: point[0])
+    return {
+        "sentiment": data["sentiment"],
+        "enhanced_script": data["enhanced_script"].strip(),
+        "key_points": key_points
+    }
+
+def story_analysis_request(story_title, transcript):
+    """Chat completion request for the structured analysis, as sent directly or in a batch."""
+    messages = [
+        {"role": "system", "content": """You prepare a recorded story for narration. Return:
+        - sentiment: the emotional tone of the original story (Positive, Negative or Neutral).
+        - enhanced_script: the story rewritten to strongly highlight that emotion while keeping the core narrative intact. Make it vivid, expressive, and easy to narrate aloud. Keep the story length similar to the original.
+        - key_points: 8-10 key moments of the enhanced script, in order, each visually descriptive (max 15 words), with a timestamp in seconds distributed over a 3-5 minute narration."""},
+        {"role": "user", "content": f"Story title: {story_title}\n\nStory:\n{transcript}"}
+    ]
+    return route_request("analysis", messages=messages, response_format={"type": "json_schema", "json_schema": STORY_ANALYSIS_SCHEMA})
+
+def analysis_attempt(story_id, content, attempt):
+    """The validated analysis, or None to ask again; raises after the last attempt."""
+    try:
+        return validate_story_analysis(json.loads(content))
+    except (ValueError, TypeError) as e:
+        logging.warning(f"Story {story_id}: invalid structured analysis (attempt {attempt + 1}): {str(e)}")
+        if attempt + 1 == STRUCTURED_ATTEMPTS:
+            raise ValueError(f"Structured analysis failed validation for story {story_id}: {str(e)}")
+
+def stage_analysis(ctx, outputs):
+    story_id = ctx["story_id"]
+    logging.info(f"Analyzing story {story_id} with one structured call")
+    request = story_analysis_request(ctx["story_title"], outputs["transcript"])
+    for attempt in range(STRUCTURED_ATTEMPTS):
+        # A retry bypasses the cache so an invalid cached answer gets replaced.
+        content = routed_chat_content(
+            ctx["blob_service"], ctx["openai_client"], "analysis", refresh=ctx["refresh_cache"] or attempt > 0,
+            **request
+        )
+        analysis = analysis_attempt(story_id, content, attempt)
+        if analysis is not None:
+            return analysis
+
+def image_checkpoints(state):
+    """
+    The state's checkpoint dict of finished images, and the images that
+    already succeeded on an earlier delivery by index, to be reused.
+    """
+    partial = state.setdefault("partial", {}).setdefault("images", {})
+    return partial, {int(idx): result for idx, result in partial.items() if "error" not in result}
+
+def stage_images(ctx, outputs):
+    story_id = ctx["story_id"]
+    key_points = [tuple(point) for point in outputs["key_points"]]
+    logging.info(f"Generating {len(key_points)} images for key points")
+    images_container_client = ctx["blob_service"].get_container_client(os.environ.get('StoryImagesContainerName', 'storyimages'))
+
+    partial, completed = image_checkpoints(ctx["state"])
+
+    def checkpoint_image(idx, result):
+        if "error" in result:
+            return
+        with ctx["state_lock"]:
+            partial[str(idx)] = result
+            save_state(ctx["blob_service"], story_id, ctx["state"], ctx["lease"])
+
+    image_results = generate_key_point_images(
+        ctx["openai_client"], images_container_client, story_id, key_points, outputs["sentiment"],
+        completed=completed, on_result=checkpoint_image,
+        blob_service=ctx["blob_service"], refresh_cache=ctx["refresh_cache"])
+    with ctx["state_lock"]:
+        ctx["state"]["partial"].pop("images", None)
+    return {"images": image_results}
+
+def timeline_rows(outputs):
+    """(time, color, image_url) story_timeline_events rows for the images that succeeded."""
+    colors = sentiment_colors(outputs["sentiment"])
+    # Key-point times were guessed before the narration existed.
+    timestamps = align_timestamps([image_result["timestamp"] for image_result in outputs["images"]], outputs.get("narration_seconds", 0))
+
+    rows = []
+    for idx, image_result in enumerate(outputs["images"]):
+        if "error" in image_result:
+            continue
+        rows.append((format_timeline_time(timestamps[idx]), colors[idx % len(colors)], image_result["image_url"]))
+    return rows
+
+def stage_timeline(ctx, outputs):
+    story_id = ctx["story_id"]
+    rows = timeline_rows(outputs)
+
+    conn = pyodbc.connect(os.environ['SqlConnectionString'])
+    try:
+        replace_timeline_rows(conn.cursor(), "story_timeline_events", ("time", "color", "image_url"), story_id, rows)
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info(f"Wrote {len(rows)} timeline events for story {story_id}")
+    return {"timeline_events": len(rows)}
+
+# name -> (stage function, names of the stages whose outputs it needs)
+SEPARATE_STAGES = {
+    "transcribe": (stage_transcribe, []),
+    "sentiment": (stage_sentiment, ["transcribe"]),
+    "rewrite": (stage_rewrite, ["transcribe", "sentiment"]),
+    "narration": (stage_narration, ["rewrite"]),
+    "key_points": (stage_key_points, ["rewrite"]),
+    "images": (stage_images, ["sentiment", "key_points"]),
+    "timeline": (stage_timeline, ["sentiment", "narration", "images"]),
+}
+
+STRUCTURED_STAGES = {
+    "transcribe": (stage_transcribe, []),
+    "analysis": (stage_analysis, ["transcribe"]),
+    "narration": (stage_narration, ["analysis"]),
+    "images": (stage_images, ["analysis"]),
+    "timeline": (stage_timeline, ["analysis", "narration", "images"]),
+}
+
+def stages_for_mode(mode):
+    return STRUCTURED_STAGES if mode == "structured" else SEPARATE_STAGES
+
+STAGE_CONCURRENCY = int(os.environ.get("PipelineStageConcurrency", "3"))
+
+def downstream_stages(stages, names):
+    """`names` plus every stage that depends on one of them, directly or through others."""
+    selected = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for name, (_, dependencies) in stages.items():
+            if name not in selected and selected.intersection(dependencies):
+                selected.add(name)
+                changed = True
+    return selected
+
+def critical_path(timings, stages):
+    """
+    Walk back from the last stage to finish, at each step following the
+    dependency that finished last, i.e. the one the stage was waiting on.
+    Returns (stage names in order, seconds spent on that path).
+    """
+    if not timings:
+        return [], 0.0
+    name = max(timings, key=lambda n: timings[n]["finished"])
+    path = [name]
+    while stages[name][1]:
+        name = max(stages[name][1], key=lambda n: timings[n]["finished"])
+        path.append(name)
+    path.reverse()
+    return path, sum(timings[n]["finished"] - timings[n]["started"] for n in path)
+
+def stage_inputs(stages, name, outputs):
+    inputs = {}
+    for dependency in stages[name][1]:
+        inputs.update(outputs[dependency])
+    return inputs
+
+def reused_stages(ctx, stages):
+    """(outputs, timings) of the stages already checkpointed in the state."""
+    outputs = {}
+    timings = {}
+    for name, checkpoint in ctx["state"]["stages"].items():
+        if name in stages:
+            logging.info(f"Story {ctx['story_id']}: reusing checkpointed stage '{name}'")
+            outputs[name] = checkpoint["output"]
+            timings[name] = {"started": 0.0, "finished": 0.0, "reused": True}
+    return outputs, timings
+
+def ready_stages(stages, outputs, running):
+    """Stages not done or running yet whose dependencies are all done."""
+    return [
+        name for name, (_, dependencies) in stages.items()
+        if name not in outputs and name not in running and all(dependency in outputs for dependency in dependencies)
+    ]
+
+def stage_failed(ctx, name, error):
+    # Nothing new is started, but stages already running are still
+    # checkpointed so the retry doesn't redo them.
+    logging.error(f"Story {ctx['story_id']}: stage '{name}' failed: {str(error)}")
+    ctx["failed_stage"] = ctx.get("failed_stage") or name
+
+def checkpoint_stage(ctx, outputs, timings, name, output, started, finished):
+    """Record a finished stage in the run and the state; the caller saves the state."""
+    outputs[name] = output
+    timings[name] = {"started": started, "finished": finished, "reused": False}
+    ctx["state"]["stages"][name] = {"output": output, "completed": datetime.now().isoformat(), "seconds": round(finished - started, 3)}
+
+def run_stages(ctx, stages):
+    """
+    Run every stage of the DAG that isn't checkpointed yet, each as soon as its
+    dependencies are done. Returns per-stage timings, in seconds relative to the
+    start of the run.
+    """
+    outputs, timings = reused_stages(ctx, stages)
+    run_start = time.monotonic()
+
+    def run_one(name):
+        ctx["lease"].check()
+        started = time.monotonic() - run_start
+        output = stages[name][0](ctx, stage_inputs(stages, name, outputs))
+        return output, started, time.monotonic() - run_start
+
+    running = {}
+    failure = None
+    with ThreadPoolExecutor(max_workers=max(STAGE_CONCURRENCY, 1)) as executor:
+        while True:
+            if failure is None:
+                for name in ready_stages(stages, outputs, running.values()):
+                    running[executor.submit(run_one, name)] = name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    output, started, finished = future.result()
+                except Exception as e:
+                    stage_failed(ctx, name, e)
+                    failure = failure or e
+                    continue
+                with ctx["state_lock"]:
+                    checkpoint_stage(ctx, outputs, timings, name, output, started, finished)
+                    save_state(ctx["blob_service"], ctx["story_id"], ctx["state"], ctx["lease"])
+    if failure is not None:
+        raise failure
+    return timings
+
+def apply_deferred_analysis(blob_service, story_id, content):
+    """
+    Checkpoint a batch answer as the story's analysis stage. Returns None if
+    the story is busy (try again later), else whether the answer was valid;
+    if it wasn't, the resumed run makes the analysis call itself.
+    """
+    lease = StoryLease.acquire(blob_service, story_id)
+    if lease is None:
+        return None
+    try:
+        state = load_state(blob_service, story_id)
+        if state is None:
+            return False
+        state.pop("deferred", None)
+        applied = False
+        if content is not None:
+            try:
+                output = validate_story_analysis(json.loads(content))
+                state["stages"]["analysis"] = {"output": output, "completed": datetime.now().isoformat(), "seconds": 0.0}
+                applied = True
+            except (ValueError, TypeError) as e:
+                logging.warning(f"Story {story_id}: invalid batch analysis: {str(e)}")
+        save_state(blob_service, story_id, state, lease)
+        return applied
+    finally:
+        lease.release()
+
+def _report(report, **values):
+    if report is not None:
+        report.update(values)
+
+def run_story_pipeline(story_id, force=False, lane=HIGH, rerun=None, refresh=False, usage=None, llm_mode=None, deferred=None, report=None):
+    """
+    Run (or resume) the pipeline for a story. Returns False if the story doesn't
+    exist. Raises on stage failure so the queue redelivers the message; the next
+    attempt resumes after the last completed stage. `lane` is the priority lane
+    (provider_limits.HIGH or LOW) the story's slot and provider calls use. If
+    another worker holds the story's lease, returns at once without doing anything.
+
+    `rerun` names stages to run again, with everything downstream of them, even
+    if the story was already processed. `force` discards all checkpoints but
+    still reuses cached results; only `refresh` bypasses result cache lookups.
+    Provider usage is counted into `usage` if given (provider_limits.new_usage).
+
+    `llm_mode` overrides PipelineLlmMode. With `deferred` (structured mode only)
+    the analysis request is queued for the next batch instead of being made
+    here, and the run stops after transcription, returning DEFERRED;
+    `deferred` is the message to put back on the backfill queue once the
+    batch answer has been checkpointed.
+
+    `report`, if given, is filled in with the outcome ("status": processed,
+    already_processed, deferred, busy or not_found; "failed_stage" on error)
+    and, for a processed story, its per-stage timings, critical path and usage.
+    """
+    story_data = load_story(story_id)
+    if not story_data:
+        logging.error(f"Story {story_id} not found in database")
+        _report(report, status="not_found")
+        return False
+
+    blob_service = BlobServiceClient.from_connection_string(os.environ['AzureBlobStorageConnectionString'])
+
+    lease = StoryLease.acquire(blob_service, story_id)
+    if lease is None:
+        logging.warning(f"Story {story_id} is already being processed by another worker, skipping duplicate delivery")
+        _report(report, status="busy")
+        return True
+    try:
+        return _run_leased(story_id, story_data, blob_service, lease, force, lane, rerun, refresh, usage, llm_mode or LLM_MODE, deferred, report)
+    finally:
+        lease.release()
+
+def resumable_state(state, story_id, story_url, llm_mode, stages, rerun=None):
+    """
+    The checkpointed state to resume from, or None to start over because the
+    story's audio or LLM mode changed since. The `rerun` stages and everything
+    downstream of them are dropped from it.
+    """
+    if state is None:
+        return None
+    if state.get("story_url") != story_url:
+        logging.info(f"Story {story_id} audio changed since last run, starting over")
+        return None
+    if state.get("llm_mode", "separate") != llm_mode:
+        logging.info(f"Story {story_id} was checkpointed in {state.get('llm_mode', 'separate')} mode, starting over in {llm_mode} mode")
+        return None
+    if rerun:
+        invalidated = downstream_stages(stages, rerun)
+        logging.info(f"Story {story_id}: re-running stages {', '.join(sorted(invalidated))}")
+        for name in invalidated:
+            state["stages"].pop(name, None)
+            state["partial"].pop(name, None)
+        state["completed"] = None
+        state.pop("deferred", None)
+    return state
+
+def starting_state(saved, story_id, story_url, llm_mode, stages, rerun=None):
+    """The resumable state from `saved` (None when forced), else a new one."""
+    state = resumable_state(saved, story_id, story_url, llm_mode, stages, rerun)
+    return state if state is not None else new_state(story_url, llm_mode)
+
+def stage_context(story_id, story_data, blob_service, state, state_lock, lease, openai_client, refresh):
+    """The `ctx` every stage function is called with, in either pipeline."""
+    return {
+        "story_id": story_id,
+        "story_url": story_data[0],
+        "story_title": story_data[1],
+        "blob_service": blob_service,
+        "state": state,
+        "state_lock": state_lock,
+        "lease": lease,
+        "refresh_cache": refresh,
+        "openai_client": openai_client
+    }
+
+def complete_state(state, timings, stages, usage):
+    """Mark the state completed, with the run's timings, critical path and usage; returns the report values."""
+    path, path_seconds = critical_path(timings, stages)
+    total_seconds = max(t["finished"] for t in timings.values())
+    state["completed"] = datetime.now().isoformat()
+    state["timings"] = {name: {**t, "started": round(t["started"], 3), "finished": round(t["finished"], 3)} for name, t in timings.items()}
+    state["critical_path"] = {"stages": path, "seconds": round(path_seconds, 3), "wall_seconds": round(total_seconds, 3)}
+    state["usage"] = usage
+    return {
+        "status": "processed", "timings": state["timings"], "critical_path": state["critical_path"], "usage": usage,
+        "outputs": {name: checkpoint["output"] for name, checkpoint in state["stages"].items() if name in ("narration", "images", "timeline")}
+    }
+
+def _run_leased(story_id, story_data, blob_service, lease, force, lane, rerun, refresh, usage, llm_mode, deferred, report):
+    story_url = story_data[0]
+    stages = stages_for_mode(llm_mode)
+    state = starting_state(None if force else load_state(blob_service, story_id), story_id, story_url, llm_mode, stages, rerun)
+    if state.get("completed"):
+        logging.info(f"Story {story_id} was already processed at {state['completed']}, nothing to do")
+        _report(report, status="already_processed", completed=state["completed"])
+        return True
+    if deferred is not None and state.get("deferred"):
+        logging.info(f"Story {story_id} is waiting for its batch since {state['deferred']}, nothing to do")
+        _report(report, status=DEFERRED)
+        return DEFERRED
+    if deferred is None:
+        state.pop("deferred", None)
+
+    ctx = stage_context(
+        story_id, story_data, blob_service, state, threading.Lock(), lease,
+        RateLimitedClient(openai_client, lane, usage if usage is not None else new_usage()), refresh
+    )
+    if deferred is not None and "analysis" not in state["stages"]:
+        _report(report, status=DEFERRED)
+        return _defer_analysis(ctx, stages, lane, deferred)
+    try:
+        with story_slots.hold(lane):
+            timings = run_stages(ctx, stages)
+    except Exception:
+        _report(report, status="failed", failed_stage=ctx.get("failed_stage"))
+        raise
+    result = complete_state(state, timings, stages, ctx["openai_client"].usage)
+    save_state(blob_service, story_id, state, lease)
+    _report(report, **result)
+    path = state["critical_path"]
+    logging.info(f"Successfully processed story {story_id} in {path['wall_seconds']:.1f}s; critical path: {' -> '.join(path['stages'])} ({path['seconds']:.1f}s)")
+    return True
+
+def _defer_analysis(ctx, stages, lane, resume_message):
+    """Run the stages before analysis, then queue the analysis request for the next batch."""
+    story_id = ctx["story_id"]
+    state = ctx["state"]
+    upstream = {name: stage for name, stage in stages.items() if name not in downstream_stages(stages, ["analysis"])}
+    with story_slots.hold(lane):
+        run_stages(ctx, upstream)
+
+    transcript = state["stages"]["transcribe"]["output"]["transcript"]
+    queue_batch_request(story_id, story_analysis_request(ctx["story_title"], transcript), resume_message)
+    state["deferred"] = datetime.now().isoformat()
+    state["usage"] = ctx["openai_client"].usage
+    save_state(ctx["blob_service"], story_id, state, ctx["lease"])
+    logging.info(f"Story {story_id}: analysis queued for the next batch")
+    return DEFERRED
@@ -0,0 +1,239 @@
+# Whisper transcription for story recordings of any length.
+#
+# Short recordings go to Whisper in one call. Long ones (or files over the
+# upload limit) are cut at silences near every TranscriptionChunkSeconds,
+# transcribed in parallel and stitched back together with segment times
+# shifted by each chunk's offset. Chunks are decoded from the source file one
+# window at a time and exported as compact mono mp3, so memory and /tmp usage
+# are bounded by the chunk size and concurrency rather than the story length.
+#
+# Before any of that, preprocess_audio re-encodes the raw upload with ffmpeg:
+# mono, 16 kHz (all Whisper uses), leading/trailing silence cut, and a low
+# bitrate speech codec, which typically shrinks phone recordings several-fold.
+
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+import ffmpeg
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from pydub import AudioSegment
+from pydub.silence import detect_silence
+from pydub.utils import mediainfo
+from result_cache import audio_cache_key
+
+WHISPER_MODEL = "whisper-1"
+WHISPER_MAX_BYTES = int(os.environ.get("WhisperMaxUploadBytes", str(24 * 1024 * 1024)))
+CHUNK_SECONDS = int(os.environ.get("TranscriptionChunkSeconds", "120"))
+TRANSCRIPTION_CONCURRENCY = int(os.environ.get("TranscriptionConcurrency", "4"))
+SILENCE_SEARCH_SECONDS = 15
+MIN_SILENCE_MS = 400
+CHUNK_FORMAT = "mp3"
+CHUNK_BITRATE = "48k"
+PREPROCESS_CODEC = os.environ.get("AudioPreprocessCodec", "opus")
+SILENCE_TRIM_DB = os.environ.get("AudioSilenceTrimThreshold", "-45dB")
+SILENCE_TRIM_MIN_SECONDS = 0.3
+PREPROCESS_FORMATS = {
+    "opus": {"extension": "ogg", "acodec": "libopus", "audio_bitrate": "24k"},
+    "mp3": {"extension": "mp3", "acodec": "libmp3lame", "audio_bitrate": "32k"},
+}
+
+def transcription_cache_key(audio_sha256):
+    """Result cache key of a transcription, by the audio's hash and how it was preprocessed."""
+    return audio_cache_key(audio_sha256, f"{WHISPER_MODEL}/segments/{PREPROCESS_CODEC}")
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def probe_duration(path):
+    return float(mediainfo(path)["duration"])
+
+def _load_window(path, start, duration):
+    segment = AudioSegment.from_file(path, start_second=start, duration=duration)
+    return segment.set_channels(1).set_frame_rate(16000)
+
+def detect_speech_bounds(path, duration):
+    """
+    (start, end) in seconds of the audio between leading and trailing silence,
+    from one decoding pass through ffmpeg's silencedetect filter.
+    """
+    _, stderr = (
+        ffmpeg
+        .input(path)
+        .filter("silencedetect", n=SILENCE_TRIM_DB, d=SILENCE_TRIM_MIN_SECONDS)
+        .output("-", format="null", ac=1, ar=16000)
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    log = stderr.decode("utf-8", errors="ignore")
+    starts = [float(v) for v in re.findall(r"silence_start: (-?[\d.]+)", log)]
+    ends = [float(v) for v in re.findall(r"silence_end: ([\d.]+)", log)]
+
+    # Some ffmpeg versions don't close a silence that runs to the end of the file.
+    silences = list(zip(starts, ends + [duration] * (len(starts) - len(ends))))
+
+    start, end = 0.0, duration
+    if silences and silences[0][0] <= 0.05:
+        start = silences[0][1]
+    if silences and silences[-1][1] >= duration - 0.05 and silences[-1][0] > start:
+        end = silences[-1][0]
+    if end - start < 1.0:
+        return 0.0, duration
+    return start, end
+
+def preprocess_audio(source_path):
+    """
+    Re-encode a raw upload for transcription. Returns (path, metrics); the
+    caller removes the file. metrics["offset_seconds"] is how much leading
+    silence was cut, i.e. what to add to times in the processed audio.
+    """
+    started = time.perf_counter()
+    duration = probe_duration(source_path)
+    speech_start, speech_end = detect_speech_bounds(source_path, duration)
+
+    output_format = PREPROCESS_FORMATS.get(PREPROCESS_CODEC, PREPROCESS_FORMATS["opus"])
+    output_path = f"/tmp/pre_{uuid.uuid4().hex}.{output_format['extension']}"
+    (
+        ffmpeg
+        .input(source_path, ss=speech_start, t=speech_end - speech_start)
+        .output(output_path, ac=1, ar=16000, vn=None, acodec=output_format["acodec"], audio_bitrate=output_format["audio_bitrate"])
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+    metrics = {
+        "original_bytes": os.path.getsize(source_path),
+        "processed_bytes": os.path.getsize(output_path),
+        "original_seconds": round(duration, 2),
+        "processed_seconds": round(speech_end - speech_start, 2),
+        "offset_seconds": round(speech_start, 3),
+        "preprocess_ms": int((time.perf_counter() - started) * 1000)
+    }
+    logging.info(
+        f"Preprocessed audio: {metrics['original_bytes']} -> {metrics['processed_bytes']} bytes, "
+        f"{metrics['original_seconds']}s -> {metrics['processed_seconds']}s in {metrics['preprocess_ms']}ms"
+    )
+    return output_path, metrics
+
+def find_split_points(path, duration):
+    """
+    Pick a cut near every CHUNK_SECONDS: the middle of the silence closest to
+    the target within +/- SILENCE_SEARCH_SECONDS, or the target itself if the
+    window has no silence.
+    """
+    splits = []
+    target = CHUNK_SECONDS
+    while target < duration - CHUNK_SECONDS / 2:
+        window_start = max(target - SILENCE_SEARCH_SECONDS, splits[-1] + 1 if splits else 0)
+        window_duration = min(target + SILENCE_SEARCH_SECONDS, duration) - window_start
+        window = _load_window(path, window_start, window_duration)
+        silences = detect_silence(window, min_silence_len=MIN_SILENCE_MS, silence_thresh=max(window.dBFS - 16, -70), seek_step=10)
+        if silences:
+            midpoints = [window_start + (s + e) / 2000 for s, e in silences]
+            split = min(midpoints, key=lambda m: abs(m - target))
+        else:
+            split = target
+        splits.append(round(split, 3))
+        target = split + CHUNK_SECONDS
+    return splits
+
+def _segment_value(segment, name):
+    return segment[name] if isinstance(segment, dict) else getattr(segment, name)
+
+def transcription_segments(transcription, offset=0.0):
+    """[[start, end, text], ...] of a verbose_json transcription, times shifted by `offset`."""
+    return [
+        [round(offset + _segment_value(s, "start"), 2), round(offset + _segment_value(s, "end"), 2), _segment_value(s, "text").strip()]
+        for s in (getattr(transcription, "segments", None) or [])
+    ]
+
+def _transcribe_file(openai_client, path, offset=0.0):
+    with open(path, "rb") as f:
+        transcription = openai_client.audio.transcriptions.create(
+            model=WHISPER_MODEL,
+            file=f,
+            response_format="verbose_json"
+        )
+    return transcription.text.strip(), transcription_segments(transcription, offset)
+
+def export_chunk(source_path, start, end):
+    """Cut start-end seconds out of the source as a compact mono mp3; the caller removes the file."""
+    chunk_path = f"/tmp/chunk_{uuid.uuid4().hex}.{CHUNK_FORMAT}"
+    _load_window(source_path, start, end - start).export(chunk_path, format=CHUNK_FORMAT, bitrate=CHUNK_BITRATE)
+    return chunk_path
+
+def fits_one_request(size, duration):
+    return size <= WHISPER_MAX_BYTES and duration <= CHUNK_SECONDS * 1.5
+
+def _transcribe_chunk(openai_client, source_path, start, end, offset):
+    chunk_path = export_chunk(source_path, start, end)
+    try:
+        return _transcribe_file(openai_client, chunk_path, offset=offset + start)
+    finally:
+        try:
+            os.remove(chunk_path)
+        except OSError:
+            pass
+
+def transcribe_audio(openai_client, audio_path, offset=0.0):
+    """
+    Transcribe a local audio file. Returns {"text": ..., "segments": [[start, end, text], ...]}
+    with segment times in seconds from the start of the recording; `offset` is
+    added to every time, e.g. the silence preprocess_audio trimmed.
+    """
+    size = os.path.getsize(audio_path)
+    duration = probe_duration(audio_path)
+    if fits_one_request(size, duration):
+        text, segments = _transcribe_file(openai_client, audio_path, offset=offset)
+        return {"text": text, "segments": segments}
+
+    splits = find_split_points(audio_path, duration)
+    bounds = list(zip([0.0] + splits, splits + [duration]))
+    logging.info(f"Transcribing {duration:.0f}s of audio ({size} bytes) in {len(bounds)} chunks")
+
+    with ThreadPoolExecutor(max_workers=max(TRANSCRIPTION_CONCURRENCY, 1)) as executor:
+        results = list(executor.map(lambda b: _transcribe_chunk(openai_client, audio_path, b[0], b[1], offset), bounds))
+
+    return {
+        "text": " ".join(text for text, _ in results if text),
+        "segments": [segment for _, segments in results for segment in segments]
+    }
+
+def preprocess_and_transcribe(openai_client, source_path):
+    """transcribe_audio on the preprocessed file, plus its size/latency metrics under "audio_metrics"."""
+    processed_path, metrics = preprocess_audio(source_path)
+    try:
+        started = time.perf_counter()
+        transcription = transcribe_audio(openai_client, processed_path, offset=metrics["offset_seconds"])
+        metrics["transcribe_ms"] = int((time.perf_counter() - started) * 1000)
+    finally:
+        try:
+            os.remove(processed_path)
+        except OSError:
+            pass
+    transcription["audio_metrics"] = metrics
+    return transcription
+
+def save_audio_metrics(cursor, story_id, metrics):
+    now = datetime.now()
+    values = (
+        metrics["original_bytes"], metrics["processed_bytes"], metrics["original_seconds"],
+        metrics["processed_seconds"], metrics["preprocess_ms"], metrics["transcribe_ms"], now
+    )
+    cursor.execute('''
+        UPDATE story_audio_metrics SET original_bytes = ?, processed_bytes = ?, original_seconds = ?,
+            processed_seconds = ?, preprocess_ms = ?, transcribe_ms = ?, updated = ?
+        WHERE story_id = ?
+    ''', *values, story_id)
+    if cursor.rowcount == 0:
+        cursor.execute('''
+            INSERT INTO story_audio_metrics (original_bytes, processed_bytes, original_seconds,
+                processed_seconds, preprocess_ms, transcribe_ms, updated, story_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', *values, story_id)
@@ -0,0 +1,285 @@
+# Shared model-provider limits for concurrently processed stories.
+#
+# One instance can run several stories at once (PipelineMaxConcurrentStories;
+# the queue trigger's batchSize in host.json and PYTHON_THREADPOOL_THREAD_COUNT
+# must allow at least that many). Their provider calls share per-provider
+# token buckets for requests and, for chat, tokens per minute, so a burst of
+# stories queues up locally instead of tripping the provider's own 429s.
+#
+# Two priority lanes: "high" for fresh uploads and "low" for backfills. The
+# low lane may use only part of the story slots and must leave a reserve in
+# every bucket, so a new upload never waits behind a backfill.
+#
+# The client wrapper also counts what each story used, for the rough cost
+# estimates backfill runs report.
+#
+# pipeline_async uses the same buckets through acquire_async and
+# AsyncRateLimitedClient, which wait with asyncio.sleep instead of blocking
+# the event loop, and holds its stories' slots in async_story_slots.
+
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from types import SimpleNamespace
+
+HIGH = "high"
+LOW = "low"
+
+MAX_CONCURRENT_STORIES = int(os.environ.get("PipelineMaxConcurrentStories", "4"))
+LOW_LANE_STORY_SLOTS = int(os.environ.get("PipelineBackfillStorySlots", str(max(MAX_CONCURRENT_STORIES - 1, 1))))
+LOW_LANE_RESERVE = float(os.environ.get("ProviderLowPriorityReserve", "0.25"))
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def _take(self, amount, lane):
+        """Take `amount` units and return None, or return how long to wait before trying again. Hold the condition."""
+        amount = min(float(amount), self.capacity)
+        floor = self.capacity * LOW_LANE_RESERVE if lane == LOW else 0.0
+        self._refill()
+        if self.available - amount >= floor:
+            self.available -= amount
+            return None
+        wait = (amount + floor - self.available) * 60.0 / self.capacity
+        return min(max(wait, 0.05), 5.0)
+
+    def acquire(self, amount, lane=HIGH):
+        """Block until `amount` units can be taken; the low lane must leave LOW_LANE_RESERVE of capacity."""
+        with self.condition:
+            while True:
+                wait = self._take(amount, lane)
+                if wait is None:
+                    return
+                self.condition.wait(timeout=wait)
+
+    async def acquire_async(self, amount, lane=HIGH):
+        """acquire() for coroutines: sleeps on the event loop rather than blocking it."""
+        while True:
+            with self.condition:
+                wait = self._take(amount, lane)
+            if wait is None:
+                return
+            await asyncio.sleep(wait)
+
+def _limit(name, default):
+    value = int(os.environ.get(name, str(default)))
+    return TokenBucket(value) if value > 0 else None
+
+# Defaults roughly match a low OpenAI usage tier; set a limit to 0 to disable it.
+BUCKETS = {
+    "whisper": {"requests": _limit("WhisperRequestsPerMinute", 50)},
+    "chat": {"requests": _limit("ChatRequestsPerMinute", 500), "tokens": _limit("ChatTokensPerMinute", 150000)},
+    "tts": {"requests": _limit("TtsRequestsPerMinute", 50)},
+    "images": {"requests": _limit("ImageRequestsPerMinute", 7)},
+}
+
+# Approximate list prices in USD, only used for reporting. Whisper is billed
+# per audio minute; with chunks of about two minutes a request is a fair unit.
+PRICES = {
+    "chat_per_1k_tokens": 0.01,
+    "tts_per_1k_chars": 0.015,
+    "image": 0.04,
+    "whisper_per_request": 0.012,
+    "batch_discount": 0.5,
+    **json.loads(os.environ.get("ProviderPricesJson", "{}"))
+}
+
+_usage_lock = threading.Lock()
+
+def new_usage():
+    return {"requests": {provider: 0 for provider in BUCKETS}, "chat_tokens": 0, "tts_chars": 0, "routes": {}}
+
+def record_route(usage, stage, model, seconds, fallbacks=0):
+    """Count a routed chat call of `stage` (see model_routing): its latency, fallbacks and the model that answered."""
+    if usage is None:
+        return
+    with _usage_lock:
+        route = usage["routes"].setdefault(stage, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "fallbacks": 0, "models": {}})
+        route["calls"] += 1
+        route["seconds"] = round(route["seconds"] + seconds, 3)
+        route["max_seconds"] = round(max(route["max_seconds"], seconds), 3)
+        route["fallbacks"] += fallbacks
+        route["models"][model] = route["models"].get(model, 0) + 1
+
+def estimate_cost(usage):
+    return round(
+        usage["chat_tokens"] / 1000 * PRICES["chat_per_1k_tokens"]
+        + usage["tts_chars"] / 1000 * PRICES["tts_per_1k_chars"]
+        + usage["requests"]["images"] * PRICES["image"]
+        + usage["requests"]["whisper"] * PRICES["whisper_per_request"], 4)
+
+def acquire(provider, lane=HIGH, tokens=0):
+    buckets = BUCKETS[provider]
+    if buckets.get("requests"):
+        buckets["requests"].acquire(1, lane)
+    if tokens and buckets.get("tokens"):
+        buckets["tokens"].acquire(tokens, lane)
+
+async def acquire_async(provider, lane=HIGH, tokens=0):
+    buckets = BUCKETS[provider]
+    if buckets.get("requests"):
+        await buckets["requests"].acquire_async(1, lane)
+    if tokens and buckets.get("tokens"):
+        await buckets["tokens"].acquire_async(tokens, lane)
+
+def estimate_chat_tokens(request):
+    """Prompt tokens at ~4 characters each plus the completion budget."""
+    return len(json.dumps(request.get("messages", []))) // 4 + int(request.get("max_tokens") or 0)
+
+class _StorySlots:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = {HIGH: 0, LOW: 0}
+
+    @contextmanager
+    def hold(self, lane):
+        with self.condition:
+            while (sum(self.active.values()) >= MAX_CONCURRENT_STORIES
+                   or (lane == LOW and self.active[LOW] >= LOW_LANE_STORY_SLOTS)):
+                self.condition.wait()
+            self.active[lane] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[lane] -= 1
+                self.condition.notify_all()
+
+story_slots = _StorySlots()
+
+class _AsyncStorySlots:
+    """_StorySlots for stories running as tasks on one event loop."""
+
+    def __init__(self):
+        self.loop = None
+        self.condition = None
+        self.active = {HIGH: 0, LOW: 0}
+
+    @asynccontextmanager
+    async def hold(self, lane):
+        # asyncio primitives belong to one loop; a new loop gets a new condition.
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop, self.condition = loop, asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: sum(self.active.values()) < MAX_CONCURRENT_STORIES
+                and (lane != LOW or self.active[LOW] < LOW_LANE_STORY_SLOTS)
+            )
+            self.active[lane] += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.active[lane] -= 1
+                self.condition.notify_all()
+
+async_story_slots = _AsyncStorySlots()
+
+class RateLimitedClient:
+    """
+    Wraps an OpenAI client so the calls the pipeline makes wait for the
+    provider's buckets in this client's lane first. Calls are counted into
+    `usage` (see new_usage).
+    """
+
+    def __init__(self, client, lane=HIGH, usage=None):
+        self._client = client
+        self.lane = lane
+        self.usage = usage if usage is not None else new_usage()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.audio = SimpleNamespace(
+            transcriptions=SimpleNamespace(create=self._transcription),
+            speech=SimpleNamespace(
+                create=self._speech,
+                with_streaming_response=SimpleNamespace(create=self._speech_streaming)
+            )
+        )
+        self.images = SimpleNamespace(generate=self._images)
+
+    def with_options(self, **options):
+        return RateLimitedClient(self._client.with_options(**options), self.lane, self.usage)
+
+    def _count(self, provider, **amounts):
+        with _usage_lock:
+            self.usage["requests"][provider] += 1
+            for name, amount in amounts.items():
+                self.usage[name] += amount
+
+    def _chat(self, **request):
+        estimate = estimate_chat_tokens(request)
+        acquire("chat", self.lane, estimate)
+        response = self._client.chat.completions.create(**request)
+        usage = getattr(response, "usage", None)
+        self._count("chat", chat_tokens=getattr(usage, "total_tokens", None) or estimate)
+        return response
+
+    def _transcription(self, **request):
+        acquire("whisper", self.lane)
+        self._count("whisper")
+        return self._client.audio.transcriptions.create(**request)
+
+    def _speech(self, **request):
+        acquire("tts", self.lane)
+        self._count("tts", tts_chars=len(request.get("input", "")))
+        return self._client.audio.speech.create(**request)
+
+    def _speech_streaming(self, **request):
+        acquire("tts", self.lane)
+        self._count("tts", tts_chars=len(request.get("input", "")))
+        return self._client.audio.speech.with_streaming_response.create(**request)
+
+    def _images(self, **request):
+        acquire("images", self.lane)
+        self._count("images")
+        return self._client.images.generate(**request)
+
+class AsyncRateLimitedClient(RateLimitedClient):
+    """RateLimitedClient for an AsyncOpenAI client: the same calls, awaited."""
+
+    def with_options(self, **options):
+        return AsyncRateLimitedClient(self._client.with_options(**options), self.lane, self.usage)
+
+    async def _chat(self, **request):
+        estimate = estimate_chat_tokens(request)
+        await acquire_async("chat", self.lane, estimate)
+        response = await self._client.chat.completions.create(**request)
+        usage = getattr(response, "usage", None)
+        self._count("chat", chat_tokens=getattr(usage, "total_tokens", None) or estimate)
+        return response
+
+    async def _transcription(self, **request):
+        await acquire_async("whisper", self.lane)
+        self._count("whisper")
+        return await self._client.audio.transcriptions.create(**request)
+
+    async def _speech(self, **request):
+        await acquire_async("tts", self.lane)
+        self._count("tts", tts_chars=len(request.get("input", "")))
+        return await self._client.audio.speech.create(**request)
+
+    @asynccontextmanager
+    async def _speech_streaming(self, **request):
+        await acquire_async("tts", self.lane)
+        self._count("tts", tts_chars=len(request.get("input", "")))
+        async with self._client.audio.speech.with_streaming_response.create(**request) as response:
+            yield response
+
+    async def _images(self, **request):
+        await acquire_async("images", self.lane)
+        self._count("images")
+        return await self._client.images.generate(**request)
@@ -0,0 +1,487 @@
+# Model provider backends for the story pipeline.
+#
+# The pipeline only uses this part of the OpenAI client:
+# chat.completions.create, audio.transcriptions.create,
+# audio.speech(.with_streaming_response).create, images.generate,
+# files / batches and with_options. Every backend offers the same methods,
+# so any of them can stand in for the OpenAI client. PipelineProvider
+# picks the backend:
+#
+#   openai  the OpenAI client (default)
+#   fake    deterministic local answers with configurable latency, error
+#           injection and malformed key-point answers, no network; for
+#           offline load tests and the benchmarks
+#   record  the OpenAI client, saving every response under ProviderRecordDir
+#   replay  serves the responses saved by record, no network
+#
+# The fake and replayed image URLs can't be fetched, so run those backends
+# with ImageTransferMode=b64. Batches are not recorded.
+#
+# create_async_provider gives the same choice for pipeline_async: AsyncOpenAI
+# or AsyncFakeProvider. Recording and replaying are only done by the threaded
+# pipeline, and neither async backend runs batches.
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from openai import AsyncOpenAI, OpenAI, InternalServerError, RateLimitError
+from result_cache import cache_key
+
+PROVIDER = os.environ.get("PipelineProvider", "openai")
+RECORD_DIR = os.environ.get("ProviderRecordDir", "provider-recordings")
+FAKE_LATENCY_SECONDS = float(os.environ.get("FakeProviderLatencySeconds", "0.05"))
+FAKE_SECONDS_PER_1K_TOKENS = float(os.environ.get("FakeProviderSecondsPer1kTokens", "0.2"))
+FAKE_ERROR_RATE = float(os.environ.get("FakeProviderErrorRate", "0"))
+FAKE_SEED = os.environ.get("FakeProviderSeed", "7")
+FAKE_MALFORMED_RATE = float(os.environ.get("FakeProviderMalformedRate", "0"))
+FAKE_BATCH_POLLS = int(os.environ.get("FakeProviderBatchPolls", "0"))
+STREAM_PIECE_BYTES = 16 * 1024
+
+def create_provider(name=PROVIDER):
+    if name == "fake":
+        return FakeProvider()
+    if name == "replay":
+        return RecordReplayProvider(None)
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    if name == "record":
+        return RecordReplayProvider(client)
+    return client
+
+def create_async_provider(name=PROVIDER):
+    if name == "fake":
+        return AsyncFakeProvider()
+    if name in ("record", "replay"):
+        raise ValueError(f"PipelineProvider={name} is not supported by the async pipeline")
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Response objects shaped like the OpenAI client's
+
+def _chat_response(content, total_tokens):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))],
+        usage=SimpleNamespace(total_tokens=total_tokens)
+    )
+
+def _transcription_response(text, segments):
+    return SimpleNamespace(text=text, segments=[dict(segment) for segment in segments])
+
+def _image_response(url=None, b64_json=None):
+    return SimpleNamespace(data=[SimpleNamespace(url=url, b64_json=b64_json, revised_prompt=None)])
+
+class _SpeechResponse:
+    """Streaming or plain speech response over a function returning an iterator of byte pieces."""
+
+    def __init__(self, pieces):
+        self._pieces = pieces
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_bytes(self, chunk_size=None):
+        buffer = bytearray()
+        for piece in self._pieces():
+            if not chunk_size:
+                yield piece
+                continue
+            buffer += piece
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+        if buffer:
+            yield bytes(buffer)
+
+    @property
+    def content(self):
+        return b"".join(self._pieces())
+
+def _request_file_sha256(request):
+    f = request["file"]
+    data = f[1] if isinstance(f, tuple) else f
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray)):
+        digest.update(data)
+    else:
+        position = data.tell()
+        for block in iter(lambda: data.read(1024 * 1024), b""):
+            digest.update(block)
+        data.seek(position)
+    return digest.hexdigest()
+
+def _request_key(kind, request):
+    if kind == "transcription":
+        request = {**{k: v for k, v in request.items() if k != "file"}, "file_sha256": _request_file_sha256(request)}
+    return cache_key(kind, request)
+
+# Fake backend
+
+# MPEG-2 Layer III, 32 kbps, 24 kHz, mono: 96 bytes and 24 ms per frame.
+_FAKE_FRAME = bytes([0xFF, 0xF3, 0x44, 0xC0]) + bytes(92)
+_FAKE_FRAME_SECONDS = 576 / 24000
+_FAKE_CHARS_PER_SECOND = 15
+
+def _fake_png(seed):
+    """A small solid-colour PNG, the colour derived from `seed`."""
+    r, g, b = hashlib.sha256(seed.encode("utf-8")).digest()[:3]
+    size = 64
+    raw = b"".join(b"\x00" + bytes([r, g, b]) * size for _ in range(size))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+def _fake_http_response(status_code, headers=None):
+    """Just what the client's error types read from a response."""
+    return SimpleNamespace(status_code=status_code, headers=headers or {}, request=None)
+
+def _fake_tokens(text):
+    return max(1, len(text) // 4)
+
+class FakeProvider:
+    """
+    Answers locally and deterministically: the same request gives the same
+    answer. Each call sleeps latency_seconds plus seconds_per_1k_tokens per
+    thousand output tokens. error_rate of calls raise a rate limit or server
+    error, decided per request and attempt, so retries can succeed.
+    malformed_rate of timestamped key-point requests get an answer without
+    parseable timestamps, like real model drift. A batch stays in progress
+    for its first batch_polls retrieve calls; its lines are answered without
+    latency or errors. api_requests counts every request made.
+    """
+
+    def __init__(self, latency_seconds=FAKE_LATENCY_SECONDS, seconds_per_1k_tokens=FAKE_SECONDS_PER_1K_TOKENS, error_rate=FAKE_ERROR_RATE, seed=FAKE_SEED,
+                 malformed_rate=FAKE_MALFORMED_RATE, batch_polls=FAKE_BATCH_POLLS):
+        self.latency_seconds = latency_seconds
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+        self.error_rate = error_rate
+        self.seed = seed
+        self.malformed_rate = malformed_rate
+        self.batch_polls = batch_polls
+        self.calls = {}
+        self.errors = 0
+        self.api_requests = 0
+        self._lock = threading.Lock()
+        self._files = {}
+        self._batches = {}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.audio = SimpleNamespace(
+            transcriptions=SimpleNamespace(create=self._transcription),
+            speech=SimpleNamespace(
+                create=self._speech,
+                with_streaming_response=SimpleNamespace(create=self._speech)
+            )
+        )
+        self.images = SimpleNamespace(generate=self._images)
+        self.files = SimpleNamespace(create=self._file_create, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._batch_create, retrieve=self._batch_retrieve)
+
+    def with_options(self, **options):
+        return self
+
+    def _call(self, kind, request, output_tokens=0):
+        """Count the call, maybe inject an error, then sleep the simulated latency. Returns the request key."""
+        key, delay = self._start_call(kind, request, output_tokens)
+        time.sleep(delay)
+        return key
+
+    def _start_call(self, kind, request, output_tokens):
+        """_call without the sleep: returns the request key and the latency to simulate."""
+        key = _request_key(kind, request)
+        with self._lock:
+            attempt = self.calls.get(key, 0)
+            self.calls[key] = attempt + 1
+            self.api_requests += 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        if rng.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            if rng.random() < 0.5:
+                raise RateLimitError("Fake rate limit", response=_fake_http_response(429, {"retry-after": "1"}), body=None)
+            raise InternalServerError("Fake server error", response=_fake_http_response(500), body=None)
+        return key, self.latency_seconds + output_tokens / 1000 * self.seconds_per_1k_tokens
+
+    def _chat_content(self, request):
+        messages = request["messages"]
+        system = messages[0]["content"]
+        user = messages[-1]["content"]
+        sentences = [s.strip() for s in user.replace("\n", " ").split(".") if s.strip()] or ["The story begins"]
+        points = [(i * 20, f"{sentences[i % len(sentences)][:60]}, shown in bright colour") for i in range(9)]
+        if request.get("response_format") is not None:
+            return json.dumps({
+                "sentiment": "Positive",
+                "enhanced_script": ". ".join(f"Vividly, {s}" for s in sentences) + ".",
+                "key_points": [{"timestamp_seconds": t, "description": d} for t, d in points]
+            })
+        if "Classify the emotional tone" in system:
+            return "Positive"
+        if "Rewrite the story" in system:
+            return ". ".join(f"Vividly, {s}" for s in sentences) + "."
+        if "{timestamp_seconds}|" in system:
+            if random.Random(f"{self.seed}:malformed:{_request_key('chat', request)}").random() < self.malformed_rate:
+                return "\n".join(f"{i + 1}. {d} (around {t}s)" for i, (t, d) in enumerate(points))
+            return "\n".join(f"{t}|{d}" for t, d in points)
+        return "\n".join(f"- {d}" for _, d in points)
+
+    def _chat(self, **request):
+        content = self._chat_content(request)
+        self._call("chat", request, _fake_tokens(content))
+        return self._chat_answer(request, content)
+
+    def _chat_answer(self, request, content):
+        prompt_tokens = sum(_fake_tokens(m["content"]) for m in request["messages"])
+        return _chat_response(content, prompt_tokens + _fake_tokens(content))
+
+    def _transcription(self, **request):
+        return self._transcription_answer(self._call("transcription", request, 200))
+
+    def _transcription_answer(self, key):
+        n_segments = 3 + int(key[:4], 16) % 10
+        segments = [
+            {"start": i * 5.0, "end": i * 5.0 + 4.5, "text": f" Spoken sentence {i + 1} of the recording."}
+            for i in range(n_segments)
+        ]
+        return _transcription_response("".join(s["text"] for s in segments).strip(), segments)
+
+    def _speech(self, **request):
+        self._call("speech", request)
+        return _SpeechResponse(self._speech_pieces(request))
+
+    def _speech_pieces(self, request):
+        frame_count = int(len(request.get("input", "")) / _FAKE_CHARS_PER_SECOND / _FAKE_FRAME_SECONDS)
+        frames_per_piece = STREAM_PIECE_BYTES // len(_FAKE_FRAME)
+
+        def pieces():
+            for start in range(0, frame_count, frames_per_piece):
+                yield _FAKE_FRAME * min(frames_per_piece, frame_count - start)
+
+        return pieces
+
+    def _images(self, **request):
+        return self._image_answer(self._call("images", request), request)
+
+    def _image_answer(self, key, request):
+        if request.get("response_format") == "b64_json":
+            return _image_response(b64_json=base64.b64encode(_fake_png(key)).decode("ascii"))
+        return _image_response(url=f"https://fake-provider.invalid/images/{key}.png")
+
+    def _file_create(self, file, purpose):
+        data = file[1] if isinstance(file, tuple) else file
+        data = data.read() if hasattr(data, "read") else data
+        with self._lock:
+            file_id = f"file-fake-{len(self._files) + 1}"
+            self._files[file_id] = data
+            self.api_requests += 1
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        with self._lock:
+            self.api_requests += 1
+        return SimpleNamespace(text=self._files[file_id].decode("utf-8"))
+
+    def _batch_create(self, input_file_id, endpoint, completion_window):
+        lines = []
+        for line in self._files[input_file_id].decode("utf-8").splitlines():
+            item = json.loads(line)
+            response = self._chat_answer(item["body"], self._chat_content(item["body"]))
+            body = {
+                "choices": [{"message": {"role": "assistant", "content": response.choices[0].message.content}}],
+                "usage": {"total_tokens": response.usage.total_tokens}
+            }
+            lines.append(json.dumps({"custom_id": item["custom_id"], "response": {"status_code": 200, "body": body}, "error": None}))
+        with self._lock:
+            file_id = f"file-fake-{len(self._files) + 1}"
+            self._files[file_id] = "\n".join(lines).encode("utf-8")
+            batch_id = f"batch-fake-{len(self._batches) + 1}"
+            self._batches[batch_id] = {"polls": 0, "output_file_id": file_id}
+            self.api_requests += 1
+        return self._batch_status(batch_id)
+
+    def _batch_retrieve(self, batch_id):
+        with self._lock:
+            self._batches[batch_id]["polls"] += 1
+            self.api_requests += 1
+        return self._batch_status(batch_id)
+
+    def _batch_status(self, batch_id):
+        batch = self._batches[batch_id]
+        if batch["polls"] < self.batch_polls:
+            return SimpleNamespace(id=batch_id, status="in_progress", output_file_id=None, error_file_id=None)
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id=batch["output_file_id"], error_file_id=None)
+
+class _AsyncSpeechResponse(_SpeechResponse):
+    """Streaming speech response of AsyncFakeProvider; the latency is awaited on entry."""
+
+    def __init__(self, pieces, start):
+        super().__init__(pieces)
+        self._start = start
+
+    async def __aenter__(self):
+        await self._start()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def iter_bytes(self, chunk_size=None):
+        for piece in super().iter_bytes(chunk_size):
+            yield piece
+
+class AsyncFakeProvider(FakeProvider):
+    """
+    FakeProvider with the AsyncOpenAI client's interface: the same answers and
+    injected errors, the latency awaited with asyncio.sleep. One instance must
+    only be used from one event loop at a time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_async))
+        self.audio = SimpleNamespace(
+            transcriptions=SimpleNamespace(create=self._transcription_async),
+            speech=SimpleNamespace(with_streaming_response=SimpleNamespace(create=self._speech_async))
+        )
+        self.images = SimpleNamespace(generate=self._images_async)
+        self.files = None
+        self.batches = None
+
+    async def _call_async(self, kind, request, output_tokens=0):
+        key, delay = self._start_call(kind, request, output_tokens)
+        await asyncio.sleep(delay)
+        return key
+
+    async def _chat_async(self, **request):
+        content = self._chat_content(request)
+        await self._call_async("chat", request, _fake_tokens(content))
+        return self._chat_answer(request, content)
+
+    async def _transcription_async(self, **request):
+        return self._transcription_answer(await self._call_async("transcription", request, 200))
+
+    def _speech_async(self, **request):
+        return _AsyncSpeechResponse(self._speech_pieces(request), lambda: self._call_async("speech", request))
+
+    async def _images_async(self, **request):
+        return self._image_answer(await self._call_async("images", request), request)
+
+    async def close(self):
+        pass
+
+# Record / replay backend
+
+class RecordReplayProvider:
+    """
+    With a client, forwards every call to it and saves the response under
+    `directory`, keyed by the request; without one, serves saved responses and
+    raises KeyError for a request that was never recorded.
+    """
+
+    def __init__(self, client, directory=RECORD_DIR):
+        self._client = client
+        self.directory = directory
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.audio = SimpleNamespace(
+            transcriptions=SimpleNamespace(create=self._transcription),
+            speech=SimpleNamespace(
+                create=self._speech,
+                with_streaming_response=SimpleNamespace(create=self._speech)
+            )
+        )
+        self.images = SimpleNamespace(generate=self._images)
+        if client is not None:
+            self.files = client.files
+            self.batches = client.batches
+
+    def with_options(self, **options):
+        if self._client is None:
+            return self
+        return RecordReplayProvider(self._client.with_options(**options), self.directory)
+
+    def _path(self, kind, key, extension="json"):
+        return os.path.join(self.directory, kind, f"{key}.{extension}")
+
+    def _load(self, kind, key, extension="json"):
+        path = self._path(kind, key, extension)
+        if not os.path.exists(path):
+            raise KeyError(f"No recorded {kind} response for request {key}")
+        with open(path, "rb") as f:
+            data = f.read()
+        return json.loads(data) if extension == "json" else data
+
+    def _save(self, kind, key, value):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name so a concurrent replay never reads half a file.
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(value, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _chat(self, **request):
+        key = _request_key("chat", request)
+        if self._client is None:
+            saved = self._load("chat", key)
+            return _chat_response(saved["content"], saved["total_tokens"])
+        response = self._client.chat.completions.create(**request)
+        usage = getattr(response, "usage", None)
+        self._save("chat", key, {"content": response.choices[0].message.content, "total_tokens": getattr(usage, "total_tokens", 0)})
+        return response
+
+    def _transcription(self, **request):
+        key = _request_key("transcription", request)
+        if self._client is None:
+            saved = self._load("transcription", key)
+            return _transcription_response(saved["text"], saved["segments"])
+        response = self._client.audio.transcriptions.create(**request)
+        segments = [
+            {name: (s[name] if isinstance(s, dict) else getattr(s, name)) for name in ("start", "end", "text")}
+            for s in (getattr(response, "segments", None) or [])
+        ]
+        self._save("transcription", key, {"text": response.text, "segments": segments})
+        return response
+
+    def _speech(self, **request):
+        key = _request_key("speech", request)
+        if self._client is None:
+            path = self._path("speech", key, "mp3")
+            if not os.path.exists(path):
+                raise KeyError(f"No recorded speech response for request {key}")
+
+            def replayed():
+                with open(path, "rb") as f:
+                    yield from iter(lambda: f.read(STREAM_PIECE_BYTES), b"")
+
+            return _SpeechResponse(replayed)
+
+        path = self._path("speech", key, "mp3")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        def recorded():
+            with self._client.audio.speech.with_streaming_response.create(**request) as response:
+                with open(f"{path}.tmp", "wb") as f:
+                    for piece in response.iter_bytes(STREAM_PIECE_BYTES):
+                        f.write(piece)
+                        yield piece
+            os.replace(f"{path}.tmp", path)
+
+        return _SpeechResponse(recorded)
+
+    def _images(self, **request):
+        key = _request_key("images", request)
+        if self._client is None:
+            saved = self._load("images", key)
+            return _image_response(saved["url"], saved["b64_json"])
+        response = self._client.images.generate(**request)
+        image = response.data[0]
+        self._save("images", key, {"url": image.url, "b64_json": image.b64_json})
+        return response
@@ -0,0 +1,206 @@
+# Content-addressed cache for pipeline results.
+#
+# Whisper transcripts, chat completions, TTS audio and generated images are
+# stored in blob storage under a key derived from their inputs: the audio
+# bytes' hash, or the full request (model, prompt, parameters and input
+# text). Editing a prompt therefore changes the key on its own. The
+# result_cache table indexes the blobs by size and last use so the eviction
+# job can drop entries by age and keep the total under a size budget.
+#
+# The cache is best effort: any failure reading or writing it is logged and
+# the result is computed as if it were a miss.
+
+import hashlib
+import json
+import logging
+import os
+import pyodbc
+from datetime import datetime, timedelta
+from azure.storage.blob import ContentSettings
+from azure.core.exceptions import ResourceNotFoundError
+from blob_streaming import block_id, rechunk, read_url
+
+CACHE_CONTAINER = os.environ.get("ResultCacheContainerName", "result-cache")
+CACHE_ENABLED = os.environ.get("ResultCacheEnabled", "true").lower() == "true"
+MAX_AGE_DAYS = int(os.environ.get("ResultCacheMaxAgeDays", "30"))
+MAX_TOTAL_BYTES = int(os.environ.get("ResultCacheMaxBytes", str(5 * 1024 ** 3)))
+
+def cache_key(kind, *parts):
+    """sha256 over the kind and a canonical JSON encoding of the inputs."""
+    payload = json.dumps([kind, *parts], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def audio_cache_key(audio_sha256, model):
+    return cache_key("transcription", model, audio_sha256)
+
+def chat_cache_key(request):
+    return cache_key("chat", request)
+
+def cache_blob_client(blob_service, key):
+    return blob_service.get_blob_client(container=CACHE_CONTAINER, blob=f"{key[:2]}/{key}")
+
+def _index_execute(sql, *params):
+    conn = pyodbc.connect(os.environ["SqlConnectionString"])
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, *params)
+        rowcount = cursor.rowcount
+        conn.commit()
+        return rowcount
+    finally:
+        conn.close()
+
+def touch_cache_entry(key):
+    """Mark an entry as just used, so eviction keeps it; best effort."""
+    try:
+        _index_execute('UPDATE result_cache SET last_used = ? WHERE cache_key = ?', datetime.now(), key)
+    except Exception as e:
+        logging.warning(f"Could not touch result cache entry {key}: {str(e)}")
+
+def get_cached(blob_service, key):
+    try:
+        data = cache_blob_client(blob_service, key).download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+    touch_cache_entry(key)
+    return data
+
+def index_cache_entry(key, kind, size_bytes):
+    now = datetime.now()
+    if _index_execute('UPDATE result_cache SET size_bytes = ?, last_used = ? WHERE cache_key = ?', size_bytes, now, key) == 0:
+        _index_execute(
+            'INSERT INTO result_cache (cache_key, kind, size_bytes, created, last_used) VALUES (?, ?, ?, ?, ?)',
+            key, kind, size_bytes, now, now
+        )
+
+def put_cached(blob_service, key, kind, data, content_type):
+    cache_blob_client(blob_service, key).upload_blob(data, overwrite=True, content_settings=ContentSettings(content_type=content_type))
+    index_cache_entry(key, kind, len(data))
+
+def cached_bytes(blob_service, kind, key, compute, content_type, refresh=False):
+    """
+    Return the cached bytes for `key`, or call `compute()` and cache its result.
+    `refresh` skips the lookup but still stores the new result.
+    """
+    if CACHE_ENABLED and not refresh:
+        try:
+            data = get_cached(blob_service, key)
+            if data is not None:
+                logging.info(f"Result cache hit for {kind} {key[:12]}")
+                return data
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed for {kind} {key[:12]}: {str(e)}")
+
+    data = compute()
+    if CACHE_ENABLED:
+        try:
+            put_cached(blob_service, key, kind, data, content_type)
+        except Exception as e:
+            logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+    return data
+
+def cached_stream(blob_service, kind, key, open_stream, content_type, refresh=False):
+    """
+    Streaming counterpart of cached_bytes: yields the cached blob in blocks, or
+    the blocks of `open_stream()` while staging them into the cache blob, so
+    neither path holds the whole result in memory.
+    """
+    if CACHE_ENABLED and not refresh:
+        downloader = None
+        try:
+            downloader = cache_blob_client(blob_service, key).download_blob()
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed for {kind} {key[:12]}: {str(e)}")
+        if downloader is not None:
+            logging.info(f"Result cache hit for {kind} {key[:12]}")
+            touch_cache_entry(key)
+            yield from downloader.chunks()
+            return
+
+    cache_blob = cache_blob_client(blob_service, key) if CACHE_ENABLED else None
+    block_ids = []
+    size_bytes = 0
+    for block in rechunk(open_stream()):
+        yield block
+        size_bytes += len(block)
+        if cache_blob is not None:
+            try:
+                block_ids.append(block_id(len(block_ids)))
+                cache_blob.stage_block(block_ids[-1], block)
+            except Exception as e:
+                logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+                cache_blob = None
+    if cache_blob is not None:
+        try:
+            cache_blob.commit_block_list(block_ids, content_settings=ContentSettings(content_type=content_type))
+            index_cache_entry(key, kind, size_bytes)
+        except Exception as e:
+            logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+
+def cached_copy(blob_service, kind, key, dest_blob_client, produce, content_type, refresh=False):
+    """
+    Server-side counterpart of cached_bytes for results that end up in a blob:
+    a hit is copied from the cache blob into `dest_blob_client`; on a miss
+    `produce(dest_blob_client)` fills it and it is copied into the cache. The
+    bytes never pass through this process.
+    """
+    cache_blob = cache_blob_client(blob_service, key)
+    if CACHE_ENABLED and not refresh:
+        try:
+            dest_blob_client.upload_blob_from_url(read_url(cache_blob), overwrite=True, content_settings=ContentSettings(content_type=content_type))
+            logging.info(f"Result cache hit for {kind} {key[:12]}")
+            touch_cache_entry(key)
+            return
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Result cache lookup failed for {kind} {key[:12]}: {str(e)}")
+
+    produce(dest_blob_client)
+    if CACHE_ENABLED:
+        try:
+            cache_blob.upload_blob_from_url(read_url(dest_blob_client), overwrite=True, content_settings=ContentSettings(content_type=content_type))
+            index_cache_entry(key, kind, dest_blob_client.get_blob_properties().size)
+        except Exception as e:
+            logging.warning(f"Could not store {kind} {key[:12]} in result cache: {str(e)}")
+
+def cached_text(blob_service, kind, key, compute, refresh=False):
+    return cached_bytes(
+        blob_service, kind, key, lambda: compute().encode("utf-8"),
+        "text/plain; charset=utf-8", refresh=refresh
+    ).decode("utf-8")
+
+def cached_chat_content(blob_service, openai_client, kind, refresh=False, **request):
+    """Message content of a chat completion, keyed by the complete request."""
+    def compute():
+        response = openai_client.chat.completions.create(**request)
+        if getattr(response, "usage", None) is not None:
+            logging.info(f"{kind} chat call used {response.usage.total_tokens} tokens")
+        return response.choices[0].message.content
+
+    return cached_text(blob_service, kind, chat_cache_key(request), compute, refresh=refresh)
+
+def evict_result_cache(cursor, blob_service):
+    """Drop entries unused for MAX_AGE_DAYS, then least recently used ones until under MAX_TOTAL_BYTES."""
+    cursor.execute('SELECT cache_key, size_bytes, last_used FROM result_cache ORDER BY last_used DESC')
+    rows = cursor.fetchall()
+
+    cutoff = datetime.now() - timedelta(days=MAX_AGE_DAYS)
+    keep_bytes = 0
+    evicted = []
+    for key, size_bytes, last_used in rows:
+        if last_used < cutoff or keep_bytes + size_bytes > MAX_TOTAL_BYTES:
+            evicted.append(key)
+        else:
+            keep_bytes += size_bytes
+
+    for key in evicted:
+        try:
+            cache_blob_client(blob_service, key).delete_blob()
+        except ResourceNotFoundError:
+            pass
+        cursor.execute('DELETE FROM result_cache WHERE cache_key = ?', key)
+    logging.info(f"Evicted {len(evicted)} result cache entries, {keep_bytes} bytes kept")
+    return len(evicted)
@@ -0,0 +1,134 @@
+# Local sentiment classifier for story transcripts.
+#
+# The pipeline's sentiment only picks the timeline palette and the adjective
+# in the rewrite prompt, so with PipelineSentimentMode=lexicon it comes from
+# this scorer instead of a gpt-4-turbo call over the whole transcript. Words
+# are looked up in a small weighted lexicon; a negator ("not", "never",
+# "didn't", ...) flips and damps the next few words within its clause, and an
+# intensifier ("very", "so", ...) boosts the word after it. Scoring is a few
+# NumPy array operations over the token ids; a 3,000-word transcript takes
+# about 2 ms.
+#
+# agreement() compares labels with the LLM's, see
+# benchmarks/bench_sentiment_agreement.py.
+
+import os
+import re
+import numpy as np
+
+LABELS = ("Positive", "Negative", "Neutral")
+THRESHOLD = float(os.environ.get("SentimentLexiconThreshold", "0.15"))
+NEGATION_WINDOW = 3
+NEGATION_FACTOR = -0.75
+INTENSIFIER_FACTOR = 1.5
+# Added to the total weight, so a handful of hits in a long story stays near 0.
+SMOOTHING = 4.0
+
+_POSITIVE = {
+    2.0: "love loved loving wonderful amazing fantastic beautiful joy joyful happiest delighted thrilled brilliant "
+         "incredible perfect excellent blessed grateful thankful proud triumph celebrate celebrated hero heroes "
+         "adore adored magical miracle",
+    1.0: "happy glad good great nice fun funny laugh laughed laughing smile smiled smiling hope hopeful kind kindness "
+         "friend friends friendship warm gentle calm peace peaceful safe success successful win won winning enjoy "
+         "enjoyed together help helped helping care cared caring brave courage sweet lucky relief relieved free "
+         "freedom excited exciting cheer cheerful gift hug hugged comfort comfortable bright best better beauty "
+         "dream dreams reunited reunion surprise treasure welcome welcomed",
+}
+_NEGATIVE = {
+    2.0: "hate hated terrible horrible awful devastated tragedy tragic grief death died dead kill killed murder "
+         "terrified horror nightmare miserable heartbroken despair abused torture cruel betrayed",
+    1.0: "sad sadness cry cried crying tears afraid fear feared scared angry anger mad upset hurt hurting pain "
+         "painful lost lose losing alone lonely worry worried anxious bad worse worst sick ill fail failed failure "
+         "problem trouble fight fought danger dangerous dark broke broken sorry regret shame ashamed guilty "
+         "disappointed boring bored tired hungry poor wrong stress stressed panic accident injured wound wounded "
+         "funeral goodbye missed miss suffer suffered storm",
+}
+_NEGATORS = {"not", "no", "never", "nothing", "nobody", "none", "neither", "nor", "without", "hardly", "barely", "cannot"}
+_INTENSIFIERS = {"very", "so", "really", "extremely", "truly", "incredibly", "totally", "absolutely", "deeply", "completely"}
+
+_TOKEN = re.compile(r"[a-z]+(?:'[a-z]+)?|[.!?;:]")
+_CLAUSE_END = {".", "!", "?", ";", ":"}
+
+def _build_vocabulary():
+    """Token ids: 0 any other word, 1 clause end, 2 negator, 3 intensifier, then one id per lexicon word."""
+    vocab = {token: 1 for token in _CLAUSE_END}
+    vocab.update({token: 2 for token in _NEGATORS})
+    vocab.update({token: 3 for token in _INTENSIFIERS})
+    weights = [0.0, 0.0, 0.0, 0.0]
+    for lexicon, sign in ((_POSITIVE, 1.0), (_NEGATIVE, -1.0)):
+        for weight, words in lexicon.items():
+            for word in words.split():
+                vocab[word] = len(weights)
+                weights.append(sign * weight)
+    return vocab, np.array(weights)
+
+_VOCAB, WEIGHTS = _build_vocabulary()
+
+def _token_ids(text):
+    ids = []
+    for token in _TOKEN.findall(text.lower().replace("\u2019", "'")):
+        if token.endswith("n't"):
+            ids.append(2)
+        else:
+            ids.append(_VOCAB.get(token, 0))
+    return np.array(ids, dtype=np.int64)
+
+def sentiment_score(text):
+    """Score in (-1, 1): the net sentiment weight relative to all the weight found."""
+    ids = _token_ids(text)
+    if ids.size == 0:
+        return 0.0
+    positions = np.arange(ids.size)
+    weights = WEIGHTS[ids]
+
+    # Position of the last negator / clause end at or before each token.
+    last_negator = np.maximum.accumulate(np.where(ids == 2, positions, -1))
+    last_clause_end = np.maximum.accumulate(np.where(ids == 1, positions, -1))
+    # The word right after a negator is one position later, hence the shift.
+    prior_negator = np.concatenate(([-1], last_negator[:-1]))
+    negated = (prior_negator >= 0) & (positions - prior_negator <= NEGATION_WINDOW) & (prior_negator > last_clause_end)
+    weights = np.where(negated, weights * NEGATION_FACTOR, weights)
+
+    intensified = np.concatenate(([False], ids[:-1] == 3))
+    weights = np.where(intensified, weights * INTENSIFIER_FACTOR, weights)
+
+    return float(weights.sum() / (np.abs(weights).sum() + SMOOTHING))
+
+def label_for_score(score, threshold=THRESHOLD):
+    """Positive, Negative or Neutral, as the LLM sentiment call answers."""
+    if score >= threshold:
+        return "Positive"
+    if score <= -threshold:
+        return "Negative"
+    return "Neutral"
+
+def classify_sentiment(text, threshold=THRESHOLD):
+    return label_for_score(sentiment_score(text), threshold)
+
+def agreement(expected, predicted, labels=LABELS):
+    """
+    How well `predicted` labels match `expected` (e.g. the LLM's): accuracy,
+    Cohen's kappa, per-label precision and recall, and the confusion matrix
+    (rows expected, columns predicted, in `labels` order).
+    """
+    index = {label: i for i, label in enumerate(labels)}
+    expected_ids = np.array([index[label] for label in expected])
+    predicted_ids = np.array([index[label] for label in predicted])
+    confusion = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    np.add.at(confusion, (expected_ids, predicted_ids), 1)
+
+    total = confusion.sum()
+    observed = np.trace(confusion) / total if total else 0.0
+    chance = (confusion.sum(axis=1) @ confusion.sum(axis=0)) / total ** 2 if total else 0.0
+    kappa = (observed - chance) / (1 - chance) if chance < 1 else 1.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        precision = np.diag(confusion) / confusion.sum(axis=0)
+        recall = np.diag(confusion) / confusion.sum(axis=1)
+    return {
+        "count": int(total),
+        "accuracy": round(float(observed), 3),
+        "kappa": round(float(kappa), 3),
+        "precision": {label: None if np.isnan(precision[i]) else round(float(precision[i]), 3) for i, label in enumerate(labels)},
+        "recall": {label: None if np.isnan(recall[i]) else round(float(recall[i]), 3) for i, label in enumerate(labels)},
+        "confusion": confusion.tolist()
+    }
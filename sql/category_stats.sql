@@ -0,0 +1,18 @@
+-- Precomputed per-category counts read by the category endpoints.
+-- story_count is incremented by upload_story; recent_listens / recent_likes
+-- (21-day window) are incremented by the story listen and like endpoints.
+-- The 15-minute refresh_category_stats_job recomputes all three, which ages
+-- activity out of the window and picks up story status changes (made
+-- directly in the database, no endpoint changes them). The trending tracker
+-- keeps its own decayed counts in blob storage and doesn't write here.
+
+CREATE TABLE category_stats (
+    category_id INT NOT NULL PRIMARY KEY,
+    story_count INT NOT NULL DEFAULT 0,
+    recent_listens INT NOT NULL DEFAULT 0,
+    recent_likes INT NOT NULL DEFAULT 0,
+    updated DATETIME NOT NULL,
+    CONSTRAINT fk_category_stats_category FOREIGN KEY (category_id) REFERENCES category(id)
+);
+
+CREATE INDEX ix_category_stats_story_count ON category_stats (story_count DESC);
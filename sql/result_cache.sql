@@ -0,0 +1,14 @@
+-- Index of the content-addressed pipeline result cache (result_cache.py).
+-- Each row is one blob in the result-cache container, named by its key.
+-- last_used drives age- and size-based eviction by the evict_result_cache
+-- timer job.
+
+CREATE TABLE result_cache (
+    cache_key CHAR(64) NOT NULL PRIMARY KEY,
+    kind NVARCHAR(32) NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    created DATETIME NOT NULL,
+    last_used DATETIME NOT NULL
+);
+
+CREATE INDEX ix_result_cache_last_used ON result_cache (last_used DESC);
@@ -0,0 +1,17 @@
+-- Per-story audio preprocessing results, written by the pipeline's
+-- transcribe stage. Compare original_bytes / processed_bytes and
+-- original_seconds / processed_seconds to see what preprocessing saves
+-- in upload size and transcribed audio; transcribe_ms is the Whisper
+-- time on the processed file.
+
+CREATE TABLE story_audio_metrics (
+    story_id INT NOT NULL PRIMARY KEY,
+    original_bytes BIGINT NOT NULL,
+    processed_bytes BIGINT NOT NULL,
+    original_seconds FLOAT NOT NULL,
+    processed_seconds FLOAT NOT NULL,
+    preprocess_ms INT NOT NULL,
+    transcribe_ms INT NOT NULL,
+    updated DATETIME NOT NULL,
+    CONSTRAINT fk_story_audio_metrics_story FOREIGN KEY (story_id) REFERENCES story(id)
+);
@@ -0,0 +1,30 @@
+-- Bulk reprocessing runs started with POST /story/backfill
+-- (pipeline_backfill.py). One item per selected story; the backfill queue
+-- trigger moves it from queued to running to done or failed and records
+-- how long it took and its estimated provider cost.
+
+CREATE TABLE story_backfill_runs (
+    id INT IDENTITY(1,1) NOT NULL PRIMARY KEY,
+    created DATETIME NOT NULL,
+    filters NVARCHAR(MAX) NOT NULL,
+    stages NVARCHAR(400) NOT NULL,
+    rate_per_minute FLOAT NOT NULL,
+    story_count INT NOT NULL
+);
+
+CREATE TABLE story_backfill_items (
+    run_id INT NOT NULL,
+    story_id INT NOT NULL,
+    status NVARCHAR(16) NOT NULL,
+    attempts INT NOT NULL,
+    started DATETIME NULL,
+    finished DATETIME NULL,
+    seconds FLOAT NULL,
+    cost_usd DECIMAL(10, 4) NULL,
+    error NVARCHAR(1000) NULL,
+    CONSTRAINT pk_story_backfill_items PRIMARY KEY (run_id, story_id),
+    CONSTRAINT fk_story_backfill_items_run FOREIGN KEY (run_id) REFERENCES story_backfill_runs(id),
+    CONSTRAINT fk_story_backfill_items_story FOREIGN KEY (story_id) REFERENCES story(id)
+);
+
+CREATE INDEX ix_story_backfill_items_status ON story_backfill_items (run_id, status);
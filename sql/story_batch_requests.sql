@@ -0,0 +1,22 @@
+-- Analysis requests of deferred pipeline runs waiting for, or sent in, an
+-- OpenAI batch (pipeline_batch.py). The process_deferred_batches timer job
+-- submits pending rows as one batch and, once the batch has finished,
+-- checkpoints each answer and sends resume_message to the backfill queue.
+
+CREATE TABLE story_batch_requests (
+    id INT IDENTITY(1,1) NOT NULL PRIMARY KEY,
+    story_id INT NOT NULL,
+    custom_id NVARCHAR(64) NOT NULL,
+    request NVARCHAR(MAX) NOT NULL,
+    resume_message NVARCHAR(MAX) NOT NULL,
+    status NVARCHAR(16) NOT NULL,
+    batch_id NVARCHAR(64) NULL,
+    error NVARCHAR(1000) NULL,
+    created DATETIME NOT NULL,
+    updated DATETIME NOT NULL,
+    CONSTRAINT uq_story_batch_requests_custom_id UNIQUE (custom_id),
+    CONSTRAINT fk_story_batch_requests_story FOREIGN KEY (story_id) REFERENCES story(id)
+);
+
+CREATE INDEX ix_story_batch_requests_status ON story_batch_requests (status, created);
+CREATE INDEX ix_story_batch_requests_batch ON story_batch_requests (batch_id);
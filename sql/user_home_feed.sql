@@ -0,0 +1,13 @@
+-- Materialized per-user home feed read by POST /dashboard.
+-- One row per user; feed_json holds the story ids of the "recentlyListened"
+-- and "recommended" sections (recent listens with the user's listen time and
+-- position). Cards are built from the story rows on read. Maintained by
+-- home_feed.py; the recommender jobs remove "recommended" from every row
+-- when the model changes, and it is rebuilt on the user's next read.
+
+CREATE TABLE user_home_feed (
+    user_id INT NOT NULL PRIMARY KEY,
+    feed_json NVARCHAR(MAX) NOT NULL,
+    updated DATETIME NOT NULL,
+    CONSTRAINT fk_user_home_feed_user FOREIGN KEY (user_id) REFERENCES "user"(id)
+);
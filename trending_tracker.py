@@ -0,0 +1,252 @@
+# In-memory "trending now" tracker.
+#
+# Listen and like events are fed into a Space-Saving top-K summary backed by a
+# Count-Min sketch, with exponential time decay. Decay uses a forward-decay
+# landmark: an event at time t is added with weight exp((t - landmark) / tau),
+# so stored counts never need touching on every event and summaries from
+# different instances can be merged by addition. Each instance keeps the
+# events it saw since its last checkpoint separately and periodically merges
+# them into a shared checkpoint blob, which is also how new instances warm-start.
+# Besides the checkpoint an event triggers when one is due, a background thread
+# checkpoints every interval and once more at interpreter exit, so the events
+# of a quiet or recycled instance are not lost.
+
+import atexit
+import logging
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+from azure.storage.blob import BlobServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError, ResourceModifiedError
+
+EVENT_WEIGHTS = {"listen": 2.0, "like": 4.0}
+CAPACITY = int(os.environ.get("TrendingCapacity", "200"))
+HALF_LIFE_SECONDS = float(os.environ.get("TrendingHalfLifeHours", "72")) * 3600
+CHECKPOINT_INTERVAL_SECONDS = int(os.environ.get("TrendingCheckpointSeconds", "60"))
+CHECKPOINT_BLOB_NAME = "tracker.json"
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+# Rebase the landmark before exp() gets anywhere near float overflow.
+MAX_EXPONENT = 50.0
+
+TAU = HALF_LIFE_SECONDS / math.log(2)
+_SKETCH_SEEDS = np.asarray([0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F][:SKETCH_DEPTH], dtype=np.uint64)
+
+class HeavyHitters:
+    """Space-Saving summary of at most `capacity` stories, with a Count-Min sketch to bound new entries."""
+
+    def __init__(self, capacity=CAPACITY, landmark=None):
+        self.capacity = capacity
+        self.landmark = time.time() if landmark is None else landmark
+        self.counts = {}
+        self.errors = {}
+        self.sketch = np.zeros((SKETCH_DEPTH, SKETCH_WIDTH), dtype=np.float64)
+
+    def _buckets(self, story_id):
+        return ((np.uint64(story_id) * _SKETCH_SEEDS) >> np.uint64(16)) % np.uint64(SKETCH_WIDTH)
+
+    def _rebase(self, landmark):
+        factor = math.exp((self.landmark - landmark) / TAU)
+        for story_id in self.counts:
+            self.counts[story_id] *= factor
+            self.errors[story_id] *= factor
+        self.sketch *= factor
+        self.landmark = landmark
+
+    def add(self, story_id, weight, now=None):
+        now = time.time() if now is None else now
+        if (now - self.landmark) / TAU > MAX_EXPONENT:
+            self._rebase(now)
+        weight = weight * math.exp((now - self.landmark) / TAU)
+
+        buckets = self._buckets(story_id)
+        rows = np.arange(SKETCH_DEPTH)
+        self.sketch[rows, buckets] += weight
+
+        if story_id in self.counts:
+            self.counts[story_id] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[story_id] = weight
+            self.errors[story_id] = 0.0
+            return
+
+        # Space-Saving: replace the minimum counter. The new entry's true count is
+        # at most both the evicted minimum and its Count-Min estimate.
+        victim = min(self.counts, key=self.counts.get)
+        floor = self.counts.pop(victim)
+        self.errors.pop(victim)
+        estimate = float(self.sketch[rows, buckets].min())
+        overestimate = min(floor + weight, estimate) - weight
+        self.counts[story_id] = overestimate + weight
+        self.errors[story_id] = overestimate
+
+    def merge(self, other):
+        """Fold `other` into this summary, keeping the `capacity` largest counters."""
+        if other.landmark > self.landmark:
+            self._rebase(other.landmark)
+        factor = math.exp((other.landmark - self.landmark) / TAU)
+        for story_id, count in other.counts.items():
+            self.counts[story_id] = self.counts.get(story_id, 0.0) + count * factor
+            self.errors[story_id] = self.errors.get(story_id, 0.0) + other.errors[story_id] * factor
+        self.sketch += other.sketch * factor
+        if len(self.counts) > self.capacity:
+            keep = sorted(self.counts, key=self.counts.get, reverse=True)[:self.capacity]
+            self.counts = {story_id: self.counts[story_id] for story_id in keep}
+            self.errors = {story_id: self.errors[story_id] for story_id in keep}
+
+    def top(self, limit, now=None):
+        """Return [(story_id, decayed_score)] for the `limit` hottest stories."""
+        now = time.time() if now is None else now
+        decay = math.exp((self.landmark - now) / TAU)
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(story_id, count * decay) for story_id, count in ranked]
+
+    def copy(self):
+        clone = HeavyHitters(self.capacity, self.landmark)
+        clone.counts = dict(self.counts)
+        clone.errors = dict(self.errors)
+        clone.sketch = self.sketch.copy()
+        return clone
+
+    def to_json(self):
+        return json.dumps({
+            "landmark": self.landmark,
+            "counts": [[story_id, count, self.errors[story_id]] for story_id, count in self.counts.items()],
+            "sketch": self.sketch.tolist()
+        })
+
+    @classmethod
+    def from_json(cls, data, capacity=CAPACITY):
+        state = json.loads(data)
+        tracker = cls(capacity, state["landmark"])
+        for story_id, count, error in state["counts"]:
+            tracker.counts[story_id] = count
+            tracker.errors[story_id] = error
+        sketch = np.asarray(state["sketch"], dtype=np.float64)
+        if sketch.shape == tracker.sketch.shape:
+            tracker.sketch = sketch
+        return tracker
+
+_lock = threading.Lock()
+_state = {"snapshot": None, "pending": None, "checkpointed": 0.0, "loaded": 0.0}
+_stop = threading.Event()
+
+def _checkpoint_blob():
+    blob_service = BlobServiceClient.from_connection_string(os.environ["AzureBlobStorageConnectionString"])
+    container_client = blob_service.get_container_client(os.environ.get("TrendingContainerName", "trending"))
+    return container_client.get_blob_client(CHECKPOINT_BLOB_NAME)
+
+def _load_checkpoint(blob_client):
+    try:
+        download = blob_client.download_blob()
+        return HeavyHitters.from_json(download.readall()), download.properties.etag
+    except ResourceNotFoundError:
+        return HeavyHitters(), None
+
+def _ensure_loaded():
+    if _state["snapshot"] is not None:
+        return
+    try:
+        snapshot, _ = _load_checkpoint(_checkpoint_blob())
+    except Exception as e:
+        logging.warning(f"Trending tracker warm-start failed, starting empty: {str(e)}")
+        snapshot = HeavyHitters()
+    _state["snapshot"] = snapshot
+    _state["pending"] = HeavyHitters(landmark=snapshot.landmark)
+    _state["checkpointed"] = time.monotonic()
+    _state["loaded"] = time.monotonic()
+    threading.Thread(target=_checkpoint_periodically, daemon=True).start()
+    atexit.register(_final_checkpoint)
+
+def _checkpoint_periodically():
+    while not _stop.wait(CHECKPOINT_INTERVAL_SECONDS):
+        try:
+            checkpoint()
+        except Exception as e:
+            logging.warning(f"Periodic trending checkpoint failed: {str(e)}")
+
+def _final_checkpoint():
+    _stop.set()
+    try:
+        checkpoint()
+    except Exception as e:
+        logging.warning(f"Final trending checkpoint failed: {str(e)}")
+
+def checkpoint():
+    """Merge this instance's pending events into the shared checkpoint blob."""
+    with _lock:
+        _ensure_loaded()
+        pending = _state["pending"]
+        _state["checkpointed"] = time.monotonic()
+        if not pending.counts:
+            return
+        _state["pending"] = HeavyHitters(landmark=pending.landmark)
+
+    merged = None
+    try:
+        blob_client = _checkpoint_blob()
+        for _ in range(3):
+            candidate, etag = _load_checkpoint(blob_client)
+            candidate.merge(pending)
+            try:
+                if etag is None:
+                    blob_client.upload_blob(candidate.to_json(), overwrite=False)
+                else:
+                    blob_client.upload_blob(candidate.to_json(), overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+                merged = candidate
+                break
+            except (ResourceModifiedError, ResourceExistsError):
+                continue
+    except Exception as e:
+        logging.warning(f"Trending checkpoint failed: {str(e)}")
+
+    if merged is None:
+        # Keep the events for the next attempt rather than dropping them.
+        with _lock:
+            _state["pending"].merge(pending)
+        return
+
+    with _lock:
+        _state["snapshot"] = merged
+        _state["loaded"] = time.monotonic()
+
+def record_event(story_id, event_type):
+    """Feed a listen/like event into the tracker. Never raises; trending is best effort."""
+    try:
+        with _lock:
+            _ensure_loaded()
+            _state["pending"].add(int(story_id), EVENT_WEIGHTS[event_type])
+            due = time.monotonic() - _state["checkpointed"] > CHECKPOINT_INTERVAL_SECONDS
+        if due:
+            checkpoint()
+    except Exception as e:
+        logging.warning(f"Failed to record trending event for story {story_id}: {str(e)}")
+
+def _refresh_snapshot():
+    # Instances that serve but rarely record events still need to see what
+    # the others have checkpointed.
+    try:
+        snapshot, _ = _load_checkpoint(_checkpoint_blob())
+    except Exception as e:
+        logging.warning(f"Failed to refresh trending snapshot: {str(e)}")
+        return
+    with _lock:
+        _state["snapshot"] = snapshot
+        _state["loaded"] = time.monotonic()
+
+def trending_now(limit):
+    """Return [(story_id, score)] for the hottest stories known to this instance."""
+    with _lock:
+        _ensure_loaded()
+        stale = time.monotonic() - _state["loaded"] > CHECKPOINT_INTERVAL_SECONDS
+    if stale:
+        _refresh_snapshot()
+    with _lock:
+        view = _state["snapshot"].copy()
+        view.merge(_state["pending"])
+    return view.top(limit)